@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -45,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'carbuyrest22app.instrumentation.MetricsMiddleware',
+    'carbuyrest22app.ratelimit.AdmissionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,13 +80,50 @@ WSGI_APPLICATION = 'CarBuy.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
-
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite by default; CARBUY_DB_ENGINE=postgresql switches to PostgreSQL using
+# CARBUY_DB_NAME, CARBUY_DB_USER, CARBUY_DB_PASSWORD, CARBUY_DB_HOST and
+# CARBUY_DB_PORT. CARBUY_DB_TUNING=off restores Django's plain configuration
+# (default backend, no pragmas, a new connection per request).
+
+CARBUY_DB_TUNING = os.environ.get('CARBUY_DB_TUNING', 'on') != 'off'
+
+# Milliseconds a connection waits for a lock held by another writer
+CARBUY_DB_BUSY_TIMEOUT = 20000
+
+# Applied to every new SQLite connection (see carbuyrest22app/database.py)
+CARBUY_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': CARBUY_DB_BUSY_TIMEOUT,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+} if CARBUY_DB_TUNING else {}
+
+if os.environ.get('CARBUY_DB_ENGINE', 'sqlite') == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('CARBUY_DB_NAME', 'carbuy'),
+            'USER': os.environ.get('CARBUY_DB_USER', ''),
+            'PASSWORD': os.environ.get('CARBUY_DB_PASSWORD', ''),
+            'HOST': os.environ.get('CARBUY_DB_HOST', ''),
+            'PORT': os.environ.get('CARBUY_DB_PORT', ''),
+            'OPTIONS': {'connect_timeout': 5},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'carbuyrest22app.backends.sqlite3' if CARBUY_DB_TUNING else 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('CARBUY_DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {'timeout': CARBUY_DB_BUSY_TIMEOUT / 1000} if CARBUY_DB_TUNING else {},
+        }
     }
-}
+
+if CARBUY_DB_TUNING:
+    # Reuse connections across requests, checking them before reuse
+    DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('CARBUY_DB_CONN_MAX_AGE', 60))
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
 
 
 # Password validation
@@ -126,3 +166,243 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Catalog pagination
+# get_ads pages are keyset-paginated on Car.id; the full listing is streamed.
+
+CARBUY_PAGE_SIZE = 50
+
+CARBUY_MAX_PAGE_SIZE = 500
+
+# Rows fetched per database round trip while streaming the catalog
+CARBUY_STREAM_CHUNK_SIZE = 2000
+
+# Rows encoded per chunk written to the client while streaming
+CARBUY_STREAM_BATCH_SIZE = 100
+
+# Catalog snapshot
+# The full get_ads listing is written to DIRECTORY as JSON, gzip and (when the
+# brotli package is installed) brotli files named after the catalog and
+# favourites versions, and served with FileResponse while both are current.
+# With AUTO, ad and favourite writes rebuild it in a background thread once no
+# write has happened for DEBOUNCE seconds, or at most MAX_DELAY seconds after
+# the first one; a lock file in DIRECTORY lets a single process build each
+# pair of versions, with the cheap AUTO_* compression levels.
+# manage.py build_catalog_snapshot uses GZIP_LEVEL and BROTLI_QUALITY. Set DIRECTORY to an empty value to always stream the listing.
+
+CARBUY_CATALOG_SNAPSHOT = {
+    'DIRECTORY': os.environ.get('CARBUY_CATALOG_SNAPSHOT', str(BASE_DIR / 'catalog_snapshot')),
+    'AUTO': True,
+    'DEBOUNCE': 2.0,
+    'MAX_DELAY': 30.0,
+    'GZIP_LEVEL': 9,
+    'BROTLI_QUALITY': 9,
+    'AUTO_GZIP_LEVEL': 1,
+    'AUTO_BROTLI_QUALITY': 3,
+}
+
+
+# Session tokens
+# With CARBUY_SIGNED_TOKENS new sessions get HMAC-signed tokens that are verified
+# without a database lookup. Legacy tokens stored in User.token keep working.
+
+CARBUY_SIGNED_TOKENS = False
+
+CARBUY_TOKEN_TTL = 30 * 24 * 60 * 60
+
+# Seconds between reloads of the in-memory revocation filter
+CARBUY_REVOCATION_REFRESH = 5
+
+CARBUY_REVOCATION_BLOOM_BITS = 1 << 20
+
+CARBUY_REVOCATION_BLOOM_HASHES = 7
+
+
+# Password hashing
+# bcrypt runs in a bounded thread pool. With the default queue depth of 0 a
+# request is only admitted when a worker is free; requests beyond the queue
+# depth get a 503 immediately.
+# Changing CARBUY_BCRYPT_ROUNDS rehashes each password on its next login.
+
+CARBUY_BCRYPT_ROUNDS = 12
+
+CARBUY_HASH_WORKERS = 4
+
+# Requests allowed to wait for a busy worker, on top of one per worker
+CARBUY_HASH_QUEUE_DEPTH = 0
+
+# Seconds a request waits for its own hash before giving up with a 503
+CARBUY_HASH_TIMEOUT = 5
+
+CARBUY_HASH_RETRY_AFTER = 1
+
+
+# Async endpoints
+# Read endpoints listed here are served by their async version (carbuyrest22app.async_endpoints),
+# which avoids the sync adapter when running under CarBuy.asgi. Available: account, search_cars,
+# ad_details, get_favourites, get_ads, get_user.
+
+CARBUY_ASYNC_ENDPOINTS = []
+
+
+# Bulk ad ingestion
+# NDJSON uploads to ad_management are inserted in bulk_create batches of this size.
+
+CARBUY_BULK_BATCH_SIZE = 1000
+
+
+# Search result cache
+# Result ids keyed on the normalized query and the catalog version, so any ad write
+# invalidates them; rows (and favourite counts) are read on every request.
+# BACKEND 'locmem' keeps a per-process LRU bounded by MAX_ENTRIES and MAX_BYTES;
+# 'django' stores entries in the CACHES alias CACHE_ALIAS for TIMEOUT seconds.
+
+CARBUY_SEARCH_CACHE = {
+    'BACKEND': 'locmem',
+    'MAX_ENTRIES': 2048,
+    'MAX_BYTES': 32 * 1024 * 1024,
+}
+
+
+# Delta sync
+# Every ad write appends a CarChange row in the same transaction; sync/?since=<cursor>
+# returns the ads changed and the ids deleted after the cursor, PAGE_SIZE
+# entries at a time (at most MAX_PAGE_SIZE). manage.py compact_changes drops
+# entries superseded by a later change of the same ad and deletions older
+# than TOMBSTONE_DAYS. A cursor issued before a later deletion was dropped gets
+# 410 and the client syncs again from since=0.
+
+CARBUY_SYNC = {
+    'PAGE_SIZE': 500,
+    'MAX_PAGE_SIZE': 5000,
+    'TOMBSTONE_DAYS': 30,
+}
+
+
+# Catalog export
+# export/ and manage.py export_ads stream every ad as NDJSON or CSV, optionally
+# with the seller's name and phone (export/ requires a sessionToken). Rows are fetched CHUNK_SIZE per database
+# round trip and encoded BATCH_SIZE at a time. Gzip output (Accept-Encoding:
+# gzip, or export_ads --gzip) uses GZIP_LEVEL; 1 keeps compression from
+# becoming the bottleneck.
+
+CARBUY_EXPORT = {
+    'CHUNK_SIZE': 5000,
+    'BATCH_SIZE': 1000,
+    'GZIP_LEVEL': 1,
+}
+
+
+# Ad detail caches
+# Read-through caches for ad/<id>/: ad columns keyed by car id and seller name
+# and phone keyed by user id. Entries are deleted by the Car and User
+# save/delete signals, so a cached ad is served without queries. 'locmem'
+# only sees the writes of its own process; with several processes use
+# BACKEND 'django' and a shared CACHES backend, or keep TIMEOUT short.
+
+CARBUY_AD_CACHE = {
+    'BACKEND': 'locmem',
+    'MAX_ENTRIES': 20000,
+    'MAX_BYTES': 16 * 1024 * 1024,
+    'TIMEOUT': 60,
+}
+
+CARBUY_SELLER_CACHE = {
+    'BACKEND': 'locmem',
+    'MAX_ENTRIES': 20000,
+    'MAX_BYTES': 4 * 1024 * 1024,
+    'TIMEOUT': 60,
+}
+
+
+# Facets
+# Width of the price buckets returned by facets/. Run manage.py rebuild_facets after changing it.
+
+CARBUY_PRICE_BUCKET = 5000
+
+
+# Request instrumentation
+# Per-route histograms are exposed at /metrics/. The Server-Timing header
+# reveals how long each request spent in the database, bcrypt and JSON encoding.
+
+CARBUY_SERVER_TIMING = True
+
+
+# JSON encoding
+# Responses are encoded with orjson when it is installed; set to False to
+# always use the standard library encoder.
+
+CARBUY_FAST_JSON = True
+
+
+# Favourites
+# Maximum number of car ids accepted in one add/remove batch
+
+CARBUY_MAX_FAVOURITES_BATCH = 500
+
+
+# Similar cars
+# ad/<id>/similar/ ranks ads by a weighted distance over brand, model, year and
+# price, computed in memory with numpy. The index is loaded from SNAPSHOT on the
+# first request (or built from the database if it does not exist yet); run
+# manage.py build_similar_index to refresh it.
+
+CARBUY_SIMILAR_SNAPSHOT = os.environ.get('CARBUY_SIMILAR_SNAPSHOT', str(BASE_DIR / 'similar_index.npz'))
+
+# Weight of each feature: brand and model count once per mismatch, year once
+# per 5 years of difference squared and price once per doubling squared
+CARBUY_SIMILAR_WEIGHTS = {
+    'brand': 1.0,
+    'model': 1.0,
+    'year': 1.0,
+    'price': 1.0,
+}
+
+
+# Co-favourite recommendations
+# manage.py build_neighbours stores the TOP_N most similar cars of every car by
+# shared favourites; ad/<id>/also_liked/ serves them. Memory is bounded by
+# MAX_BATCH_PAIRS (car pairs held at once). Users with more than
+# MAX_USER_FAVOURITES favourites are ignored.
+
+CARBUY_NEIGHBOURS = {
+    'TOP_N': 20,
+    'CHUNK_SIZE': 50000,
+    'MAX_BATCH_PAIRS': 5000000,
+    'MAX_BATCH_CARS': 5000,
+    'MAX_USER_FAVOURITES': 1000,
+}
+
+
+# Admission control
+# Per-client token buckets by route and method: (requests per second, burst).
+# Clients are identified by REMOTE_ADDR or, behind TRUSTED_PROXIES proxies
+# that append to CLIENT_HEADER (e.g. 'X-Forwarded-For'), by the address
+# TRUSTED_PROXIES entries from its right end. 'locmem' keeps the buckets per
+# process (at most MAX_BUCKETS); 'django' shares them through the CACHES
+# alias CACHE_ALIAS, which should be memcached or redis.
+
+CARBUY_RATE_LIMIT = {
+    'BACKEND': 'locmem',
+    'MAX_BUCKETS': 100000,
+    'CLIENT_HEADER': None,
+    'TRUSTED_PROXIES': 1,
+}
+
+CARBUY_RATE_LIMITS = {
+    'sessions/': {'POST': (1, 10)},
+    'users/': {'POST': (0.2, 5)},
+    'password/': {'POST': (0.2, 5)},
+    'get_ads/': {'GET': (5, 20)},
+    'export/': {'GET': (0.1, 5)},
+}
+
+# Requests per route each process serves at once; the rest get 503
+CARBUY_CONCURRENCY_LIMITS = {
+    'sessions/': 8,
+    'users/': 4,
+    'password/': 4,
+    'get_ads/': 8,
+    'export/': 2,
+}
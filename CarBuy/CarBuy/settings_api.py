@@ -0,0 +1,30 @@
+"""
+API-only settings for CarBuy.
+
+Select with DJANGO_SETTINGS_MODULE=CarBuy.settings_api (or --settings). Same
+configuration as CarBuy.settings, without the admin site and the apps and
+middleware it needs: the REST endpoints authenticate with session tokens and
+are csrf_exempt, so none of them use contrib.auth, sessions or messages.
+Compare both profiles with manage.py benchmark_profiles.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+
+# Application definition
+# Only the CarBuy app: no admin/, no templates and no static files.
+
+INSTALLED_APPS = [
+    'carbuyrest22app.apps.Carbuyrest22AppConfig',
+]
+
+MIDDLEWARE = [
+    'carbuyrest22app.instrumentation.MetricsMiddleware',
+    'carbuyrest22app.ratelimit.AdmissionMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.common.CommonMiddleware',
+]
+
+TEMPLATES = []
+
+AUTH_PASSWORD_VALIDATORS = []
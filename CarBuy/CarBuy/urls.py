@@ -1,18 +1,40 @@
-from django.contrib import admin
+from django.apps import apps
+from django.conf import settings
 from django.urls import path
-from carbuyrest22app import endpoints
+from carbuyrest22app import async_endpoints, endpoints
+
+
+def view(name):
+    # Las rutas listadas en CARBUY_ASYNC_ENDPOINTS usan la version asincrona del endpoint
+    if name in settings.CARBUY_ASYNC_ENDPOINTS:
+        return getattr(async_endpoints, name)
+    return getattr(endpoints, name)
+
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
     path('users/', endpoints.users),
     path('sessions/', endpoints.sessions),
     path('password/', endpoints.password),
-    path('account/', endpoints.account),
-    path('search/', endpoints.search_cars),
-    path('ad/<int:position_id>/', endpoints.ad_details),
+    path('account/', view('account')),
+    path('search/', view('search_cars')),
+    path('search/cache_stats/', endpoints.search_cache_stats),
+    path('ad/<int:position_id>/', view('ad_details')),
+    path('ad/<int:position_id>/similar/', endpoints.similar_cars),
+    path('ad/<int:position_id>/also_liked/', endpoints.also_liked),
     path('ad_management/', endpoints.ad_management),
     path('favourite_management/', endpoints.favourite_management),
-    path('get_favourites/', endpoints.get_favourites),
-    path('get_ads/', endpoints.get_ads),
-    path('get_user/', endpoints.get_user)
+    path('get_favourites/', view('get_favourites')),
+    path('get_ads/', view('get_ads')),
+    path('export/', endpoints.export_ads),
+    path('sync/', endpoints.sync_ads),
+    path('filter_ads/', endpoints.filter_ads),
+    path('facets/', endpoints.facets),
+    path('most_favourited/', endpoints.most_favourited),
+    path('metrics/', endpoints.metrics),
+    path('get_user/', view('get_user'))
 ]
+
+# El perfil CarBuy.settings_api no instala el admin
+if apps.is_installed('django.contrib.admin'):
+    from django.contrib import admin
+    urlpatterns.insert(0, path('admin/', admin.site.urls))
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class Carbuyrest22AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'carbuyrest22app'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,135 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from .catalog import aad_validators, alisting_validators, arequest_catalog_state
+from .conditional import async_conditional
+from .details import arequest_ad, detail_row
+from .endpoints import search_params
+from .models import Car, FavouriteCar, User
+from .pagination import akeyset_page, parse_page_params
+from .search import search_cache, search_cache_key, search_car_ids, search_entry_size
+from .serializers import (
+    AD_LIST_FIELDS, FAVOURITE_FIELDS, USER_FIELDS, JsonResponse, ad_detail_data, ad_list_row,
+    astream_json_array, favourite_data, search_results, user_data
+)
+from .snapshot import snapshot_response, snapshot_scheduler
+from .tokens import asession_user_id
+
+
+# Versiones asincronas de los endpoints de lectura. Devuelven exactamente lo
+# mismo que los de endpoints.py, pero servidos por CarBuy.asgi no ocupan un
+# hilo mientras esperan. En CarBuy/urls.py se elige cual usar en cada ruta
+# con el ajuste CARBUY_ASYNC_ENDPOINTS.
+
+
+async def account(request):
+    if request.method == 'GET':
+        header_token = request.headers.get('sessionToken', None)
+        if not header_token:
+            return JsonResponse({'error': 'Body token missing'}, status=401)
+        user_id = await asession_user_id(header_token)
+        if user_id is None:
+            return JsonResponse({'error': 'Invalid sessionToken'}, status=401)
+        try:
+            session = await User.objects.only('id', 'email').aget(id=user_id)
+        except User.DoesNotExist:
+            return JsonResponse({'error': 'Invalid sessionToken'}, status=401)
+        return JsonResponse(session.to_jsonAccount(), status=200)
+
+
+@async_conditional(alisting_validators)
+async def search_cars(request):
+    if request.method == 'GET':
+        try:
+            search_query, page, limit = search_params(request)
+        except ValueError as error:
+            return JsonResponse({'error': str(error)}, status=400)
+
+        version = (await arequest_catalog_state(request))[0]
+        cache_key = search_cache_key(version, search_query, page, limit)
+        cached = await search_cache.aget(cache_key)
+        if cached is not None:
+            car_ids, next_page = cached
+        else:
+            # La consulta al indice de texto completo es SQL directo, sin API asincrona
+            car_ids = await sync_to_async(search_car_ids)(search_query, (page - 1) * limit, limit + 1)
+            next_page = page + 1 if len(car_ids) > limit else None
+            car_ids = car_ids[:limit]
+            await search_cache.aset(cache_key, (car_ids, next_page), search_entry_size(car_ids))
+
+        cars = [car async for car in Car.objects.filter(id__in=car_ids).values_list(*AD_LIST_FIELDS)]
+        return JsonResponse({'cars': search_results(car_ids, cars), 'next_page': next_page}, status=200)
+    else:
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+
+@async_conditional(aad_validators)
+async def ad_details(request, position_id):
+    if request.method == 'GET':
+        ad = await arequest_ad(request, position_id)
+        if ad is None:
+            return JsonResponse({"error": "Ad not found"}, status=404)
+        return JsonResponse(ad_detail_data(detail_row(ad)), status=200)
+    else:
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+
+
+async def get_favourites(request):
+    if request.method == 'GET':
+        user_id = await asession_user_id(request.headers.get('sessionToken'))
+        if user_id is None:
+            return JsonResponse({'error': 'Invalid sessionToken'}, status=401)
+
+        favourites = FavouriteCar.objects.filter(user_id=user_id).order_by('id').values_list(*FAVOURITE_FIELDS)
+        favourites_data = [favourite_data(user_id, favourite) async for favourite in favourites]
+        return JsonResponse(favourites_data, status=200, safe=False)
+    else:
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+
+
+@async_conditional(alisting_validators)
+async def get_ads(request):
+    if request.method == 'GET':
+        cars = Car.objects.values_list(*AD_LIST_FIELDS)
+
+        if 'cursor' in request.GET or 'limit' in request.GET:
+            try:
+                cursor, limit = parse_page_params(request)
+            except ValueError:
+                return JsonResponse({"error": "Invalid pagination parameters"}, status=400)
+
+            rows, next_cursor = await akeyset_page(cars, cursor, limit)
+            cars_data = [ad_list_row(row) for row in rows]
+            return JsonResponse({"cars": cars_data, "next_cursor": next_cursor}, status=200)
+
+        # La copia en disco de la version actual, si existe (ver snapshot.py)
+        response = snapshot_response(request, await arequest_catalog_state(request),
+                                     (await alisting_validators(request))[0])
+        if response is not None:
+            return response
+        snapshot_scheduler.schedule()
+
+        # En Django 4.2 values_list().aiterator() ejecuta la consulta fuera de
+        # sync_to_async; values() si funciona y conserva el orden de las columnas
+        async def rows():
+            chunks = Car.objects.values(*AD_LIST_FIELDS).order_by('id')
+            async for row in chunks.aiterator(chunk_size=settings.CARBUY_STREAM_CHUNK_SIZE):
+                yield ad_list_row(row.values())
+
+        return StreamingHttpResponse(astream_json_array(rows()), content_type='application/json')
+    else:
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+
+
+async def get_user(request):
+    if request.method == 'GET':
+        sessionToken = request.headers.get('sessionToken')
+        user_id = await asession_user_id(sessionToken)
+        user = None
+        if user_id is not None:
+            user = await User.objects.filter(id=user_id).values_list(*USER_FIELDS).afirst()
+        if user is None:
+            return JsonResponse({"error": "User not found"}, status=404)
+        return JsonResponse(user_data(user, sessionToken), status=200)
+    else:
+        return JsonResponse({"error": "Invalid request method"}, status=405)
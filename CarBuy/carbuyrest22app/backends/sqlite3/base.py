@@ -0,0 +1,14 @@
+from django.db.backends.sqlite3 import base
+
+
+# Backend de SQLite de Django con una sola diferencia: las transacciones
+# empiezan con BEGIN IMMEDIATE. Con el BEGIN normal, una transaccion que lee y
+# luego escribe (por ejemplo car.save(), que consulta las facetas anteriores)
+# falla con "database is locked" sin esperar a busy_timeout si otro escritor
+# se le adelanta. Con IMMEDIATE el bloqueo de escritura se pide al empezar y
+# la espera si respeta busy_timeout. Django 5.1 lo permite con la opcion
+# "transaction_mode"; en 4.2 hace falta este backend.
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
@@ -0,0 +1,443 @@
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from django.apps import apps
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+from django.test import Client
+from django.urls import path
+
+from . import async_endpoints, endpoints
+from .favourites import reconcile_favourite_counts
+from .hashing import hash_password
+from .models import Car, CarChange, FavouriteCar, User
+from .signals import cars_bulk_created
+from .tokens import start_session
+
+
+# Utilidades compartidas por los comandos de benchmark
+
+
+READ_ENDPOINTS = ('account', 'search_cars', 'ad_details', 'get_favourites', 'get_ads', 'get_user')
+
+
+def read_urlpatterns(module):
+    return [
+        path('account/', module.account),
+        path('search/', module.search_cars),
+        path('ad/<int:position_id>/', module.ad_details),
+        path('get_favourites/', module.get_favourites),
+        path('get_ads/', module.get_ads),
+        path('get_user/', module.get_user),
+    ]
+
+
+class SyncURLConf:
+    # URLconf con las versiones sincronas de los endpoints de lectura
+    urlpatterns = read_urlpatterns(endpoints)
+
+
+class AsyncURLConf:
+    # URLconf con las versiones asincronas de los endpoints de lectura
+    urlpatterns = read_urlpatterns(async_endpoints)
+
+
+def percentile(sorted_values, fraction):
+    # Percentil por el metodo del rango mas cercano sobre una lista ordenada
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed):
+    # Resume una lista de latencias (segundos) medidas durante elapsed segundos
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+# Datos sinteticos para los benchmarks. Todo sale de un random.Random con
+# semilla, asi que dos ejecuciones con la misma semilla generan el mismo
+# catalogo, y se inserta con bulk_create por lotes.
+
+SEED_PASSWORD = 'benchmark'
+
+BRANDS = {
+    'Volkswagen': ('Golf', 'Polo', 'Passat', 'Tiguan'),
+    'Seat': ('Ibiza', 'Leon', 'Ateca', 'Arona'),
+    'Renault': ('Clio', 'Megane', 'Captur', 'Kadjar'),
+    'Toyota': ('Corolla', 'Yaris', 'RAV4', 'Auris'),
+    'BMW': ('Serie 1', 'Serie 3', 'X1', 'X3'),
+    'Ford': ('Fiesta', 'Focus', 'Kuga', 'Mondeo'),
+    'Peugeot': ('208', '308', '2008', '3008'),
+    'Audi': ('A3', 'A4', 'Q3', 'Q5'),
+}
+
+DESCRIPTION_WORDS = ('diesel', 'gasolina', 'hibrido', 'automatico', 'manual', 'unico', 'propietario',
+                     'revisiones', 'oficiales', 'garantia', 'itv', 'recien', 'pasada', 'navegador',
+                     'techo', 'solar', 'llantas', 'aleacion', 'bluetooth', 'camara', 'trasera')
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def seed_dataset(users, cars, favourites, seed=0, batch_size=5000):
+    # Inserta usuarios, anuncios y favoritos aleatorios y devuelve cuantos ha creado
+    rng = random.Random(seed)
+    # bcrypt es caro: todos los usuarios comparten la misma contraseña ya hasheada
+    encrypted_password = hash_password(SEED_PASSWORD)
+    first = User.objects.count()
+
+    user_ids = []
+    new_users = (
+        User(
+            email='bench%d@carbuy.test' % (first + i),
+            name='Usuario %d' % (first + i),
+            encrypted_password=encrypted_password,
+            birthdate='1990-01-01',
+            phone='6%08d' % (first + i),
+        )
+        for i in range(users)
+    )
+    for batch in _batches(new_users, batch_size):
+        user_ids += [user.id for user in User.objects.bulk_create(batch)]
+    if not user_ids:
+        return {'users': 0, 'cars': 0, 'favourites': 0}
+
+    def new_car():
+        brand = rng.choice(list(BRANDS))
+        model = rng.choice(BRANDS[brand])
+        year = rng.randint(1995, 2024)
+        return Car(
+            brand=brand,
+            model=model,
+            year=year,
+            price=Decimal(rng.randrange(1000, 80000, 50)),
+            description='%s %s de %d, %s' % (brand, model, year, ' '.join(rng.sample(DESCRIPTION_WORDS, 6))),
+            user_id=rng.choice(user_ids),
+        )
+
+    car_ids = []
+    for batch in _batches((new_car() for _ in range(cars)), batch_size):
+        # Igual que la subida NDJSON: facetas y version del catalogo en la misma transaccion
+        with transaction.atomic():
+            batch = Car.objects.bulk_create(batch)
+            cars_bulk_created.send(sender=Car, cars=batch)
+        car_ids += [car.id for car in batch]
+
+    def new_favourites():
+        # Cada usuario marca coches distintos; el resto se reparte entre los primeros
+        if not car_ids:
+            return
+        per_user, extra = divmod(favourites, len(user_ids))
+        for index, user_id in enumerate(user_ids):
+            count = min(per_user + (index < extra), len(car_ids))
+            for position in rng.sample(range(len(car_ids)), count):
+                yield FavouriteCar(user_id=user_id, car_id=car_ids[position])
+
+    created_favourites = 0
+    for batch in _batches(new_favourites(), batch_size):
+        FavouriteCar.objects.bulk_create(batch)
+        created_favourites += len(batch)
+    # bulk_create no actualiza los contadores de favoritos
+    reconcile_favourite_counts()
+
+    return {'users': len(user_ids), 'cars': len(car_ids), 'favourites': created_favourites}
+
+
+# Escenarios: una funcion prepare(i) por ruta de CarBuy/urls.py que devuelve
+# la peticion i-esima (metodo, ruta, cuerpo y cabeceras). Todo lo que no forma
+# parte de la peticion (abrir sesiones, crear el anuncio que se va a borrar...)
+# se hace en prepare, fuera del tiempo medido.
+
+
+def _request(method, url, body=None, token=None, content_type='application/json'):
+    headers = {'sessionToken': token} if token else {}
+    data = json.dumps(body) if body is not None else ''
+    return method, url, data, content_type, headers
+
+
+def route_scenarios(seed=0, readers=100):
+    # Devuelve [(nombre, prepare, maximo de peticiones o None)] en orden de
+    # ejecucion: primero las lecturas y al final las rutas que modifican datos
+    rng = random.Random(seed)
+    user_ids = list(User.objects.order_by('id').values_list('id', flat=True))
+    car_ids = list(Car.objects.order_by('id').values_list('id', flat=True))
+    if not user_ids or not car_ids:
+        raise ValueError('No hay usuarios ni anuncios; ejecuta antes seed_benchmark')
+
+    # Los lectores tienen una sesion abierta todo el benchmark; login, logout y
+    # cambio de contraseña usan otros usuarios para no invalidar esas sesiones
+    readers = user_ids[:readers]
+    others = user_ids[len(readers):] or user_ids
+    tokens = [start_session(user_id) for user_id in readers]
+    emails = dict(User.objects.filter(id__in=others[:1000]).values_list('id', 'email'))
+    others = [user_id for user_id in others if user_id in emails]
+    words = [word for brand, models in BRANDS.items() for word in (brand, *models)] + list(DESCRIPTION_WORDS)
+    run = '%x' % int(time.time() * 1000)
+    # Los clientes de sync/ piden los ultimos cambios
+    last_change = CarChange.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+    def reader_token(i):
+        return tokens[i % len(tokens)]
+
+    def other(i):
+        return others[i % len(others)]
+
+    def new_ad(i):
+        return {'brand': 'Seat', 'model': 'Ibiza', 'year': 2015, 'price': 9000, 'description': 'Benchmark',
+                'image_url': 'https://example.com/car.jpg', 'user_id': readers[i % len(readers)]}
+
+    def delete_ad(i):
+        car = Car.objects.create(**new_ad(i))
+        return _request('DELETE', '/ad_management/', {'car_id': car.id})
+
+    def logout(i):
+        return _request('DELETE', '/sessions/', token=start_session(other(i)))
+
+    def change_password(i):
+        return _request('POST', '/password/', {'current_password': SEED_PASSWORD, 'new_password': SEED_PASSWORD},
+                        token=start_session(other(i)))
+
+    scenarios = []
+    if apps.is_installed('django.contrib.admin'):
+        scenarios.append(('admin', lambda i: _request('GET', '/admin/login/'), None))
+    return scenarios + [
+        ('account', lambda i: _request('GET', '/account/', token=reader_token(i)), None),
+        ('get_user', lambda i: _request('GET', '/get_user/', token=reader_token(i)), None),
+        ('get_favourites', lambda i: _request('GET', '/get_favourites/', token=reader_token(i)), None),
+        ('ad_details', lambda i: _request('GET', '/ad/%d/' % rng.choice(car_ids)), None),
+        ('similar_cars', lambda i: _request('GET', '/ad/%d/similar/' % rng.choice(car_ids)), None),
+        ('also_liked', lambda i: _request('GET', '/ad/%d/also_liked/' % rng.choice(car_ids)), None),
+        ('get_ads', lambda i: _request('GET', '/get_ads/?limit=50&cursor=%d' % rng.choice(car_ids)), None),
+        # El catalogo completo es muy grande: pocas peticiones bastan
+        ('get_ads_stream', lambda i: _request('GET', '/get_ads/'), 5),
+        ('sync', lambda i: _request('GET', '/sync/?since=%d' % max(0, last_change - 500)), None),
+        ('export', lambda i: _request('GET', '/export/?format=%s&sellers=1' % ('ndjson', 'csv')[i % 2],
+                                      token=reader_token(i)), 4),
+        ('search', lambda i: _request('GET', '/search/?q=%s' % '+'.join(rng.sample(words, rng.randint(1, 2)))), None),
+        ('search_cache_stats', lambda i: _request('GET', '/search/cache_stats/'), None),
+        ('filter_ads', lambda i: _request('GET', '/filter_ads/?brand=%s&year_min=%d&sort=%s' % (
+            rng.choice(list(BRANDS)), rng.randint(1995, 2020), rng.choice(('price', '-year', 'newest')))), None),
+        ('facets', lambda i: _request('GET', '/facets/'), None),
+        ('most_favourited', lambda i: _request('GET', '/most_favourited/?limit=20'), None),
+        ('metrics', lambda i: _request('GET', '/metrics/'), None),
+        ('favourite_management', lambda i: _request('PUT', '/favourite_management/', {'car_id': rng.choice(car_ids)},
+                                                    token=reader_token(i)), None),
+        ('ad_management_post', lambda i: _request('POST', '/ad_management/', new_ad(i)), None),
+        ('ad_management_put', lambda i: _request('PUT', '/ad_management/', {'car_id': rng.choice(car_ids),
+                                                                            'price': rng.randrange(1000, 80000)}), None),
+        ('ad_management_delete', delete_ad, None),
+        ('sessions_post', lambda i: _request('POST', '/sessions/', {'email': emails[other(i)],
+                                                                    'password': SEED_PASSWORD}), None),
+        ('sessions_delete', logout, None),
+        ('password', change_password, None),
+        ('users', lambda i: _request('POST', '/users/', {'name': 'Nuevo', 'mail': 'new-%s-%d@carbuy.test' % (run, i),
+                                                         'password': SEED_PASSWORD, 'birthdate': '2000-01-01',
+                                                         'phone': '600000000'}), None),
+    ]
+
+
+_clients = threading.local()
+
+
+def _send(request):
+    # Envia una peticion con el Client del hilo y devuelve (latencia, estado, consultas)
+    client = getattr(_clients, 'client', None)
+    if client is None:
+        client = _clients.client = Client(raise_request_exception=False)
+    method, url, data, content_type, headers = request
+    queries = 0
+
+    def count(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    with connection.execute_wrapper(count):
+        response = client.generic(method, url, data, content_type, headers=headers)
+        if response.streaming:
+            b''.join(response.streaming_content)
+    return time.perf_counter() - start, response.status_code, queries
+
+
+def run_scenario(prepare, total, concurrency):
+    # Prepara todas las peticiones y las lanza con concurrency hilos. Con un
+    # solo cliente se ejecutan en el hilo actual, sin ThreadPoolExecutor.
+    requests = [prepare(i) for i in range(total)]
+    started = time.perf_counter()
+    if concurrency <= 1:
+        results = [_send(request) for request in requests]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(_send, requests))
+    elapsed = time.perf_counter() - started
+
+    stats = summarize([latency for latency, status, queries in results], elapsed)
+    statuses = {}
+    for latency, status, queries in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    stats['queries_per_request'] = sum(queries for latency, status, queries in results) / len(results) if results else 0.0
+    stats['statuses'] = statuses
+    return stats
+
+
+def compare_results(baseline, current, max_regression):
+    # Compara dos resultados de benchmark y devuelve la lista de regresiones:
+    # p95 o throughput peor que la referencia en mas de max_regression (0.2 =
+    # 20%), o mas consultas por peticion (el numero de consultas no tiene ruido)
+    regressions = []
+    for name, stats in sorted(current['routes'].items()):
+        base = baseline.get('routes', {}).get(name)
+        if base is None:
+            continue
+        if stats['p95_ms'] > base['p95_ms'] * (1 + max_regression):
+            regressions.append('%s: p95 %.2f ms > %.2f ms' % (name, stats['p95_ms'], base['p95_ms']))
+        if stats['throughput'] < base['throughput'] * (1 - max_regression):
+            regressions.append('%s: throughput %.1f req/s < %.1f req/s' % (name, stats['throughput'], base['throughput']))
+        if stats['queries_per_request'] > base['queries_per_request'] + 0.01:
+            regressions.append('%s: %.2f queries/request > %.2f' % (
+                name, stats['queries_per_request'], base['queries_per_request']))
+    return regressions
+
+
+# Prueba de carga de la base de datos: escritores que publican anuncios y
+# marcan favoritos mientras los lectores recorren el catalogo, todo a traves
+# de las vistas y cada hilo con su propia conexion.
+
+
+def stress_database(writers, readers, seconds, seed=0):
+    if not User.objects.exists():
+        seed_dataset(users=10, cars=100, favourites=0, seed=seed)
+    user_id = User.objects.order_by('id').values_list('id', flat=True).first()
+    token = start_session(user_id)
+    car_ids = list(Car.objects.order_by('id').values_list('id', flat=True)[:1000])
+    deadline = time.perf_counter() + seconds
+    lock = threading.Lock()
+    totals = {'writes': 0, 'reads': 0, 'lock_errors': 0, 'errors': 0}
+
+    def write(client, rng):
+        if rng.random() < 0.5:
+            ad = {'brand': 'Seat', 'model': 'Ibiza', 'year': 2015, 'price': 9000, 'description': 'Stress',
+                  'image_url': 'https://example.com/car.jpg', 'user_id': user_id}
+            return client.post('/ad_management/', ad, content_type='application/json')
+        return client.put('/favourite_management/', {'car_id': rng.choice(car_ids)},
+                          content_type='application/json', headers={'sessionToken': token})
+
+    def read(client, rng):
+        if rng.random() < 0.5:
+            return client.get('/get_ads/?limit=50&cursor=%d' % rng.choice(car_ids))
+        return client.get('/facets/')
+
+    def worker(kind, number):
+        client = Client()
+        rng = random.Random(seed * 1000 + number)
+        request = write if kind == 'writes' else read
+        counts = {kind: 0, 'lock_errors': 0, 'errors': 0}
+        try:
+            while time.perf_counter() < deadline:
+                try:
+                    response = request(client, rng)
+                except OperationalError as error:
+                    counts['lock_errors' if 'locked' in str(error) else 'errors'] += 1
+                    continue
+                counts[kind if response.status_code < 500 else 'errors'] += 1
+        finally:
+            connection.close()
+        with lock:
+            for name, count in counts.items():
+                totals[name] += count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=('writes', i)) for i in range(writers)]
+    threads += [threading.Thread(target=worker, args=('reads', writers + i)) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    totals['writes_per_second'] = totals['writes'] / elapsed
+    totals['reads_per_second'] = totals['reads'] / elapsed
+    return totals
+
+
+# Arranque y coste por peticion de cada perfil de settings (CarBuy.settings,
+# CarBuy.settings_api). Cada medida se hace en un proceso nuevo, porque
+# INSTALLED_APPS y MIDDLEWARE no se pueden cambiar despues de django.setup().
+# El proceso mide desde la primera linea hasta tener la aplicacion WSGI lista
+# (sin el arranque del interprete) y despues atiende requests peticiones a
+# search/cache_stats/, que no consulta la base de datos: su latencia es casi
+# toda la de la cadena de middleware y la resolucion de la URL.
+
+PROFILE_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+startup = time.perf_counter() - start
+modules = len(sys.modules)
+heavy = sorted(name for name in ('numpy', 'bcrypt', 'django.contrib.admin', 'django.template.backends.django')
+               if name in sys.modules)
+
+from django.test import RequestFactory
+environ = RequestFactory()._base_environ(PATH_INFO='/search/cache_stats/', REQUEST_METHOD='GET',
+                                         HTTP_HOST='localhost', SERVER_NAME='localhost')
+statuses = {}
+def start_response(status, headers):
+    statuses[status[:3]] = statuses.get(status[:3], 0) + 1
+latencies = []
+for _ in range(%d):
+    request_start = time.perf_counter()
+    response = application(dict(environ), start_response)
+    b''.join(response)
+    response.close()
+    latencies.append(time.perf_counter() - request_start)
+print(json.dumps({'startup': startup, 'modules': modules, 'heavy': heavy, 'latencies': latencies,
+                  'statuses': statuses}))
+"""
+
+
+def measure_profile(settings_module, runs=5, requests=2000):
+    # Devuelve la mediana del arranque en ms, los modulos cargados y la
+    # latencia por peticion (de la ultima ejecucion, sin las 100 primeras)
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module)
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', PROFILE_SCRIPT % requests], cwd=settings.BASE_DIR,
+                                env=env, capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output))
+    startups = sorted(sample['startup'] for sample in samples)
+    last = samples[-1]
+    latencies = sorted(last['latencies'][min(100, len(last['latencies']) // 2):])
+    return {
+        'startup_ms': startups[len(startups) // 2] * 1000,
+        'modules': last['modules'],
+        'heavy_modules': last['heavy'],
+        'request_us': sum(latencies) / len(latencies) * 1e6,
+        'p50_us': latencies[len(latencies) // 2] * 1e6,
+        'p99_us': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e6,
+        'statuses': last['statuses'],
+    }
@@ -0,0 +1,171 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+
+
+# Caches de resultados en memoria del proceso (LRU acotada en numero de
+# entradas y en bytes) o en el framework de cache de Django, para compartirla
+# entre procesos. Las claves de la cache de busquedas incluyen una version de
+# los datos, asi que las entradas antiguas se descartan solas; la de detalles
+# (details.py) borra cada entrada cuando cambia el anuncio o el vendedor.
+#
+# Las vistas asincronas usan aget y aset: la LRU no hace E/S y responde
+# directamente; el framework de Django usa su API asincrona (aget/aset) para
+# no bloquear el bucle de eventos con una cache de red.
+
+
+class LRUCache:
+    def __init__(self, max_entries, max_bytes=None, timeout=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Segundos de vida de cada entrada (None: hasta que se descarte)
+        self.timeout = timeout
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] is not None and entry[2] < time.monotonic():
+                del self._entries[key]
+                self.bytes -= entry[1]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size=0):
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            expires = time.monotonic() + self.timeout if self.timeout is not None else None
+            self._entries[key] = (value, size, expires)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, value, size=0):
+        self.set(key, value, size)
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DjangoCache:
+    # Adaptador sobre una cache de CACHES con la misma interfaz que LRUCache
+    def __init__(self, alias, timeout, prefix):
+        self.alias = alias
+        self.timeout = timeout
+        self.prefix = prefix
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        return self.cache.get(self.prefix + key)
+
+    def set(self, key, value, size=0):
+        self.cache.set(self.prefix + key, value, self.timeout)
+
+    async def aget(self, key):
+        return await self.cache.aget(self.prefix + key)
+
+    async def aset(self, key, value, size=0):
+        await self.cache.aset(self.prefix + key, value, self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(self.prefix + key)
+
+    def clear(self):
+        # Las entradas compartidas caducan solas por timeout
+        pass
+
+
+class ResultCache:
+    # Cache con contadores de aciertos y fallos. Se configura con un
+    # diccionario de settings: BACKEND ('locmem' o 'django'), MAX_ENTRIES,
+    # MAX_BYTES, CACHE_ALIAS y TIMEOUT (en 'locmem' solo si se indica).
+
+    def __init__(self, name, setting):
+        self.name = name
+        self.setting = setting
+        self.hits = 0
+        self.misses = 0
+        # Protege los contadores: += no es atomico entre hilos
+        self._stats_lock = threading.Lock()
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            config = getattr(settings, self.setting)
+            if config.get('BACKEND', 'locmem') == 'django':
+                self._backend = DjangoCache(config.get('CACHE_ALIAS', 'default'), config.get('TIMEOUT', 300),
+                                            'carbuy:%s:' % self.name)
+            else:
+                self._backend = LRUCache(config.get('MAX_ENTRIES', 1024), config.get('MAX_BYTES'),
+                                         config.get('TIMEOUT'))
+        return self._backend
+
+    def _count(self, value):
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def get(self, key):
+        return self._count(self.backend.get(key))
+
+    async def aget(self, key):
+        return self._count(await self.backend.aget(key))
+
+    def set(self, key, value, size=0):
+        self.backend.set(key, value, size)
+
+    async def aset(self, key, value, size=0):
+        await self.backend.aset(key, value, size)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def reset(self):
+        # Vacia la cache local y los contadores (se usa tambien al cambiar settings)
+        if self._backend is not None:
+            self._backend.clear()
+        self._backend = None
+        with self._stats_lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        backend = self.backend
+        with self._stats_lock:
+            stats = {'hits': self.hits, 'misses': self.misses}
+        if isinstance(backend, LRUCache):
+            stats.update(entries=len(backend), bytes=backend.bytes)
+        return stats
@@ -0,0 +1,113 @@
+from django.db.models import F
+from django.utils import timezone
+
+from .details import arequest_ad, request_ad
+from .models import CatalogState
+
+
+# Version del catalogo de anuncios. Cualquier alta, modificacion o baja de un
+# anuncio la incrementa (ver signals.py), asi que dos respuestas del listado
+# con la misma version son identicas. Los contadores de favoritos llevan su
+# propia version: un favorito no vacia la cache de busquedas ni obliga a
+# regenerar el indice de similares, que solo dependen de los anuncios. La
+# copia del listado completo (snapshot.py) incluye los contadores y depende de
+# las dos versiones.
+
+CATALOG_STATE_ID = 1
+
+STATE_FIELDS = ('version', 'updated_at', 'favourites_version', 'favourites_updated_at')
+
+
+def bump_catalog_version():
+    updated = CatalogState.objects.filter(id=CATALOG_STATE_ID).update(
+        version=F('version') + 1, updated_at=timezone.now()
+    )
+    if not updated:
+        CatalogState.objects.get_or_create(id=CATALOG_STATE_ID, defaults={'version': 1, 'updated_at': timezone.now()})
+
+
+def bump_favourites_version():
+    now = timezone.now()
+    updated = CatalogState.objects.filter(id=CATALOG_STATE_ID).update(
+        favourites_version=F('favourites_version') + 1, favourites_updated_at=now
+    )
+    if not updated:
+        CatalogState.objects.get_or_create(id=CATALOG_STATE_ID, defaults={
+            'updated_at': now, 'favourites_version': 1, 'favourites_updated_at': now
+        })
+
+
+def catalog_state():
+    # Devuelve (version, fecha de la ultima modificacion, version de los
+    # favoritos, fecha de su ultimo cambio)
+    state = CatalogState.objects.filter(id=CATALOG_STATE_ID).values_list(*STATE_FIELDS).first()
+    return state or (0, None, 0, None)
+
+
+async def acatalog_state():
+    state = await CatalogState.objects.filter(id=CATALOG_STATE_ID).values_list(*STATE_FIELDS).afirst()
+    return state or (0, None, 0, None)
+
+
+def _microseconds(moment):
+    return int(moment.timestamp() * 1000000)
+
+
+def request_catalog_state(request):
+    # Estado del catalogo leido una sola vez por peticion (lo usan tanto los
+    # validadores del ETag como la cache de busquedas)
+    if not hasattr(request, '_catalog_state'):
+        request._catalog_state = catalog_state()
+    return request._catalog_state
+
+
+async def arequest_catalog_state(request):
+    if not hasattr(request, '_catalog_state'):
+        request._catalog_state = await acatalog_state()
+    return request._catalog_state
+
+
+# Validadores para las respuestas condicionales (ver conditional.py). Cada
+# funcion devuelve (ETag, Last-Modified) o None si el recurso no existe.
+
+def _catalog_validators(state):
+    version, updated_at = state[:2]
+    return '"catalog-%d"' % version, updated_at
+
+
+def _listing_validators(state):
+    # Listados que incluyen favourite_count: cambian tambien con los favoritos
+    version, updated_at, favourites_version, favourites_updated_at = state
+    last_modified = max(filter(None, (updated_at, favourites_updated_at)), default=None)
+    return '"catalog-%d-%d"' % (version, favourites_version), last_modified
+
+
+def catalog_validators(request, *args, **kwargs):
+    return _catalog_validators(request_catalog_state(request))
+
+
+def listing_validators(request, *args, **kwargs):
+    return _listing_validators(request_catalog_state(request))
+
+
+async def alisting_validators(request, *args, **kwargs):
+    return _listing_validators(await arequest_catalog_state(request))
+
+
+def _ad_validators(position_id, ad):
+    if ad is None:
+        return None
+    car, seller = ad
+    car_updated_at, user_updated_at = car[-1], seller[-1]
+    etag = '"ad-%d-%d-%d"' % (position_id, _microseconds(car_updated_at), _microseconds(user_updated_at))
+    return etag, max(car_updated_at, user_updated_at)
+
+
+def ad_validators(request, position_id):
+    # El detalle incluye datos del vendedor, asi que tambien cuenta su fecha.
+    # Se leen de la cache de detalles (ver details.py).
+    return _ad_validators(position_id, request_ad(request, position_id))
+
+
+async def aad_validators(request, position_id):
+    return _ad_validators(position_id, await arequest_ad(request, position_id))
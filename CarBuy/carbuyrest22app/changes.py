@@ -0,0 +1,106 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, Max, Min, OuterRef
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .catalog import CATALOG_STATE_ID
+from .models import Car, CarChange, CatalogState
+from .serializers import AD_LIST_FIELDS
+
+
+# Registro de cambios para la sincronizacion incremental (sync/). Cada alta,
+# modificacion o baja de un anuncio, y cada cambio de su contador de
+# favoritos, añade una fila a CarChange en la misma transaccion (ver
+# signals.py); las bajas quedan como marcas (deleted). La migracion que crea
+# la tabla apunta todos los coches que ya existian, asi que since=0 devuelve
+# el catalogo completo y despues cada cliente solo descarga lo que cambia.
+#
+# El cursor es "<id de CarChange>.<changes_pruned_through al emitirlo>". Los
+# ids siguen el orden de los commits porque las filas se escriben despues de
+# bump_catalog_version o bump_favourites_version, que bloquean la fila de
+# CatalogState hasta el final de la transaccion. Los coches de cada pagina se leen en su estado actual.
+#
+# manage.py compact_changes borra las entradas que tienen un cambio posterior
+# del mismo coche, lo que no cambia el resultado de ningun cursor, y las bajas
+# de hace mas de TOMBSTONE_DAYS, apuntando la ultima en
+# CatalogState.changes_pruned_through. Si desde que se emitio un cursor se ha
+# borrado alguna baja posterior a el, el cliente puede no enterarse de esa
+# baja: recibe 410 y vuelve a empezar desde since=0. QuerySet.update() sobre
+# Car, como el de reconcile_favourite_counts, no queda registrado.
+
+
+def record_changes(car_ids, deleted=False):
+    now = timezone.now()
+    CarChange.objects.bulk_create([CarChange(car_id=car_id, deleted=deleted, created_at=now) for car_id in car_ids])
+
+
+def pruned_through():
+    state = CatalogState.objects.filter(id=CATALOG_STATE_ID).values_list('changes_pruned_through', flat=True).first()
+    return state or 0
+
+
+def parse_cursor(value):
+    # Devuelve (posicion, changes_pruned_through al emitirlo); "0" empieza desde
+    # el principio. Lanza ValueError si el cursor no es valido.
+    position, _, pruned = value.partition('.')
+    position, pruned = int(position), int(pruned or 0)
+    if position < 0 or pruned < 0:
+        raise ValueError('Invalid cursor')
+    return position, pruned
+
+
+def format_cursor(position, pruned):
+    return '%d.%d' % (position, pruned)
+
+
+def cursor_expired(position, issued_pruned, pruned):
+    # Una sincronizacion desde el principio nunca caduca
+    return position > 0 and pruned > max(position, issued_pruned)
+
+
+def changes_since(since, limit):
+    # Devuelve (filas de AD_LIST_FIELDS de los coches cambiados, ids borrados,
+    # nuevo cursor, si quedan mas cambios) para las limit entradas siguientes a since
+    entries = list(CarChange.objects.filter(id__gt=since).order_by('id').values_list('id', 'car_id', 'deleted')[:limit + 1])
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    # Un coche que cambia varias veces en la pagina cuenta una vez, con su ultimo estado
+    latest = {car_id: deleted for entry_id, car_id, deleted in entries}
+    changed = [car_id for car_id, deleted in latest.items() if not deleted]
+    rows = list(Car.objects.filter(id__in=changed).order_by('id').values_list(*AD_LIST_FIELDS)) if changed else []
+
+    # Los que ya no existen se borraron despues: su baja llega en otra pagina
+    found = {row[0] for row in rows}
+    deleted = sorted(car_id for car_id, deleted in latest.items() if deleted or car_id not in found)
+    cursor = entries[-1][0] if entries else since
+    return rows, deleted, cursor, has_more
+
+
+def compact_changes(tombstone_days=None, batch_size=10000):
+    # Recorre el registro por tramos de batch_size ids, cada uno en su propia
+    # transaccion para no bloquear a los escritores. Devuelve cuantas entradas
+    # se han borrado de cada tipo.
+    if tombstone_days is None:
+        tombstone_days = settings.CARBUY_SYNC['TOMBSTONE_DAYS']
+    cutoff = timezone.now() - timedelta(days=tombstone_days)
+    bounds = CarChange.objects.aggregate(first=Min('id'), last=Max('id'))
+    later = CarChange.objects.filter(car_id=OuterRef('car_id'), id__gt=OuterRef('id'))
+    removed = {'superseded': 0, 'tombstones': 0}
+    if bounds['first'] is None:
+        return removed
+
+    for start in range(bounds['first'], bounds['last'] + 1, batch_size):
+        with transaction.atomic():
+            entries = CarChange.objects.filter(id__gte=start, id__lt=start + batch_size)
+            removed['superseded'] += entries.filter(Exists(later)).delete()[0]
+            tombstones = entries.filter(deleted=True, created_at__lt=cutoff)
+            last_tombstone = tombstones.aggregate(last=Max('id'))['last']
+            if last_tombstone is not None:
+                removed['tombstones'] += tombstones.delete()[0]
+                CatalogState.objects.filter(id=CATALOG_STATE_ID).update(
+                    changes_pruned_through=Greatest(F('changes_pruned_through'), last_tombstone)
+                )
+    return removed
@@ -0,0 +1,60 @@
+from functools import wraps
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+
+# Peticiones condicionales (If-None-Match / If-Modified-Since). A diferencia de
+# django.views.decorators.http.condition, los validadores se obtienen con una
+# sola funcion (una sola consulta) y existe version para vistas asincronas.
+
+
+def _conditional_response(request, validators):
+    etag, last_modified = validators
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    return get_conditional_response(request, etag=etag, last_modified=timestamp)
+
+
+def _set_validators(response, validators):
+    etag, last_modified = validators
+    if response.status_code in (200, 304):
+        response.headers.setdefault('ETag', etag)
+        if last_modified:
+            response.headers.setdefault('Last-Modified', http_date(int(last_modified.timestamp())))
+    return response
+
+
+def conditional(load_validators):
+    # load_validators(request, *args, **kwargs) devuelve (etag, last_modified)
+    # o None si no se puede validar (por ejemplo si el recurso no existe)
+    def decorator(view):
+        @wraps(view)
+        def inner(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            validators = load_validators(request, *args, **kwargs)
+            if validators is None:
+                return view(request, *args, **kwargs)
+            response = _conditional_response(request, validators)
+            if response is None:
+                response = view(request, *args, **kwargs)
+            return _set_validators(response, validators)
+        return inner
+    return decorator
+
+
+def async_conditional(load_validators):
+    # Igual que conditional, para vistas y validadores asincronos
+    def decorator(view):
+        @wraps(view)
+        async def inner(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return await view(request, *args, **kwargs)
+            validators = await load_validators(request, *args, **kwargs)
+            if validators is None:
+                return await view(request, *args, **kwargs)
+            response = _conditional_response(request, validators)
+            if response is None:
+                response = await view(request, *args, **kwargs)
+            return _set_validators(response, validators)
+        return inner
+    return decorator
@@ -0,0 +1,173 @@
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import CarNeighbour, FavouriteCar, StaleNeighbours
+from .neighbours import in_chunks
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Calculo de los vecinos por favoritos en comun (ver neighbours.py), lo
+# ejecuta manage.py build_neighbours.
+
+
+def _ranges(starts, counts):
+    # Concatenacion de range(start, start + count) para cada par, sin bucles
+    ends = np.cumsum(counts)
+    offsets = np.repeat(starts - (ends - counts), counts)
+    return np.arange(ends[-1] if len(ends) else 0) + offsets
+
+
+def read_favourites(chunk_size):
+    # Devuelve (usuarios, coches) como arrays, leyendo la tabla por bloques
+    chunks = []
+    buffer = []
+    rows = FavouriteCar.objects.order_by().values_list('user_id', 'car_id').iterator(chunk_size=chunk_size)
+    for row in rows:
+        buffer.append(row)
+        if len(buffer) >= chunk_size:
+            chunks.append(np.array(buffer, dtype=np.int64))
+            buffer = []
+    if buffer:
+        chunks.append(np.array(buffer, dtype=np.int64))
+    pairs = np.concatenate(chunks) if chunks else np.zeros((0, 2), dtype=np.int64)
+    return pairs[:, 0], pairs[:, 1]
+
+
+class FavouriteMatrix:
+    def __init__(self, users, cars, max_user_favourites):
+        # Los ids se sustituyen por posiciones 0..n-1. Los usuarios con mas de
+        # max_user_favourites favoritos se descartan: aportan poca informacion
+        # y el numero de pares crece con el cuadrado de su lista.
+        user_ids, users = np.unique(users, return_inverse=True)
+        user_degree = np.bincount(users, minlength=len(user_ids))
+        keep = user_degree[users] <= max_user_favourites
+        self.car_ids, cars = np.unique(cars[keep], return_inverse=True)
+        users = users[keep]
+        self.favourites = len(users)
+
+        # CSR: coches de cada usuario
+        order = np.argsort(users, kind='stable')
+        self.user_cars = cars[order]
+        self.user_start = np.concatenate(([0], np.cumsum(np.bincount(users, minlength=len(user_ids)))))
+
+        # CSC: usuarios de cada coche
+        order = np.argsort(cars, kind='stable')
+        self.car_users = users[order]
+        self.car_degree = np.bincount(cars, minlength=len(self.car_ids))
+        self.car_start = np.concatenate(([0], np.cumsum(self.car_degree)))
+
+        # Pares (coche, otro coche) que genera cada coche: sirve para partir en lotes
+        user_degree = np.diff(self.user_start)
+        self.car_pairs = np.bincount(cars, weights=user_degree[users], minlength=len(self.car_ids)).astype(np.int64)
+
+    def positions(self, car_ids):
+        # Posiciones de los car_ids que tienen algun favorito
+        car_ids = np.asarray(car_ids, dtype=np.int64)
+        if not len(self.car_ids):
+            return np.zeros(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.car_ids, car_ids), len(self.car_ids) - 1)
+        return positions[self.car_ids[positions] == car_ids]
+
+    def co_favourited(self, positions):
+        # Coches que comparten al menos un usuario con alguno de positions
+        users = self.car_users[_ranges(self.car_start[positions], self.car_degree[positions])]
+        starts = self.user_start[users]
+        return np.unique(self.user_cars[_ranges(starts, self.user_start[users + 1] - starts)])
+
+    def batches(self, positions, max_pairs, max_cars):
+        batch = []
+        pairs = 0
+        for position, cost in zip(positions.tolist(), self.car_pairs[positions].tolist()):
+            if batch and (pairs + cost > max_pairs or len(batch) >= max_cars):
+                yield np.array(batch, dtype=np.int64)
+                batch = []
+                pairs = 0
+            batch.append(position)
+            pairs += cost
+        if batch:
+            yield np.array(batch, dtype=np.int64)
+
+    def neighbours(self, batch, top_n):
+        # Devuelve (coche, vecino, similitud) con los top_n vecinos de cada
+        # coche del lote, como arrays de ids
+        rows = np.repeat(np.arange(len(batch)), self.car_degree[batch])
+        users = self.car_users[_ranges(self.car_start[batch], self.car_degree[batch])]
+        starts = self.user_start[users]
+        counts = self.user_start[users + 1] - starts
+        rows = np.repeat(rows, counts)
+        others = self.user_cars[_ranges(starts, counts)]
+        different = others != batch[rows]
+        rows, others = rows[different], others[different]
+
+        # Usuarios en comun de cada par (fila del lote, otro coche)
+        keys, common = np.unique(rows * len(self.car_ids) + others, return_counts=True)
+        rows, others = np.divmod(keys, len(self.car_ids))
+        cars = batch[rows]
+        score = common / np.sqrt(self.car_degree[cars] * self.car_degree[others])
+
+        # Por coche, de mayor a menor similitud (empates: id menor primero)
+        order = np.lexsort((others, -score, rows))
+        rows, cars, others, score = rows[order], cars[order], others[order], score[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        keep = rank < top_n
+        return self.car_ids[cars[keep]], self.car_ids[others[keep]], score[keep]
+
+
+def _replace_neighbours(car_ids, rows):
+    # Sustituye los vecinos de car_ids en una transaccion: el endpoint ve la
+    # lista anterior o la nueva, nunca una a medias. Se inserta con
+    # executemany, sin instanciar modelos: son millones de filas.
+    table = connection.ops.quote_name(CarNeighbour._meta.db_table)
+    sql = 'INSERT INTO %s (car_id, neighbour_id, score) VALUES (%%s, %%s, %%s)' % table
+    with transaction.atomic():
+        for chunk in in_chunks(car_ids):
+            CarNeighbour.objects.filter(car_id__in=chunk).delete()
+        if rows:
+            with connection.cursor() as cursor:
+                cursor.executemany(sql, rows)
+
+
+def build_neighbours(changed_only=False):
+    # Recalcula los vecinos de todos los coches o, con changed_only, solo los
+    # afectados por StaleNeighbours. Devuelve un resumen para el comando.
+    config = settings.CARBUY_NEIGHBOURS
+    stale = list(StaleNeighbours.objects.order_by('id').values_list('id', 'car_id'))
+    last_stale = stale[-1][0] if stale else 0
+    stale_cars = [car_id for _, car_id in stale]
+
+    matrix = FavouriteMatrix(*read_favourites(config['CHUNK_SIZE']), config['MAX_USER_FAVOURITES'])
+
+    if changed_only:
+        # Los coches cambiados, los que comparten usuarios con ellos y los que
+        # los tenian como vecinos (quiza ya no compartan ningun usuario)
+        pointing = set()
+        for chunk in in_chunks(stale_cars):
+            pointing.update(CarNeighbour.objects.filter(neighbour_id__in=chunk).values_list('car_id', flat=True))
+        targets = np.union1d(matrix.co_favourited(matrix.positions(stale_cars)),
+                             matrix.positions(sorted(pointing)))
+        affected = sorted(set(stale_cars) | pointing)
+    else:
+        targets = np.arange(len(matrix.car_ids))
+        affected = list(CarNeighbour.objects.order_by().values_list('car_id', flat=True).distinct())
+
+    written = 0
+    for batch in matrix.batches(targets, config['MAX_BATCH_PAIRS'], config['MAX_BATCH_CARS']):
+        cars, neighbours, scores = matrix.neighbours(batch, config['TOP_N'])
+        _replace_neighbours(matrix.car_ids[batch].tolist(),
+                            list(zip(cars.tolist(), neighbours.tolist(), scores.tolist())))
+        written += len(cars)
+
+    # Coches afectados que ya no tienen favoritos: se quedan sin vecinos
+    computed = set(matrix.car_ids[targets].tolist())
+    _replace_neighbours([car_id for car_id in affected if car_id not in computed], [])
+
+    StaleNeighbours.objects.filter(id__lte=last_stale).delete()
+    return {
+        'favourites': matrix.favourites,
+        'cars': len(targets),
+        'neighbours': written,
+    }
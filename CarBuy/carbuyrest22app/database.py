@@ -0,0 +1,14 @@
+from django.conf import settings
+
+
+# Ajustes que se aplican a cada conexion nueva (ver signals.py). En SQLite el
+# modo WAL permite leer mientras otro escribe, y busy_timeout hace que un
+# escritor espere al anterior en lugar de fallar con "database is locked".
+
+
+def configure_connection(connection):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.CARBUY_SQLITE_PRAGMAS.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
@@ -0,0 +1,108 @@
+from .caching import ResultCache
+from .models import Car, User
+
+
+# Cache de lectura del detalle de anuncio (ad/<id>/). Se guardan por separado
+# las columnas del anuncio, por id de coche, y el nombre y telefono del
+# vendedor, por id de usuario, y la respuesta se monta al servirla: asi un
+# cambio en el vendedor no obliga a buscar todos sus anuncios. Un anuncio en
+# cache se sirve (incluido el ETag) sin consultar la base de datos.
+#
+# Las entradas se borran en los post_save y post_delete de Car y User (ver
+# signals.py). Con varios procesos hay que usar BACKEND 'django' con una
+# cache compartida; con 'locmem' los cambios hechos en otro proceso se ven al
+# caducar la entrada (TIMEOUT).
+
+ad_cache = ResultCache('ad', 'CARBUY_AD_CACHE')
+seller_cache = ResultCache('seller', 'CARBUY_SELLER_CACHE')
+
+CAR_FIELDS = ('brand', 'model', 'year', 'price', 'description', 'image_url', 'user_id', 'updated_at')
+SELLER_FIELDS = ('name', 'phone', 'updated_at')
+
+
+def _size(row):
+    # Tamaño aproximado de una fila, para el limite MAX_BYTES
+    return sum(len(str(value)) for value in row) + 64
+
+
+def _store_ad(car_id, row):
+    car = row[:len(CAR_FIELDS)]
+    seller = row[len(CAR_FIELDS):]
+    ad_cache.set(str(car_id), car, _size(car))
+    seller_cache.set(str(car[6]), seller, _size(seller))
+    return car, seller
+
+
+async def _astore_ad(car_id, row):
+    car = row[:len(CAR_FIELDS)]
+    seller = row[len(CAR_FIELDS):]
+    await ad_cache.aset(str(car_id), car, _size(car))
+    await seller_cache.aset(str(car[6]), seller, _size(seller))
+    return car, seller
+
+
+def _store_seller(user_id, seller):
+    seller_cache.set(str(user_id), seller, _size(seller))
+    return seller
+
+
+def _ad_query(car_id):
+    # Anuncio y vendedor en una sola consulta, cuando no esta el anuncio
+    return Car.objects.filter(id=car_id).values_list(*CAR_FIELDS, *('user__%s' % field for field in SELLER_FIELDS))
+
+
+def get_ad(car_id):
+    # Devuelve (columnas del anuncio, columnas del vendedor) o None si no existe
+    car = ad_cache.get(str(car_id))
+    if car is None:
+        row = _ad_query(car_id).first()
+        return _store_ad(car_id, row) if row is not None else None
+    seller = seller_cache.get(str(car[6]))
+    if seller is None:
+        seller = User.objects.filter(id=car[6]).values_list(*SELLER_FIELDS).first()
+        if seller is None:
+            return None
+        _store_seller(car[6], seller)
+    return car, seller
+
+
+async def aget_ad(car_id):
+    # Con BACKEND 'django' la cache es de red: aget y aset no bloquean el bucle de eventos
+    car = await ad_cache.aget(str(car_id))
+    if car is None:
+        row = await _ad_query(car_id).afirst()
+        return await _astore_ad(car_id, row) if row is not None else None
+    seller = await seller_cache.aget(str(car[6]))
+    if seller is None:
+        seller = await User.objects.filter(id=car[6]).values_list(*SELLER_FIELDS).afirst()
+        if seller is None:
+            return None
+        await seller_cache.aset(str(car[6]), seller, _size(seller))
+    return car, seller
+
+
+def request_ad(request, car_id):
+    # Anuncio leido una sola vez por peticion (validadores del ETag y vista)
+    if not hasattr(request, '_ad'):
+        request._ad = get_ad(car_id)
+    return request._ad
+
+
+async def arequest_ad(request, car_id):
+    if not hasattr(request, '_ad'):
+        request._ad = await aget_ad(car_id)
+    return request._ad
+
+
+def detail_row(ad):
+    # Fila con las columnas de serializers.AD_DETAIL_FIELDS
+    car, seller = ad
+    return car[:6] + seller[:2]
+
+
+def forget_ad(car_id):
+    ad_cache.delete(str(car_id))
+
+
+def forget_seller(user_id):
+    seller_cache.delete(str(user_id))
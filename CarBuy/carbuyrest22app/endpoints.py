@@ -1,9 +1,52 @@
 import json
-import bcrypt
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from .catalog import ad_validators, catalog_validators, listing_validators, request_catalog_state
+from .changes import changes_since, cursor_expired, format_cursor, parse_cursor, pruned_through
+from .conditional import conditional
+from .details import detail_row, request_ad
+from .export import EXPORT_FORMATS, accepts_encoding, export_chunks, gzip_chunks
+from .facets import facet_counts
+from .favourites import most_favourited as most_favourited_cars, parse_car_ids, update_favourites
+from .filters import filter_cars, parse_filters
+from .hashing import HashingBusy, check_password, hash_password, needs_rehash
+from .ingest import NDJSON_CONTENT_TYPES, ingest_ads
+from .instrumentation import metrics as request_metrics
 from .models import Car, FavouriteCar, User
-import secrets
+from .neighbours import neighbour_rows
+from .pagination import keyset_page, parse_page_params
+from .search import search_cache, search_cache_key, search_car_ids, search_entry_size
+from .serializers import (
+    AD_LIST_FIELDS, FAVOURITE_FIELDS, USER_FIELDS, JsonResponse, ad_detail_data, ad_list_row,
+    favourite_data, search_results, stream_json_array, user_data
+)
+from .snapshot import snapshot_response, snapshot_scheduler
+from .tokens import end_session, is_signed_token, revocations, session_user_id, start_session
+
+
+def busy_response():
+    # Respuesta rapida cuando el pool de bcrypt esta saturado
+    response = JsonResponse({"error": "Server busy, try again later"}, status=503)
+    response['Retry-After'] = str(settings.CARBUY_HASH_RETRY_AFTER)
+    return response
+
+
+def search_params(request):
+    # Lee la búsqueda (q) y la página solicitada (page, limit, empezando en 1).
+    # Lanza ValueError con el mensaje de error si falta o no es valido.
+    search_query = request.GET.get('q', None)
+    if not search_query:
+        raise ValueError('Search query missing')
+    try:
+        page = int(request.GET.get('page', 1))
+        limit = min(int(request.GET.get('limit', settings.CARBUY_PAGE_SIZE)), settings.CARBUY_MAX_PAGE_SIZE)
+    except ValueError:
+        raise ValueError('Invalid pagination parameters')
+    if page < 1 or limit < 1:
+        raise ValueError('Invalid pagination parameters')
+    return search_query, page, limit
 
 
 @csrf_exempt
@@ -39,8 +82,11 @@ def users(request):
         # Si el correo ya existe, devuelve un error
         return JsonResponse({"error": "Email already exists"}, status=400)
     
-    # Hashea y saltea la contraseña
-    salted_and_hashed_pass = bcrypt.hashpw(json_password.encode('utf8'), bcrypt.gensalt()).decode('utf8')
+    # Hashea y saltea la contraseña (en el pool de bcrypt; si esta saturado se rechaza)
+    try:
+        salted_and_hashed_pass = hash_password(json_password)
+    except HashingBusy:
+        return busy_response()
     # Crea un nuevo objeto de usuario con los datos proporcionados
     user_object = User(
         name=json_username,
@@ -69,24 +115,30 @@ def sessions(request):
             db_user = User.objects.get(email=json_email)
         except User.DoesNotExist: 
             return JsonResponse({"error": "User not in database"}, status=404) #Devuelve un error si el usario no se encuentra en la base de datos
-        if bcrypt.checkpw(json_password.encode('utf8'), db_user.encrypted_password.encode('utf8')): # Verifica la contraseña proporcionada con la contraseña almacenada en la base de datos usando bcrypt
-            pass
-        else:
+        try: # Verifica la contraseña proporcionada con la contraseña almacenada en la base de datos usando bcrypt
+            valid_password = check_password(json_password, db_user.encrypted_password)
+        except HashingBusy:
+            return busy_response()
+        if not valid_password:
             return JsonResponse({"error": "Invalid credentials"}, status=401)
+
+        if needs_rehash(db_user.encrypted_password): # Si ha cambiado el coste de bcrypt se vuelve a hashear la contraseña
+            try:
+                rehashed_password = hash_password(json_password)
+            except HashingBusy: # No es imprescindible, se hará en el próximo login
+                pass
+            else:
+                User.objects.filter(id=db_user.id).update(encrypted_password=rehashed_password)
         
-        random_token = secrets.token_hex(10) # Genera un token aleatorio para la sesión
-        db_user.token = random_token #Guardo el token de sesion en la base de datos
-        db_user.save()  #Guardo la sesion
-        return JsonResponse({"sessionToken": random_token}, status=200) # Devuelve una respuesta exitosa con el token generado
+        session_token = start_session(db_user.id) # Genera el token de la sesión (firmado, o aleatorio guardado en la base de datos)
+        return JsonResponse({"sessionToken": session_token}, status=200) # Devuelve una respuesta exitosa con el token generado
     
     elif request.method == 'DELETE': #Ejemplo: curl -X DELETE -H "sessionToken: 922aa6990578697f7afc" http://localhost:8000/sessions/
-        try:
-            header_token = request.headers.get("sessionToken", None) #Obtención del token de sesión del encabezado de la solicitud
-        except AttributeError: #Si hay error...
+        header_token = request.headers.get("sessionToken", None) #Obtención del token de sesión del encabezado de la solicitud
+        if not header_token:
             return JsonResponse({"error": "Body token missing"}, status=401)
-        session = User.objects.get(token=header_token) # Intenta obtener la sesión de usuario basada en el token alojada en la base de datos
-        session.token = None
-        session.save() #Se elimina
+        if not end_session(header_token): # Revoca el token firmado o lo borra de la base de datos
+            return JsonResponse({"error": "Invalid sessionToken"}, status=401)
         return JsonResponse({"message": "Session closed successfully"}, status=200)
     
 @csrf_exempt
@@ -110,21 +162,31 @@ def password(request):
         return JsonResponse({'error': 'Header token missing'}, status=401)  # curl -X POST -H "Content-Type: application/json" -d "{\"current_password\": \"Carmenchu10\", \"new_password\": \"CCarmenchu10\"}"  http://localhost:8000/password/
     
     # Obtener el usuario con el token de sesión proporcionado
+    user_id = session_user_id(sessionToken)
+    if user_id is None:
+        return JsonResponse({'error': 'Invalid sessionToken'}, status=401)
     try:
-        user = User.objects.get(token=sessionToken)
+        user = User.objects.only('id', 'encrypted_password').get(id=user_id)
     except User.DoesNotExist:
         return JsonResponse({'error': 'Invalid sessionToken'}, status=401)
 
-    # Verificar la contraseña actual
-    if not bcrypt.checkpw(current_password.encode('utf8'), user.encrypted_password.encode('utf8')):
-        return JsonResponse({'error': 'Invalid credentials'}, status=401)
+    try:
+        # Verificar la contraseña actual
+        if not check_password(current_password, user.encrypted_password):
+            return JsonResponse({'error': 'Invalid credentials'}, status=401)
 
-    # Generar el hash para la nueva contraseña
-    hashed_new_password = bcrypt.hashpw(new_password.encode('utf8'), bcrypt.gensalt()).decode('utf8')
+        # Generar el hash para la nueva contraseña
+        hashed_new_password = hash_password(new_password)
+    except HashingBusy:
+        return busy_response()
 
     # Actualizar la contraseña del usuario
-    user.encrypted_password = hashed_new_password
-    user.save()
+    User.objects.filter(id=user.id).update(encrypted_password=hashed_new_password)
+
+    # Con tokens firmados se revocan todas las sesiones abiertas y se devuelve una nueva
+    if is_signed_token(sessionToken):
+        revocations.revoke_user(user.id)
+        return JsonResponse({'message': 'Password changed succesfully', 'sessionToken': start_session(user.id)}, status=200)
 
     return JsonResponse({'message': 'Password changed succesfully'}, status=200)    # curl -X POST http://localhost:8000/password/ -H "Content-Type: application/json" -H "sessionToken: 51fde779db0a0b3e1bcd" -d '{"current_password": "1234", "new_password": "123456789"}'
 
@@ -137,80 +199,126 @@ def account(request):
         # Recuperamos token de la cabecera
         if not header_token:
             return JsonResponse({'error': 'Body token missing'}, status=401)
-        # Recupera la sesión del usuario correspondiente al token pasado en la bbdd
-        session = User.objects.get(token=header_token) 
+        # Recupera el usuario correspondiente al token pasado
+        user_id = session_user_id(header_token)
+        if user_id is None:
+            return JsonResponse({'error': 'Invalid sessionToken'}, status=401)
+        try:
+            session = User.objects.only('id', 'email').get(id=user_id)
+        except User.DoesNotExist:
+            return JsonResponse({'error': 'Invalid sessionToken'}, status=401)
         json_response = session.to_jsonAccount() 
         return JsonResponse(json_response, status=200)
     
 @csrf_exempt
+@conditional(listing_validators)
 def search_cars(request):
     if request.method == 'GET':
-        # Obtener el nombre de la marca de coche de los parámetros de la solicitud
-        search_query = request.GET.get('q', None)
-        
-        # Verificar si se proporcionó un nombre de marca de coche
-        if not search_query:
-            return JsonResponse({'error': 'Search query missing'}, status=400)
-        
-        # Realizar la búsqueda en la base de datos por el nombre de la marca de coche
-        cars = Car.objects.filter(brand__icontains=search_query) | Car.objects.filter(model__icontains=search_query)
-        
-        # Convertir los resultados a un formato JSON
-        results = []
-        for car in cars:
-            car_data = {
-                "car_id": car.id,
-                'brand': car.brand,
-                'model': car.model,
-                'year': car.year,
-                'price': str(car.price),
-                'description': car.description,
-                'image_url': car.image_url,
-                'user_id': car.user_id
-            }
-            results.append(car_data)
+        # Obtener la búsqueda y la página solicitada de los parámetros de la solicitud
+        try:
+            search_query, page, limit = search_params(request)
+        except ValueError as error:
+            return JsonResponse({'error': str(error)}, status=400)
+
+        # Busquedas repetidas se sirven desde la cache mientras no cambie el catalogo
+        version = request_catalog_state(request)[0]
+        cache_key = search_cache_key(version, search_query, page, limit)
+        cached = search_cache.get(cache_key)
+        if cached is not None:
+            car_ids, next_page = cached
+        else:
+            # Busca en el indice de texto completo (marca, modelo y descripcion).
+            # Se pide un resultado extra para saber si hay pagina siguiente.
+            car_ids = search_car_ids(search_query, (page - 1) * limit, limit + 1)
+            next_page = page + 1 if len(car_ids) > limit else None
+            car_ids = car_ids[:limit]
+            search_cache.set(cache_key, (car_ids, next_page), search_entry_size(car_ids))
+
+        # Recupera las filas de una vez (con los contadores de favoritos
+        # actuales) y las convierte a JSON en orden de relevancia
+        cars = Car.objects.filter(id__in=car_ids).values_list(*AD_LIST_FIELDS)
+        results = search_results(car_ids, cars)
         
         # Retornar los resultados como una respuesta JSON
-        return JsonResponse({'cars': results}, status=200)
+        return JsonResponse({'cars': results, 'next_page': next_page}, status=200)
     else:
         return JsonResponse({'error': 'Method not allowed'}, status=405)
 
+def search_cache_stats(request):
+    # http://localhost:8000/search/cache_stats/
+    if request.method == 'GET':
+        return JsonResponse(search_cache.stats(), status=200)
+    else:
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+
 @csrf_exempt
+@conditional(ad_validators)
 def ad_details(request, position_id):
     if request.method == 'GET':
-        try:
-            # Obtener el coche en la posición especificada
-            car = Car.objects.get(id=position_id)
-        except IndexError:
+        # Obtener el coche en la posición especificada junto con su vendedor
+        # (ya leido por los validadores, normalmente de la cache de detalles)
+        ad = request_ad(request, position_id)
+        if ad is None:
             return JsonResponse({"error": "Ad not found"}, status=404)
 
-        # Obtener el usuario asociado a este coche
-        user = car.user
-        
         # Crear la respuesta JSON
-        user_data = {
-            "name": user.name,
-            "phone": user.phone
-        }
-        
-        car_data = {
-            "brand": car.brand,
-            "model": car.model,
-            "year": car.year,
-            "price": car.price,
-            "description": car.description,
-            "image_url": car.image_url,
-            "user": user_data
-        }
+        car_data = ad_detail_data(detail_row(ad))
 
         return JsonResponse(car_data, status=200)
     
     else:
         return JsonResponse({"error": "Invalid request method"}, status=405)
     
+@conditional(listing_validators)
+def similar_cars(request, position_id):
+    # http://localhost:8000/ad/5/similar/?limit=10
+    if request.method == 'GET':
+        # Se importa aqui para no cargar numpy al arrancar (ver similar.py)
+        from .similar import similar_car_ids, similar_index
+        if similar_index is None:
+            return JsonResponse({"error": "Similar cars not available"}, status=503)
+        try:
+            limit = min(int(request.GET.get('limit', 10)), settings.CARBUY_MAX_PAGE_SIZE)
+        except ValueError:
+            return JsonResponse({"error": "Invalid limit"}, status=400)
+        if limit < 1:
+            return JsonResponse({"error": "Invalid limit"}, status=400)
+
+        # Vecinos mas cercanos en el indice en memoria, del mas al menos parecido
+        car_ids = similar_car_ids(position_id, limit, request_catalog_state(request)[0])
+        if car_ids is None:
+            return JsonResponse({"error": "Ad not found"}, status=404)
+
+        rows = {row[0]: row for row in Car.objects.filter(id__in=car_ids).values_list(*AD_LIST_FIELDS)}
+        cars_data = [ad_list_row(rows[car_id]) for car_id in car_ids if car_id in rows]
+        return JsonResponse({"cars": cars_data}, status=200)
+    else:
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+    
+def also_liked(request, position_id):
+    # http://localhost:8000/ad/5/also_liked/?limit=10
+    if request.method == 'GET':
+        try:
+            limit = min(int(request.GET.get('limit', 10)), settings.CARBUY_MAX_PAGE_SIZE)
+        except ValueError:
+            return JsonResponse({"error": "Invalid limit"}, status=400)
+        if limit < 1:
+            return JsonResponse({"error": "Invalid limit"}, status=400)
+
+        # Vecinos por favoritos en comun calculados por build_neighbours, en una consulta
+        rows = neighbour_rows(position_id, limit)
+        return JsonResponse({"cars": [ad_list_row(row) for row in rows]}, status=200)
+    else:
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+    
 @csrf_exempt
 def ad_management(request):
     # curl -X POST -H "Content-Type: application/json" -d '{"brand": "Volkswagen", "model": "Golf GTI", "year": 2006, "price": 9000, "description": "A good car to drive", "user_id": 1}' http://localhost:8000/ad_management/
+    # curl -X POST -H "Content-Type: application/x-ndjson" --data-binary @ads.ndjson http://localhost:8000/ad_management/
+    if request.method == 'POST' and request.content_type in NDJSON_CONTENT_TYPES:
+        # Alta masiva: un anuncio por linea, leido e insertado por lotes
+        return JsonResponse(ingest_ads(request), status=200)
+
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
@@ -236,16 +344,18 @@ def ad_management(request):
         except User.DoesNotExist:
             return JsonResponse({"error": "User not found"}, status=404)
         
-        # Agrega un nuevo objeto con los datos del anuncio creado
-        car = Car.objects.create(
-            brand=brand,
-            model=model,
-            year=year,
-            price=price,
-            description=description,
-            image_url=image_url,
-            user=user
-        )
+        # Agrega un nuevo objeto con los datos del anuncio creado. Las facetas y la
+        # version del catalogo se actualizan en la misma transaccion (signals.py).
+        with transaction.atomic():
+            car = Car.objects.create(
+                brand=brand,
+                model=model,
+                year=year,
+                price=price,
+                description=description,
+                image_url=image_url,
+                user=user
+            )
         
         return JsonResponse({"message": "Ad created successfully"}, status=201)
     
@@ -278,7 +388,8 @@ def ad_management(request):
         car.user_id = data.get("user_id", car.user_id)
         
         # Guarda los cambios en la base de datos
-        car.save()
+        with transaction.atomic():
+            car.save()
         
         return JsonResponse({"message": "Ad updated successfully"}, status=200)
     
@@ -302,7 +413,8 @@ def ad_management(request):
             return JsonResponse({"error": "Ad not found"}, status=404)
         
         # Elimina el anuncio
-        car.delete()
+        with transaction.atomic():
+            car.delete()
         
         return JsonResponse({"message": "Ad deleted successfully"}, status=200)
     
@@ -311,23 +423,34 @@ def ad_management(request):
     
 @csrf_exempt
 def favourite_management(request):
-    # curl -X PUT -H "Content-Type: application/json" -d '{"user_id": 2, "car_id": 5}' http://localhost:8000/favourite_management/
+    # curl -X PUT -H "Content-Type: application/json" -H "sessionToken: 922aa6990578697f7afc" -d '{"car_id": 5}' http://localhost:8000/favourite_management/
+    # curl -X PUT -H "Content-Type: application/json" -H "sessionToken: 922aa6990578697f7afc" -d '{"add": [5, 6], "remove": [7]}' http://localhost:8000/favourite_management/
     if request.method != 'PUT':
         return JsonResponse({'error': 'HTTP method not supported'}, status=405)
 
-    sessionToken = request.headers['sessionToken']
+    sessionToken = request.headers.get('sessionToken')
     if not sessionToken:
         return JsonResponse({'error': 'Missing sessionToken'}, status=400)
     
-    try:
-        user = User.objects.get(token=sessionToken)
-    except User.DoesNotExist:
+    user_id = session_user_id(sessionToken)
+    if user_id is None:
         return JsonResponse({'error': 'Invalid sessionToken'}, status=401)
 
     try:
         data = json.loads(request.body)
     except json.JSONDecodeError:
         return JsonResponse({"error": "Invalid JSON"}, status=400)
+    if not isinstance(data, dict):
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+
+    # Lote: {"add": [ids], "remove": [ids]} en una sola peticion
+    if 'add' in data or 'remove' in data:
+        try:
+            add = parse_car_ids(data.get('add', []))
+            remove = parse_car_ids(data.get('remove', []))
+        except ValueError as error:
+            return JsonResponse({"error": str(error)}, status=400)
+        return JsonResponse(update_favourites(user_id, add, remove), status=200)
 
     car_id = data.get('car_id')
     if not car_id:
@@ -335,23 +458,15 @@ def favourite_management(request):
 
     try:
         car_id = int(car_id)
-    except ValueError:
+    except (TypeError, ValueError):
         return JsonResponse({"error": "Invalid car_id"}, status=400)
 
-    try:
-        car_to_check = Car.objects.get(id=car_id)
-    except Car.DoesNotExist:
+    # Un solo coche: se añade como un lote de uno
+    result = update_favourites(user_id, add=[car_id])
+    if result['not_found']:
         return JsonResponse({"error": "Car not found"}, status=404)
-
-    # Verificar si el coche ya está en favoritos del usuario
-    existing_favorite = FavouriteCar.objects.filter(user=user, car=car_to_check).exists()
-
-    if existing_favorite:
+    if not result['added']:
         return JsonResponse({'success': False, 'message': 'Car is already in favourites'}, status=200)
-    
-    # Si no existe, agregarlo a favoritos
-    favorite_car = FavouriteCar(user=user, car=car_to_check)
-    favorite_car.save()
 
     return JsonResponse({'success': True, 'message': 'Car added to favourites'}, status=200)
     
@@ -360,64 +475,164 @@ def get_favourites(request):
     # curl -X GET http://localhost:8000/get_favourites/
     if request.method == 'GET':
 
-        sessionToken = request.headers['sessionToken']
+        sessionToken = request.headers.get('sessionToken')
 
-        try:
-            user = User.objects.get(token=sessionToken)
-        except User.DoesNotExist:
+        user_id = session_user_id(sessionToken)
+        if user_id is None:
             return JsonResponse({'error': 'Invalid sessionToken'}, status=401)
         
-        # Obtiene los favoritos
-        favourites = FavouriteCar.objects.filter(user=user)
-
-        # Lista para almacenar los datos de favoritos
-        favourites_data = []
-
-        # Itera sobre los favoritos y agrega los datos a la lista
-        for favourite in favourites:
-            favourite_info = {
-                "user_id": favourite.user.id,
-                "car_id": favourite.car.id,
-                "user_name": favourite.user.name,
-                "car_brand": favourite.car.brand,
-                "car_model": favourite.car.model,
-                "car_year": favourite.car.year,
-                "car_price": favourite.car.price,
-                "car_description": favourite.car.description,
-                "image_url": favourite.car.image_url
-            }
-            favourites_data.append(favourite_info)
+        # Obtiene los favoritos junto con los datos del coche y el nombre del usuario en una sola consulta
+        favourites = FavouriteCar.objects.filter(user_id=user_id).order_by('id').values_list(*FAVOURITE_FIELDS)
+
+        # Lista con los datos de cada favorito
+        favourites_data = [favourite_data(user_id, favourite) for favourite in favourites]
 
         # Retorna la lista de datos de favoritos en formato JSON
         return JsonResponse(favourites_data, status=200, safe=False)
     else:
         return JsonResponse({"error": "Invalid request method"}, status=405)
     
+@conditional(listing_validators)
 def get_ads(request):
     # http://localhost:8000/get_ads/
+    # http://localhost:8000/get_ads/?limit=50&cursor=120
+    if request.method == 'GET':
+        # Solo se leen las columnas del listado, sin instanciar modelos
+        cars = Car.objects.values_list(*AD_LIST_FIELDS)
+
+        # Con cursor o limit se devuelve una pagina, ordenada por id
+        if 'cursor' in request.GET or 'limit' in request.GET:
+            try:
+                cursor, limit = parse_page_params(request)
+            except ValueError:
+                return JsonResponse({"error": "Invalid pagination parameters"}, status=400)
+
+            rows, next_cursor = keyset_page(cars, cursor, limit)
+            cars_data = [ad_list_row(row) for row in rows]
+            return JsonResponse({"cars": cars_data, "next_cursor": next_cursor}, status=200)
+
+        # Sin parametros se devuelve el catalogo completo: la copia en disco de
+        # la version actual si existe (ver snapshot.py) y si no se pide otra
+        response = snapshot_response(request, request_catalog_state(request), listing_validators(request)[0])
+        if response is not None:
+            return response
+        snapshot_scheduler.schedule()
+
+        # Mientras tanto se escribe fila a fila mediante un iterador por bloques
+        # para no cargar toda la tabla en memoria
+        rows = cars.order_by('id').iterator(chunk_size=settings.CARBUY_STREAM_CHUNK_SIZE)
+        return StreamingHttpResponse(
+            stream_json_array(ad_list_row(row) for row in rows),
+            content_type='application/json'
+        )
+    else:
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+    
+def export_ads(request):
+    # http://localhost:8000/export/?format=csv&sellers=1
+    if request.method == 'GET':
+        format = request.GET.get('format', 'ndjson')
+        if format not in EXPORT_FORMATS:
+            return JsonResponse({"error": "Invalid format"}, status=400)
+        sellers = request.GET.get('sellers') in ('1', 'true')
+        # Los datos de contacto de los vendedores solo con sesion
+        if sellers and session_user_id(request.headers.get('sessionToken')) is None:
+            return JsonResponse({"error": "Invalid sessionToken"}, status=401)
+
+        # Todo el catalogo, escrito por lotes y comprimido al vuelo si el cliente lo admite
+        chunks = export_chunks(format, sellers)
+        gzip = accepts_encoding(request, 'gzip')
+        response = StreamingHttpResponse(gzip_chunks(chunks) if gzip else chunks,
+                                         content_type=EXPORT_FORMATS[format])
+        if gzip:
+            response['Content-Encoding'] = 'gzip'
+        response['Vary'] = 'Accept-Encoding'
+        response['Content-Disposition'] = 'attachment; filename="carbuy-ads.%s"' % format
+        return response
+    else:
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+    
+def sync_ads(request):
+    # http://localhost:8000/sync/?since=0&limit=500
     if request.method == 'GET':
-        # Obtiene todos los anuncios de coches
-        all_cars = Car.objects.all()
-
-        # Lista para almacenar los datos
-        cars_data = []
-
-        # Itera sobre los coches y agrega los datos a la lista
-        for car in all_cars:
-            car_info = {
-                "id": car.id,
-                "brand": car.brand,
-                "model": car.model,
-                "year": car.year,
-                "price": str(car.price),  # Convertir Decimal a String
-                "description": car.description,
-                "image_url": car.image_url,
-                "user_id": car.user_id
-            }
-            cars_data.append(car_info)
-
-        # Retorna la lista de datos en formato JSON
-        return JsonResponse(cars_data, safe=False)
+        try:
+            since, issued_pruned = parse_cursor(request.GET.get('since', '0'))
+            limit = min(int(request.GET.get('limit', settings.CARBUY_SYNC['PAGE_SIZE'])),
+                        settings.CARBUY_SYNC['MAX_PAGE_SIZE'])
+        except ValueError:
+            return JsonResponse({"error": "Invalid sync parameters"}, status=400)
+        if limit < 1:
+            return JsonResponse({"error": "Invalid sync parameters"}, status=400)
+
+        # Si se han compactado bajas posteriores al cursor hay que empezar de nuevo
+        pruned = pruned_through()
+        if cursor_expired(since, issued_pruned, pruned):
+            return JsonResponse({"error": "Cursor expired, sync again from since=0"}, status=410)
+
+        # Solo los anuncios cambiados y borrados despues del cursor (ver changes.py)
+        rows, deleted, position, has_more = changes_since(since, limit)
+        return JsonResponse({
+            "cars": [ad_list_row(row) for row in rows],
+            "deleted": deleted,
+            "cursor": format_cursor(position, pruned),
+            "has_more": has_more,
+        }, status=200)
+    else:
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+    
+def filter_ads(request):
+    # http://localhost:8000/filter_ads/?brand=Volkswagen&year_min=2005&price_max=10000&sort=price&page=1&limit=50
+    if request.method == 'GET':
+        # Lee los filtros, el orden y la pagina solicitada
+        try:
+            filters, sort = parse_filters(request.GET)
+            page = int(request.GET.get('page', 1))
+            limit = min(int(request.GET.get('limit', settings.CARBUY_PAGE_SIZE)), settings.CARBUY_MAX_PAGE_SIZE)
+        except ValueError as error:
+            return JsonResponse({"error": str(error)}, status=400)
+        if page < 1 or limit < 1:
+            return JsonResponse({"error": "Invalid pagination parameters"}, status=400)
+
+        # Se pide una fila extra para saber si hay pagina siguiente
+        offset = (page - 1) * limit
+        rows = list(filter_cars(filters, sort).values_list(*AD_LIST_FIELDS)[offset:offset + limit + 1])
+        next_page = page + 1 if len(rows) > limit else None
+
+        cars_data = [ad_list_row(row) for row in rows[:limit]]
+        return JsonResponse({"cars": cars_data, "next_page": next_page}, status=200)
+    else:
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+    
+@conditional(catalog_validators)
+def facets(request):
+    # http://localhost:8000/facets/
+    if request.method == 'GET':
+        # Recuentos por marca, año y tramo de precio, mantenidos en CarFacet
+        return JsonResponse(facet_counts(), status=200)
+    else:
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+    
+@conditional(listing_validators)
+def most_favourited(request):
+    # http://localhost:8000/most_favourited/?limit=10
+    if request.method == 'GET':
+        try:
+            limit = min(int(request.GET.get('limit', 10)), settings.CARBUY_MAX_PAGE_SIZE)
+        except ValueError:
+            return JsonResponse({"error": "Invalid limit"}, status=400)
+        if limit < 1:
+            return JsonResponse({"error": "Invalid limit"}, status=400)
+
+        # Los coches con mas favoritos, leidos del indice del contador
+        rows = most_favourited_cars(limit).values_list(*AD_LIST_FIELDS)
+        return JsonResponse({"cars": [ad_list_row(row) for row in rows]}, status=200)
+    else:
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+    
+def metrics(request):
+    # http://localhost:8000/metrics/ (formato de texto de Prometheus)
+    if request.method == 'GET':
+        return HttpResponse(request_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
     else:
         return JsonResponse({"error": "Invalid request method"}, status=405)
     
@@ -426,20 +641,14 @@ def get_user(request):
     # http://localhost:8000/get_user/
     if request.method == 'GET':
 
-        sessionToken = request.headers['sessionToken']
-        # Comprueba que el id pertenece a un usuario existente
-        try:
-            user = User.objects.get(token=sessionToken)
-        except User.DoesNotExist:
+        sessionToken = request.headers.get('sessionToken')
+        # Comprueba que el token pertenece a un usuario existente
+        user_id = session_user_id(sessionToken)
+        user = User.objects.filter(id=user_id).values_list(*USER_FIELDS).first() if user_id is not None else None
+        if user is None:
             return JsonResponse({"error": "User not found"}, status=404)
 
         # Carga todos los datos en un diccionario
-        user_info = {
-            "id": user.id,
-            "email": user.email,
-            "name": user.name,
-            "token": user.token
-        }
-        return JsonResponse(user_info, status=200)
+        return JsonResponse(user_data(user, sessionToken), status=200)
     else:
         return JsonResponse({"error": "Invalid request method"}, status=405)
\ No newline at end of file
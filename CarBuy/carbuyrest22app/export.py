@@ -0,0 +1,109 @@
+import csv
+import io
+import zlib
+from django.conf import settings
+
+from .models import Car
+from .serializers import AD_LIST_FIELDS, ad_list_row, dumps_lines
+
+
+# Exportacion del catalogo completo (export/ y manage.py export_ads) para
+# analitica y feeds de terceros. Las filas se leen con un iterador por bloques
+# (en PostgreSQL un cursor de servidor) de CHUNK_SIZE filas y se codifican de
+# BATCH_SIZE en BATCH_SIZE, asi que la memoria no depende del tamaño de la
+# tabla. Cada lote se codifica de una vez (csv.writer y orjson estan en C) y
+# la compresion gzip, opcional, usa un nivel bajo para no limitar el ritmo.
+# En el CSV, los textos que una hoja de calculo tomaria por formulas llevan
+# delante un apostrofo.
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+SELLER_FIELDS = ('user__name', 'user__phone')
+
+# Columnas de la exportacion (cabecera del CSV y claves de cada linea NDJSON)
+SELLER_COLUMNS = ('seller_name', 'seller_phone')
+
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def export_columns(sellers):
+    return AD_LIST_FIELDS + SELLER_COLUMNS if sellers else AD_LIST_FIELDS
+
+
+def export_rows(sellers):
+    fields = AD_LIST_FIELDS + SELLER_FIELDS if sellers else AD_LIST_FIELDS
+    return Car.objects.values_list(*fields).order_by('id').iterator(chunk_size=settings.CARBUY_EXPORT['CHUNK_SIZE'])
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _ndjson_data(row):
+    if len(row) == len(AD_LIST_FIELDS):
+        return ad_list_row(row)
+    data = ad_list_row(row[:len(AD_LIST_FIELDS)])
+    data['seller_name'], data['seller_phone'] = row[len(AD_LIST_FIELDS):]
+    return data
+
+
+def _encode_ndjson(batch):
+    return dumps_lines(map(_ndjson_data, batch))
+
+
+def _csv_cell(value):
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def _encode_csv(batch):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(map(_csv_cell, row) for row in batch)
+    return buffer.getvalue().encode('utf8')
+
+
+def export_chunks(format, sellers=False):
+    # Genera la exportacion en fragmentos de bytes, uno por lote de filas
+    encode = _encode_ndjson if format == 'ndjson' else _encode_csv
+    if format == 'csv':
+        yield _encode_csv([export_columns(sellers)])
+    for batch in _batches(export_rows(sellers), settings.CARBUY_EXPORT['BATCH_SIZE']):
+        yield encode(batch)
+
+
+def gzip_chunks(chunks, level=None):
+    # Comprime un flujo de fragmentos en formato gzip sin acumularlo
+    if level is None:
+        level = settings.CARBUY_EXPORT['GZIP_LEVEL']
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def accepts_encoding(request, encoding):
+    # Comprueba si Accept-Encoding admite encoding (se ignoran las que llevan q=0)
+    for value in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = value.partition(';')
+        if name.strip().lower() in (encoding, '*'):
+            quality = params.strip().replace(' ', '')
+            if not quality.startswith('q='):
+                return True
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+    return False
@@ -0,0 +1,104 @@
+import math
+from collections import Counter
+from decimal import Decimal
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, FloatField
+from django.db.models.functions import Cast, Floor
+
+from .models import Car, CarFacet
+
+
+# Recuentos por marca, por año y por tramo de precio, guardados en CarFacet.
+# Cada alta, modificacion o baja de un anuncio suma o resta 1 a las filas
+# afectadas (ver signals.py), asi que consultar las facetas nunca recorre Car.
+# Las escrituras que no envian señales (QuerySet.update) requieren ejecutar
+# manage.py rebuild_facets.
+
+BRAND = 'brand'
+YEAR = 'year'
+PRICE = 'price'
+
+
+def price_bucket(price):
+    # Limite inferior del tramo de precio. Redondea hacia abajo como Floor en
+    # compute_facets (// de Decimal trunca hacia cero con precios negativos)
+    width = settings.CARBUY_PRICE_BUCKET
+    return math.floor(Decimal(str(price)) / width) * width
+
+
+def facet_keys(brand, year, price):
+    return [(BRAND, brand), (YEAR, str(int(year))), (PRICE, str(price_bucket(price)))]
+
+
+def car_deltas(deltas, brand, year, price, delta):
+    for key in facet_keys(brand, year, price):
+        deltas[key] += delta
+    return deltas
+
+
+def apply_deltas(deltas):
+    # Aplica los incrementos con F() para no perder actualizaciones concurrentes
+    for (kind, key), delta in deltas.items():
+        if not delta:
+            continue
+        if CarFacet.objects.filter(kind=kind, key=key).update(count=F('count') + delta):
+            continue
+        try:
+            with transaction.atomic():
+                CarFacet.objects.create(kind=kind, key=key, count=delta)
+        except IntegrityError:
+            # Otro proceso ha creado la fila mientras tanto
+            CarFacet.objects.filter(kind=kind, key=key).update(count=F('count') + delta)
+
+
+def facet_counts():
+    # Devuelve las facetas para el endpoint, sin las filas que han quedado a 0
+    facets = {BRAND: [], YEAR: [], PRICE: []}
+    for kind, key, count in CarFacet.objects.filter(count__gt=0).values_list('kind', 'key', 'count'):
+        facets[kind].append((key, count))
+
+    width = settings.CARBUY_PRICE_BUCKET
+    prices = sorted((int(key), count) for key, count in facets[PRICE])
+    return {
+        'brands': [{'brand': brand, 'count': count}
+                   for brand, count in sorted(facets[BRAND], key=lambda item: (-item[1], item[0]))],
+        'years': [{'year': int(year), 'count': count}
+                  for year, count in sorted(facets[YEAR], key=lambda item: -int(item[0]))],
+        'prices': [{'min': low, 'max': low + width, 'count': count} for low, count in prices],
+    }
+
+
+def compute_facets(car_model=Car):
+    # Recuento completo con GROUP BY sobre Car, para reconstruir o verificar
+    cars = car_model.objects.order_by()
+    counts = Counter()
+    for row in cars.values('brand').annotate(count=Count('id')):
+        counts[(BRAND, row['brand'])] = row['count']
+    for row in cars.values('year').annotate(count=Count('id')):
+        counts[(YEAR, str(row['year']))] = row['count']
+    width = settings.CARBUY_PRICE_BUCKET
+    # SQLite guarda los precios sin decimales como enteros y los dividiria con
+    # division entera, que tambien trunca hacia cero
+    for row in cars.annotate(bucket=Floor(Cast(F('price'), FloatField()) / width)).values('bucket').annotate(count=Count('id')):
+        counts[(PRICE, str(int(row['bucket']) * width))] += row['count']
+    return counts
+
+
+def stored_facets(facet_model=CarFacet):
+    return Counter({
+        (kind, key): count
+        for kind, key, count in facet_model.objects.filter(count__gt=0).values_list('kind', 'key', 'count')
+    })
+
+
+def rebuild_facets(car_model=Car, facet_model=CarFacet):
+    # Sustituye la tabla por un recuento completo. Tambien la usa la migracion
+    # que crea CarFacet, con los modelos historicos.
+    with transaction.atomic():
+        counts = compute_facets(car_model)
+        facet_model.objects.all().delete()
+        facet_model.objects.bulk_create(
+            facet_model(kind=kind, key=key, count=count) for (kind, key), count in counts.items()
+        )
+    return counts
@@ -0,0 +1,94 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import Car, FavouriteCar, User
+from .signals import favourites_changed
+
+
+# Altas y bajas de favoritos por lotes. La restriccion unica (user, car) de
+# FavouriteCar impide los duplicados aunque dos peticiones añadan el mismo
+# coche a la vez, asi que no hace falta comprobar antes de insertar.
+#
+# Car.favourite_count guarda cuantos usuarios tienen cada coche en favoritos.
+# Se actualiza con F() en la misma transaccion que el alta o la baja; los
+# favoritos que desaparecen al borrar un usuario se restan antes (ver
+# signals.py). Cualquier otra escritura sobre FavouriteCar deja el contador
+# desfasado hasta ejecutar manage.py reconcile_favourite_counts.
+
+
+def parse_car_ids(value):
+    # Lista de ids de coche del cuerpo de la peticion. Lanza ValueError si no
+    # es una lista de enteros o supera CARBUY_MAX_FAVOURITES_BATCH.
+    if not isinstance(value, list):
+        raise ValueError('Invalid car_id list')
+    if len(value) > settings.CARBUY_MAX_FAVOURITES_BATCH:
+        raise ValueError('Too many car_ids (max %d)' % settings.CARBUY_MAX_FAVOURITES_BATCH)
+    try:
+        return [int(car_id) for car_id in value]
+    except (TypeError, ValueError):
+        raise ValueError('Invalid car_id')
+
+
+def update_favourites(user_id, add=(), remove=()):
+    # Añade y quita favoritos con un numero fijo de consultas, sea cual sea el
+    # tamaño de las listas. Devuelve los ids añadidos, los quitados y los que
+    # no corresponden a ningun coche.
+    add = list(dict.fromkeys(add))
+    adding = set(add)
+    remove = [car_id for car_id in dict.fromkeys(remove) if car_id not in adding]
+
+    existing_cars = set(Car.objects.filter(id__in=add).values_list('id', flat=True)) if add else set()
+    if not existing_cars and not remove:
+        return {'added': [], 'removed': [], 'not_found': add}
+
+    with transaction.atomic():
+        # Bloquea al usuario (en PostgreSQL; SQLite ya serializa las transacciones
+        # de escritura) para que dos lotes simultaneos no cuenten el mismo cambio
+        list(User.objects.select_for_update().filter(id=user_id).values_list('id'))
+        current = set(
+            FavouriteCar.objects.filter(user_id=user_id, car_id__in=add + remove).values_list('car_id', flat=True)
+        )
+        added = [car_id for car_id in add if car_id in existing_cars and car_id not in current]
+        removed = [car_id for car_id in remove if car_id in current]
+
+        if added:
+            FavouriteCar.objects.bulk_create(
+                [FavouriteCar(user_id=user_id, car_id=car_id) for car_id in added], ignore_conflicts=True
+            )
+            adjust_favourite_counts(added, 1)
+        if removed:
+            FavouriteCar.objects.filter(user_id=user_id, car_id__in=removed).delete()
+            adjust_favourite_counts(removed, -1)
+        if added or removed:
+            favourites_changed.send(sender=FavouriteCar, user_id=user_id, added=added, removed=removed)
+
+    return {
+        'added': added,
+        'removed': removed,
+        'not_found': [car_id for car_id in add if car_id not in existing_cars],
+    }
+
+
+def adjust_favourite_counts(car_ids, delta):
+    # car_ids puede ser una lista o una subconsulta de ids. Un contador
+    # desfasado nunca baja de 0 (la columna no admite negativos).
+    return Car.objects.filter(id__in=car_ids).update(favourite_count=Greatest(F('favourite_count') + delta, Value(0)))
+
+
+def most_favourited(limit):
+    # Recorre el indice car_favourite_count_idx y se detiene en limit filas
+    return Car.objects.filter(favourite_count__gt=0).order_by('-favourite_count', 'id')[:limit]
+
+
+def reconcile_favourite_counts(car_model=Car, favourite_model=FavouriteCar, dry_run=False):
+    # Recalcula todos los contadores con una sola sentencia UPDATE que solo
+    # escribe los coches desfasados, y devuelve cuantos eran. Tambien la usa
+    # la migracion que crea el campo, con los modelos historicos.
+    favourites = favourite_model.objects.filter(car_id=OuterRef('pk')).order_by().values('car_id')
+    actual = Coalesce(Subquery(favourites.annotate(count=Count('*')).values('count')), Value(0))
+    drifted = car_model.objects.alias(actual=actual).exclude(favourite_count=F('actual'))
+    if dry_run:
+        return drifted.count()
+    return drifted.update(favourite_count=actual)
@@ -0,0 +1,74 @@
+from decimal import Decimal, InvalidOperation
+
+from .models import Car
+
+
+# Filtros y ordenaciones admitidos por el listado filtrado. Cada combinacion
+# tiene un indice compuesto en Car (ver Car.Meta.indexes) para que la consulta
+# sea un recorrido por rango de indice y no de toda la tabla.
+
+SORT_ORDERS = {
+    'newest': ('-id',),
+    'oldest': ('id',),
+    'price': ('price', 'id'),
+    '-price': ('-price', '-id'),
+    'year': ('year', 'id'),
+    '-year': ('-year', '-id'),
+}
+
+DEFAULT_SORT = 'newest'
+
+
+def _integer(params, name):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('Invalid %s' % name)
+
+
+def _decimal(params, name):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise ValueError('Invalid %s' % name)
+
+
+def parse_filters(params):
+    # Lee los filtros de la query string. Lanza ValueError con el mensaje de
+    # error si alguno no es valido.
+    filters = {
+        'brand': params.get('brand') or None,
+        'model': params.get('model') or None,
+        'year_min': _integer(params, 'year_min'),
+        'year_max': _integer(params, 'year_max'),
+        'price_min': _decimal(params, 'price_min'),
+        'price_max': _decimal(params, 'price_max'),
+    }
+    sort = params.get('sort') or DEFAULT_SORT
+    if sort not in SORT_ORDERS:
+        raise ValueError('Invalid sort, expected one of: %s' % ', '.join(SORT_ORDERS))
+    return filters, sort
+
+
+def filter_cars(filters, sort):
+    # Construye la consulta sobre Car para los filtros y el orden indicados
+    conditions = {}
+    if filters.get('brand') is not None:
+        conditions['brand'] = filters['brand']
+    if filters.get('model') is not None:
+        conditions['model'] = filters['model']
+    if filters.get('year_min') is not None:
+        conditions['year__gte'] = filters['year_min']
+    if filters.get('year_max') is not None:
+        conditions['year__lte'] = filters['year_max']
+    if filters.get('price_min') is not None:
+        conditions['price__gte'] = filters['price_min']
+    if filters.get('price_max') is not None:
+        conditions['price__lte'] = filters['price_max']
+    return Car.objects.filter(**conditions).order_by(*SORT_ORDERS[sort])
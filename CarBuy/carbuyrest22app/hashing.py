@@ -0,0 +1,78 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from django.conf import settings
+
+from .instrumentation import timed
+
+
+# Las operaciones de bcrypt tardan cientos de milisegundos. Se ejecutan en un
+# pool de hilos acotado (bcrypt libera el GIL) con un numero maximo de
+# peticiones en espera, CARBUY_HASH_QUEUE_DEPTH. Por defecto es 0, sin cola:
+# solo se admite una peticion si hay un hilo libre, asi que espera unicamente
+# a su propio hash. Si el pool esta lleno se rechaza al momento en lugar de
+# dejar al worker bloqueado detras de otros hashes.
+
+class HashingBusy(Exception):
+    pass
+
+
+class HashingPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+
+    def _start(self):
+        with self._lock:
+            if self._executor is None:
+                workers = settings.CARBUY_HASH_WORKERS
+                self._slots = threading.BoundedSemaphore(workers + settings.CARBUY_HASH_QUEUE_DEPTH)
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+
+    def run(self, function, *args):
+        if self._executor is None:
+            self._start()
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        try:
+            with timed('hash'):
+                return future.result(timeout=settings.CARBUY_HASH_TIMEOUT)
+        except TimeoutError:
+            raise HashingBusy()
+
+
+pool = HashingPool()
+
+
+# bcrypt se importa con el primer hash y no al arrancar el worker
+
+def _hash(password):
+    import bcrypt
+    return bcrypt.hashpw(password.encode('utf8'), bcrypt.gensalt(settings.CARBUY_BCRYPT_ROUNDS)).decode('utf8')
+
+
+def _check(password, hashed):
+    import bcrypt
+    return bcrypt.checkpw(password.encode('utf8'), hashed.encode('utf8'))
+
+
+def hash_password(password):
+    return pool.run(_hash, password)
+
+
+def check_password(password, hashed):
+    return pool.run(_check, password, hashed)
+
+
+def needs_rehash(hashed):
+    # Formato de bcrypt: $2b$<coste>$<sal y hash>
+    try:
+        return int(hashed.split('$')[2]) != settings.CARBUY_BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
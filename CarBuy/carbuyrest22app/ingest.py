@@ -0,0 +1,141 @@
+import json
+from decimal import Decimal, InvalidOperation
+from django.conf import settings
+from django.db import transaction
+
+from .models import Car, User
+from .signals import cars_bulk_created
+
+
+# Alta masiva de anuncios a partir de un cuerpo NDJSON (un anuncio JSON por
+# linea). El cuerpo se lee linea a linea y se inserta por lotes, asi que la
+# memoria usada no depende del tamaño de la subida.
+
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson')
+
+# Car.price admite 10 digitos con 2 decimales
+MAX_PRICE = Decimal('1e8')
+
+AD_FIELDS = ('brand', 'model', 'year', 'price', 'description', 'image_url', 'user_id')
+
+TEXT_FIELDS = ('brand', 'model', 'description', 'image_url')
+
+# Limite de PositiveIntegerField y de los ids en todas las bases de datos
+MAX_INTEGER = 2 ** 31 - 1
+
+
+def parse_integer(value):
+    # Solo enteros JSON o cadenas de digitos: int() aceptaria tambien True,
+    # 2.5 o " 7 "
+    if isinstance(value, int) and not isinstance(value, bool):
+        number = value
+    elif isinstance(value, str) and value.isascii() and value.isdigit():
+        number = int(value)
+    else:
+        raise ValueError
+    if not 0 <= number <= MAX_INTEGER:
+        raise ValueError
+    return number
+
+
+def parse_ad(line):
+    # Valida una linea y devuelve los datos del anuncio. Lanza ValueError con
+    # el mensaje de error si la linea no es valida.
+    try:
+        data = json.loads(line)
+    except json.JSONDecodeError:
+        raise ValueError('Invalid JSON')
+    if not isinstance(data, dict):
+        raise ValueError('Invalid JSON')
+    if not all(data.get(field) for field in AD_FIELDS):
+        raise ValueError('All fields are required')
+    for field in TEXT_FIELDS:
+        max_length = Car._meta.get_field(field).max_length
+        if not isinstance(data[field], str) or (max_length and len(data[field]) > max_length):
+            raise ValueError('Invalid %s' % field)
+    try:
+        year = parse_integer(data['year'])
+        user_id = parse_integer(data['user_id'])
+    except ValueError:
+        raise ValueError('Invalid year or user_id')
+    try:
+        price = Decimal(str(data['price']))
+    except InvalidOperation:
+        raise ValueError('Invalid price')
+    if not price.is_finite() or price < 0 or price >= MAX_PRICE:
+        raise ValueError('Invalid price')
+    return {
+        'brand': data['brand'],
+        'model': data['model'],
+        'year': year,
+        'price': price,
+        'description': data['description'],
+        'image_url': data['image_url'],
+        'user_id': user_id,
+    }
+
+
+class AdIngestion:
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or settings.CARBUY_BULK_BATCH_SIZE
+        self.known_users = set()
+        self.pending = []
+        self.results = []
+        self.created = 0
+        self.failed = 0
+
+    def add_line(self, number, line):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            self.pending.append((number, parse_ad(line)))
+        except ValueError as error:
+            self.fail(number, str(error))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def fail(self, number, error):
+        self.failed += 1
+        self.results.append({'line': number, 'error': error})
+
+    def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+
+        # Comprueba de una vez los usuarios que aun no se han visto
+        unknown = {data['user_id'] for number, data in batch} - self.known_users
+        if unknown:
+            self.known_users.update(User.objects.filter(id__in=unknown).values_list('id', flat=True))
+
+        lines = []
+        cars = []
+        for number, data in batch:
+            if data['user_id'] not in self.known_users:
+                self.fail(number, 'User not found')
+                continue
+            lines.append(number)
+            cars.append(Car(**data))
+
+        with transaction.atomic():
+            cars = Car.objects.bulk_create(cars)
+            cars_bulk_created.send(sender=Car, cars=cars)
+
+        self.created += len(cars)
+        for number, car in zip(lines, cars):
+            self.results.append({'line': number, 'id': car.id})
+
+    def report(self):
+        self.flush()
+        self.results.sort(key=lambda result: result['line'])
+        return {'created': self.created, 'failed': self.failed, 'results': self.results}
+
+
+def ingest_ads(lines, batch_size=None):
+    # Inserta los anuncios de un iterador de lineas NDJSON y devuelve el
+    # resultado de cada linea (id del anuncio creado o error)
+    ingestion = AdIngestion(batch_size)
+    for number, line in enumerate(lines, start=1):
+        ingestion.add_line(number, line)
+    return ingestion.report()
@@ -0,0 +1,213 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+
+# Medicion de cada peticion: numero de consultas y tiempo en base de datos,
+# en bcrypt, serializando JSON y en el resto de la vista. Se envia en la
+# cabecera Server-Timing y se acumula por ruta en histogramas que se exponen
+# en /metrics/ con el formato de texto de Prometheus. Cada proceso tiene sus
+# propios histogramas.
+#
+# Los tiempos de la peticion en curso viven en una ContextVar, que tambien se
+# propaga a los hilos de sync_to_async, asi que funciona igual con vistas
+# asincronas. El cuerpo de las respuestas en streaming se genera despues de
+# enviar las cabeceras y no se cuenta.
+
+class RequestTimings:
+    __slots__ = ('queries', 'db', 'hash', 'serialize')
+
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.hash = 0.0
+        self.serialize = 0.0
+
+
+_current = ContextVar('carbuy_request_timings', default=None)
+
+
+@contextmanager
+def timed(name):
+    # Suma la duracion del bloque al tiempo name de la peticion en curso
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        setattr(timings, name, getattr(timings, name) + time.perf_counter() - start)
+
+
+def record_query(execute, sql, params, many, context):
+    # Execute wrapper instalado en todas las conexiones (ver install_query_timer)
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.queries += 1
+        timings.db += time.perf_counter() - start
+
+
+def install_query_timer(connection):
+    # Va el primero de la lista: connection.execute_wrapper() quita el ultimo al
+    # salir y no debe llevarse este si la conexion se abrio dentro del bloque
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_query)
+
+
+# Limites superiores de los buckets (segundos y numero de consultas)
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+HISTOGRAMS = (
+    ('carbuy_request_duration_seconds', 'Time spent handling the request', DURATION_BUCKETS),
+    ('carbuy_db_duration_seconds', 'Time spent executing database queries', DURATION_BUCKETS),
+    ('carbuy_hash_duration_seconds', 'Time spent waiting for bcrypt', DURATION_BUCKETS),
+    ('carbuy_serialize_duration_seconds', 'Time spent encoding JSON responses', DURATION_BUCKETS),
+    ('carbuy_view_duration_seconds', 'Request time not spent in the database, bcrypt or JSON encoding',
+     DURATION_BUCKETS),
+    ('carbuy_db_queries', 'Database queries per request', QUERY_BUCKETS),
+)
+
+
+# Metodos con etiqueta propia; el resto se agrupa en OTHER
+METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'))
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Un contador por bucket mas el de +Inf; se acumulan al exportar
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+def _labels(route, method, **extra):
+    labels = dict(route=route, method=method, **extra)
+    return ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # {(route, method): [Histogram por cada entrada de HISTOGRAMS]}
+            self.histograms = {}
+            # {(route, method, status): peticiones}
+            self.responses = {}
+
+    def observe(self, route, method, status, timings, total):
+        if method not in METHODS:
+            method = 'OTHER'
+        view = max(total - timings.db - timings.hash - timings.serialize, 0.0)
+        values = (total, timings.db, timings.hash, timings.serialize, view, timings.queries)
+        with self._lock:
+            histograms = self.histograms.get((route, method))
+            if histograms is None:
+                histograms = self.histograms[(route, method)] = [Histogram(buckets) for _, _, buckets in HISTOGRAMS]
+            for histogram, value in zip(histograms, values):
+                histogram.observe(value)
+            key = (route, method, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+    def render(self):
+        # Formato de texto de Prometheus (version 0.0.4)
+        with self._lock:
+            histograms = {key: [(list(h.counts), h.sum) for h in values] for key, values in self.histograms.items()}
+            responses = dict(self.responses)
+
+        lines = [
+            '# HELP carbuy_responses_total Responses by route, method and status code',
+            '# TYPE carbuy_responses_total counter',
+        ]
+        for (route, method, status), count in sorted(responses.items()):
+            lines.append('carbuy_responses_total{%s} %d' % (_labels(route, method, status=status), count))
+
+        for index, (name, help_text, buckets) in enumerate(HISTOGRAMS):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s histogram' % name)
+            for (route, method), values in sorted(histograms.items()):
+                counts, total = values[index]
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('%s_bucket{%s} %d' % (name, _labels(route, method, le=bound), cumulative))
+                lines.append('%s_sum{%s} %r' % (name, _labels(route, method), total))
+                lines.append('%s_count{%s} %d' % (name, _labels(route, method), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def server_timing(timings, total):
+    view = max(total - timings.db - timings.hash - timings.serialize, 0.0)
+    return 'db;dur=%.3f;desc="%d queries", hash;dur=%.3f, serialize;dur=%.3f, view;dur=%.3f, total;dur=%.3f' % (
+        timings.db * 1000, timings.queries, timings.hash * 1000, timings.serialize * 1000, view * 1000, total * 1000
+    )
+
+
+class MetricsMiddleware:
+    # Debe ir el primero de MIDDLEWARE para medir tambien el resto de middlewares.
+    # Admite peticiones sincronas y asincronas sin adaptar la cadena.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, timings, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, timings, time.perf_counter() - start)
+
+    def finish(self, request, response, timings, total):
+        # Las peticiones que no coinciden con ninguna ruta se agrupan juntas
+        match = request.resolver_match
+        route = match.route if match is not None else ''
+        metrics.observe(route, request.method, response.status_code, timings, total)
+        if settings.CARBUY_SERVER_TIMING:
+            response['Server-Timing'] = server_timing(timings, total)
+        return response
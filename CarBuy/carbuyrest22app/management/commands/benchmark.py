@@ -0,0 +1,92 @@
+import json
+import logging
+import platform
+import time
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from carbuyrest22app.benchmarks import compare_results, route_scenarios, run_scenario
+from carbuyrest22app.models import Car, FavouriteCar, User
+
+
+class Command(BaseCommand):
+    help = ('Lanza peticiones concurrentes contra todas las rutas de CarBuy/urls.py y mide latencia '
+            '(p50/p95/p99), throughput y consultas por peticion. Los resultados se guardan en JSON y '
+            'pueden compararse con una ejecucion de referencia. Ver seed_benchmark para los datos.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Peticiones por ruta')
+        parser.add_argument('--concurrency', type=int, default=20, help='Clientes concurrentes')
+        parser.add_argument('--routes', nargs='+', help='Medir solo estas rutas')
+        parser.add_argument('--readers', type=int, default=100, help='Usuarios con sesion abierta para las lecturas')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Fichero JSON donde guardar los resultados')
+        parser.add_argument('--baseline', help='Resultados de referencia con los que comparar')
+        parser.add_argument('--max-regression', type=float, default=0.2,
+                            help='Empeoramiento admitido en p95 y throughput respecto a la referencia (0.2 = 20%%)')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        try:
+            scenarios = route_scenarios(options['seed'], options['readers'])
+        except ValueError as error:
+            raise CommandError(str(error))
+        if options['routes']:
+            unknown = set(options['routes']) - {name for name, prepare, limit in scenarios}
+            if unknown:
+                raise CommandError('Rutas desconocidas: %s' % ', '.join(sorted(unknown)))
+            scenarios = [scenario for scenario in scenarios if scenario[0] in options['routes']]
+
+        results = {
+            'meta': {
+                'timestamp': int(time.time()),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'requests': options['requests'],
+                'concurrency': options['concurrency'],
+                'users': User.objects.count(),
+                'cars': Car.objects.count(),
+                'favourites': FavouriteCar.objects.count(),
+            },
+            'routes': {},
+        }
+
+        # Los codigos de estado se resumen en la tabla; no hace falta un aviso por peticion
+        logging.getLogger('django.request').setLevel(logging.CRITICAL)
+        hosts = list(settings.ALLOWED_HOSTS) + ['testserver']
+        # Todas las peticiones salen de la misma IP: sin limites de admision se
+        # mide la aplicacion y no los rechazos (ver ratelimit.py)
+        unlimited = {'ALLOWED_HOSTS': hosts, 'CARBUY_RATE_LIMITS': {}, 'CARBUY_CONCURRENCY_LIMITS': {}}
+
+        self.stdout.write('%-22s %8s %10s %9s %9s %9s %8s  %s' % (
+            'route', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'status'))
+        for name, prepare, limit in scenarios:
+            total = min(options['requests'], limit) if limit else options['requests']
+            with override_settings(**unlimited):
+                stats = run_scenario(prepare, total, options['concurrency'])
+            results['routes'][name] = stats
+            self.stdout.write('%-22s %8d %10.1f %9.2f %9.2f %9.2f %8.2f  %s' % (
+                name, stats['requests'], stats['throughput'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+                stats['queries_per_request'],
+                ' '.join('%s:%d' % item for item in sorted(stats['statuses'].items()))
+            ))
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(results, output_file, indent=2, sort_keys=True)
+
+        if baseline is not None:
+            regressions = compare_results(baseline, results, options['max_regression'])
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(regression))
+            if regressions:
+                raise CommandError('%d regresiones respecto a %s' % (len(regressions), options['baseline']))
+            self.stdout.write(self.style.SUCCESS('Sin regresiones respecto a %s' % options['baseline']))
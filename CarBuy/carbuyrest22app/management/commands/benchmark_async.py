@@ -0,0 +1,69 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+
+from carbuyrest22app.benchmarks import AsyncURLConf, SyncURLConf, summarize
+from carbuyrest22app.models import Car
+
+
+class Command(BaseCommand):
+    help = ('Compara el rendimiento de los endpoints de lectura sincronos (WSGIHandler, un hilo por '
+            'peticion) y asincronos (ASGIHandler) con muchos clientes concurrentes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Peticiones por ruta y modo')
+        parser.add_argument('--concurrency', type=int, default=50, help='Clientes concurrentes')
+        parser.add_argument('--token', help='sessionToken para medir tambien las rutas autenticadas')
+        parser.add_argument('--query', default='golf', help='Busqueda usada en /search/')
+
+    def handle(self, *args, **options):
+        paths = ['/get_ads/?limit=50', '/search/?q=%s' % options['query']]
+        car_id = Car.objects.order_by('id').values_list('id', flat=True).first()
+        if car_id is not None:
+            paths.append('/ad/%d/' % car_id)
+        headers = {}
+        if options['token']:
+            headers['sessionToken'] = options['token']
+            paths += ['/get_favourites/', '/get_user/', '/account/']
+
+        hosts = list(settings.ALLOWED_HOSTS) + ['testserver']
+        self.stdout.write('%-24s %-6s %10s %9s %9s %9s' % ('route', 'mode', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for url in paths:
+            with override_settings(ROOT_URLCONF=SyncURLConf, ALLOWED_HOSTS=hosts):
+                sync_stats = self.run_sync(url, headers, options['requests'], options['concurrency'])
+            with override_settings(ROOT_URLCONF=AsyncURLConf, ALLOWED_HOSTS=hosts):
+                async_stats = asyncio.run(self.run_async(url, headers, options['requests'], options['concurrency']))
+            for mode, stats in (('wsgi', sync_stats), ('asgi', async_stats)):
+                self.stdout.write('%-24s %-6s %10.1f %9.2f %9.2f %9.2f' % (
+                    url[:24], mode, stats['throughput'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms']
+                ))
+
+    def run_sync(self, url, headers, total, concurrency):
+        def request(_):
+            client = Client()
+            start = time.perf_counter()
+            client.get(url, headers=headers)
+            return time.perf_counter() - start
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(request, range(total)))
+        return summarize(latencies, time.perf_counter() - started)
+
+    async def run_async(self, url, headers, total, concurrency):
+        client = AsyncClient()
+        slots = asyncio.Semaphore(concurrency)
+
+        async def request():
+            async with slots:
+                start = time.perf_counter()
+                await client.get(url, headers=headers)
+                return time.perf_counter() - start
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(request() for _ in range(total)))
+        return summarize(latencies, time.perf_counter() - started)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from carbuyrest22app.benchmarks import measure_profile
+
+
+class Command(BaseCommand):
+    help = ('Compara el tiempo de arranque y el coste por peticion de los perfiles de settings '
+            '(completo y solo API), cada uno en un proceso nuevo')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', nargs='+', default=['CarBuy.settings', 'CarBuy.settings_api'],
+                            help='Modulos de settings a comparar')
+        parser.add_argument('--runs', type=int, default=5, help='Arranques por perfil (se da la mediana)')
+        parser.add_argument('--requests', type=int, default=2000, help='Peticiones por perfil')
+
+    def handle(self, *args, **options):
+        self.stdout.write('%-22s %11s %8s %11s %8s %8s  %s' % (
+            'profile', 'startup ms', 'modules', 'request us', 'p50 us', 'p99 us', 'heavy modules'))
+        for profile in options['profiles']:
+            stats = measure_profile(profile, options['runs'], options['requests'])
+            self.stdout.write('%-22s %11.1f %8d %11.1f %8.1f %8.1f  %s' % (
+                profile, stats['startup_ms'], stats['modules'], stats['request_us'], stats['p50_us'],
+                stats['p99_us'], ', '.join(stats['heavy_modules']) or '-'))
@@ -0,0 +1,28 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from carbuyrest22app.snapshot import SnapshotBusy, build_catalog_snapshot
+
+
+class Command(BaseCommand):
+    help = ('Genera la copia en disco del listado completo de get_ads (JSON, gzip y brotli) para la '
+            'version actual del catalogo')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', help='Directorio de salida (por defecto CARBUY_CATALOG_SNAPSHOT)')
+
+    def handle(self, *args, **options):
+        directory = options['directory'] or settings.CARBUY_CATALOG_SNAPSHOT['DIRECTORY']
+        if not directory:
+            raise CommandError('CARBUY_CATALOG_SNAPSHOT no tiene DIRECTORY')
+        start = time.perf_counter()
+        try:
+            sizes = build_catalog_snapshot(directory)
+        except SnapshotBusy:
+            raise CommandError('Otro proceso esta generando la copia; vuelve a intentarlo')
+        if sizes is None:
+            raise CommandError('El catalogo ha cambiado mientras se generaba la copia; vuelve a intentarlo')
+        self.stdout.write(self.style.SUCCESS('Copia generada en %.1f s en %s: %s' % (
+            time.perf_counter() - start, directory,
+            ', '.join('%s %.1f MB' % ('json' + suffix, size / 1e6) for suffix, size in sorted(sizes.items())))))
@@ -0,0 +1,22 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+
+from carbuyrest22app.cooccurrence import build_neighbours, np
+
+
+class Command(BaseCommand):
+    help = 'Calcula los coches mas parecidos de cada coche por favoritos en comun (CarNeighbour)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--changed', action='store_true',
+                            help='Solo recalcula los coches con cambios en sus favoritos desde la ultima ejecucion')
+
+    def handle(self, *args, **options):
+        if np is None:
+            raise CommandError('build_neighbours necesita numpy')
+        start = time.perf_counter()
+        result = build_neighbours(changed_only=options['changed'])
+        self.stdout.write(self.style.SUCCESS(
+            'Vecinos calculados: %d coches, %d filas a partir de %d favoritos en %.2f s' % (
+                result['cars'], result['neighbours'], result['favourites'], time.perf_counter() - start)
+        ))
@@ -0,0 +1,27 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from carbuyrest22app.catalog import catalog_state
+from carbuyrest22app.similar import similar_index
+
+
+class Command(BaseCommand):
+    help = 'Construye el indice de coches similares desde la base de datos y guarda el snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None,
+                            help='Fichero del snapshot (por defecto CARBUY_SIMILAR_SNAPSHOT)')
+
+    def handle(self, *args, **options):
+        if similar_index is None:
+            raise CommandError('El indice de coches similares necesita numpy')
+        path = options['output'] or settings.CARBUY_SIMILAR_SNAPSHOT
+        if not path:
+            raise CommandError('Indica el fichero con --output o el ajuste CARBUY_SIMILAR_SNAPSHOT')
+
+        start = time.perf_counter()
+        similar_index.rebuild(catalog_state()[0])
+        similar_index.save(path)
+        self.stdout.write(self.style.SUCCESS('Indice guardado en %s: %d anuncios en %.2f s' % (
+            path, similar_index.alive, time.perf_counter() - start)))
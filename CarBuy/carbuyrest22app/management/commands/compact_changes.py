@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from carbuyrest22app.changes import compact_changes
+
+
+class Command(BaseCommand):
+    help = ('Compacta el registro de cambios de sync/: borra las entradas con un cambio posterior del '
+            'mismo anuncio y las bajas mas antiguas que --tombstone-days')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tombstone-days', type=float, default=settings.CARBUY_SYNC['TOMBSTONE_DAYS'],
+                            help='Dias que se conservan las bajas (los cursores anteriores reciben 410)')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Entradas revisadas por transaccion')
+
+    def handle(self, *args, **options):
+        removed = compact_changes(options['tombstone_days'], options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Borradas %d entradas sustituidas y %d bajas antiguas' % (
+            removed['superseded'], removed['tombstones'])))
@@ -0,0 +1,37 @@
+import sys
+import time
+from django.core.management.base import BaseCommand
+
+from carbuyrest22app.export import EXPORT_FORMATS, export_chunks, gzip_chunks
+
+
+class Command(BaseCommand):
+    help = ('Exporta todos los anuncios como NDJSON o CSV, leyendo y escribiendo por bloques '
+            '(memoria constante). Sin --output se escribe en la salida estandar.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='ndjson')
+        parser.add_argument('--sellers', action='store_true', help='Incluir nombre y telefono del vendedor')
+        parser.add_argument('--gzip', action='store_true', help='Comprimir la salida con gzip')
+        parser.add_argument('--output', help='Fichero de salida')
+
+    def handle(self, *args, **options):
+        chunks = export_chunks(options['format'], options['sellers'])
+        if options['gzip']:
+            chunks = gzip_chunks(chunks)
+
+        start = time.perf_counter()
+        written = 0
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+                written += len(chunk)
+        finally:
+            if options['output']:
+                output.close()
+            else:
+                output.flush()
+        if options['output']:
+            self.stdout.write('Exportados %.1f MB en %.1f s a %s' % (
+                written / 1e6, time.perf_counter() - start, options['output']))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from carbuyrest22app.facets import compute_facets, rebuild_facets, stored_facets
+
+
+class Command(BaseCommand):
+    help = 'Reconstruye desde cero la tabla de facetas (CarFacet) o comprueba que coincide con Car'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help='Solo compara la tabla con un recuento completo y falla si hay diferencias')
+
+    def handle(self, *args, **options):
+        if not options['verify']:
+            counts = rebuild_facets()
+            self.stdout.write(self.style.SUCCESS('Facetas reconstruidas: %d filas' % len(counts)))
+            return
+
+        expected = compute_facets()
+        stored = stored_facets()
+        differences = sorted(key for key in expected.keys() | stored.keys() if expected[key] != stored[key])
+        for kind, key in differences:
+            self.stdout.write('%s=%s: guardado %d, real %d' % (kind, key, stored[(kind, key)], expected[(kind, key)]))
+        if differences:
+            raise CommandError('%d facetas no coinciden; ejecuta rebuild_facets' % len(differences))
+        self.stdout.write(self.style.SUCCESS('Facetas correctas: %d filas' % len(expected)))
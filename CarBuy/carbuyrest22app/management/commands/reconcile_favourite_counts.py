@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from carbuyrest22app.catalog import bump_favourites_version
+from carbuyrest22app.favourites import reconcile_favourite_counts
+
+
+class Command(BaseCommand):
+    help = 'Recalcula Car.favourite_count a partir de FavouriteCar y corrige los coches desfasados'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help='Solo cuenta los coches desfasados y falla si hay alguno')
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            drifted = reconcile_favourite_counts(dry_run=True)
+            if drifted:
+                raise CommandError('%d coches con favourite_count desfasado; ejecuta reconcile_favourite_counts'
+                                   % drifted)
+            self.stdout.write(self.style.SUCCESS('Contadores de favoritos correctos'))
+            return
+
+        fixed = reconcile_favourite_counts()
+        if fixed:
+            # Los listados con favourite_count dejan de ser validos
+            bump_favourites_version()
+        self.stdout.write(self.style.SUCCESS('Contadores corregidos: %d coches' % fixed))
@@ -0,0 +1,25 @@
+import time
+from django.core.management.base import BaseCommand
+
+from carbuyrest22app.benchmarks import SEED_PASSWORD, seed_dataset
+
+
+class Command(BaseCommand):
+    help = ('Genera usuarios, anuncios y favoritos sinteticos para los benchmarks. Conviene usar una base '
+            'de datos aparte: los datos se añaden a los que ya haya')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--cars', type=int, default=500000)
+        parser.add_argument('--favourites', type=int, default=1000000)
+        parser.add_argument('--seed', type=int, default=0, help='Semilla del generador aleatorio')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Filas por bulk_create')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        counts = seed_dataset(options['users'], options['cars'], options['favourites'],
+                              seed=options['seed'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            'Creados %(users)d usuarios, %(cars)d anuncios y %(favourites)d favoritos' % counts
+            + ' en %.1f s (contraseña: %s)' % (time.perf_counter() - started, SEED_PASSWORD)
+        ))
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from carbuyrest22app.benchmarks import stress_database
+
+
+class Command(BaseCommand):
+    help = ('Escritores y lectores concurrentes contra la base de datos configurada. Falla si alguna '
+            'peticion termina con "database is locked". Para comparar con la configuracion sin ajustes, '
+            'ejecutalo tambien con CARBUY_DB_TUNING=off sobre otra base de datos.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=4)
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--seconds', type=float, default=5)
+
+    def handle(self, *args, **options):
+        hosts = list(settings.ALLOWED_HOSTS) + ['testserver']
+        with override_settings(ALLOWED_HOSTS=hosts, CARBUY_RATE_LIMITS={}, CARBUY_CONCURRENCY_LIMITS={}):
+            results = stress_database(options['writers'], options['readers'], options['seconds'])
+
+        journal_mode = ''
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                journal_mode = ' (journal_mode=%s)' % cursor.execute('PRAGMA journal_mode').fetchone()[0]
+        self.stdout.write('%s%s' % (connection.vendor, journal_mode))
+        self.stdout.write('writes: %(writes)d (%(writes_per_second).1f/s)' % results)
+        self.stdout.write('reads: %(reads)d (%(reads_per_second).1f/s)' % results)
+        self.stdout.write('lock errors: %(lock_errors)d' % results)
+        self.stdout.write('other errors: %(errors)d' % results)
+        if results['lock_errors']:
+            raise CommandError('%(lock_errors)d requests failed with "database is locked"' % results)
@@ -0,0 +1,14 @@
+from django.db import migrations
+
+from carbuyrest22app.search import install_search_index, remove_search_index
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carbuyrest22app', '0003_car_image_url'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_index, remove_search_index),
+    ]
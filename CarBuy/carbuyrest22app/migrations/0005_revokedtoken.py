@@ -0,0 +1,22 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carbuyrest22app', '0004_car_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevokedToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('not_before', models.BigIntegerField(null=True)),
+                ('expires_at', models.BigIntegerField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,42 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+from carbuyrest22app.search import install_sqlite_triggers
+
+
+def create_catalog_state(apps, schema_editor):
+    CatalogState = apps.get_model('carbuyrest22app', 'CatalogState')
+    CatalogState.objects.get_or_create(id=1, defaults={'version': 0, 'updated_at': django.utils.timezone.now()})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carbuyrest22app', '0006_car_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='car',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='CatalogState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.RunPython(create_catalog_state, migrations.RunPython.noop),
+        # AddField reconstruye la tabla de coches en SQLite y borra los triggers del indice de busqueda
+        migrations.RunPython(install_sqlite_triggers, migrations.RunPython.noop),
+    ]
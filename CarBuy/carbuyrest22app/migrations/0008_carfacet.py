@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:13
+
+from django.db import migrations, models
+
+from carbuyrest22app.facets import rebuild_facets
+
+
+def populate_facets(apps, schema_editor):
+    rebuild_facets(apps.get_model('carbuyrest22app', 'Car'), apps.get_model('carbuyrest22app', 'CarFacet'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carbuyrest22app', '0007_modification_tracking'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CarFacet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=10)),
+                ('key', models.CharField(max_length=100)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='carfacet',
+            constraint=models.UniqueConstraint(fields=('kind', 'key'), name='carfacet_kind_key_unique'),
+        ),
+        migrations.RunPython(populate_facets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:25
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def remove_duplicates(apps, schema_editor):
+    # Sin la restriccion se podian guardar favoritos repetidos; se conserva el primero
+    FavouriteCar = apps.get_model('carbuyrest22app', 'FavouriteCar')
+    first = FavouriteCar.objects.order_by().values('user_id', 'car_id').annotate(first=Min('id')).values('first')
+    FavouriteCar.objects.exclude(id__in=first).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carbuyrest22app', '0008_carfacet'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='favouritecar',
+            constraint=models.UniqueConstraint(fields=('user', 'car'), name='favouritecar_user_car_unique'),
+        ),
+    ]
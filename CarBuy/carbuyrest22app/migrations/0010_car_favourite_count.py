@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:26
+
+from django.db import migrations, models
+
+from carbuyrest22app.favourites import reconcile_favourite_counts
+from carbuyrest22app.search import install_sqlite_triggers
+
+
+def count_favourites(apps, schema_editor):
+    reconcile_favourite_counts(apps.get_model('carbuyrest22app', 'Car'),
+                               apps.get_model('carbuyrest22app', 'FavouriteCar'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carbuyrest22app', '0009_favouritecar_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='car',
+            name='favourite_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='car',
+            index=models.Index(fields=['-favourite_count', 'id'], name='car_favourite_count_idx'),
+        ),
+        migrations.RunPython(count_favourites, migrations.RunPython.noop),
+        # AddField reconstruye la tabla de coches en SQLite y borra los triggers del indice de busqueda
+        migrations.RunPython(install_sqlite_triggers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carbuyrest22app', '0010_car_favourite_count'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='car',
+            index=models.Index(fields=['updated_at'], name='car_updated_at_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carbuyrest22app', '0011_car_updated_at_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StaleNeighbours',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('car_id', models.BigIntegerField(unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CarNeighbour',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('car', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='neighbours', to='carbuyrest22app.car')),
+                ('neighbour', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='carbuyrest22app.car')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['car', '-score', 'neighbour'], name='carneighbour_car_score_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:05
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def log_existing_cars(apps, schema_editor):
+    # Una entrada por coche ya existente, para que sync/?since=0 devuelva el catalogo completo
+    Car = apps.get_model('carbuyrest22app', 'Car')
+    CarChange = apps.get_model('carbuyrest22app', 'CarChange')
+    connection = schema_editor.connection
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO %s (car_id, deleted, created_at) SELECT id, %%s, %%s FROM %s ORDER BY id'
+            % (quote(CarChange._meta.db_table), quote(Car._meta.db_table)),
+            [False, connection.ops.adapt_datetimefield_value(django.utils.timezone.now())]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carbuyrest22app', '0012_carneighbour'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='catalogstate',
+            name='changes_pruned_through',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='CarChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('car_id', models.BigIntegerField()),
+                ('deleted', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['car_id', 'id'], name='carchange_car_idx')],
+            },
+        ),
+        migrations.RunPython(log_existing_cars, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carbuyrest22app', '0013_carchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='catalogstate',
+            name='favourites_updated_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='catalogstate',
+            name='favourites_version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
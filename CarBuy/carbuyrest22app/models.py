@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 class User(models.Model):
     email = models.CharField(max_length=200, unique=True)
@@ -7,6 +8,7 @@ class User(models.Model):
     birthdate = models.DateField(auto_now_add=False)
     phone = models.CharField(max_length=15)
     token = models.CharField(unique=True, null=True, max_length=50)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def to_jsonAccount(self):
         return {
@@ -21,7 +23,89 @@ class Car(models.Model):
     description = models.TextField()
     image_url = models.URLField(default='https://shorturl.at/YJLnZ')
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Numero de usuarios que lo tienen en favoritos (ver favourites.py)
+    favourite_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # Indices para las combinaciones de filtros y ordenaciones de filter_ads
+        indexes = [
+            models.Index(fields=['brand', 'model', 'year'], name='car_brand_model_year_idx'),
+            models.Index(fields=['brand', 'year'], name='car_brand_year_idx'),
+            models.Index(fields=['brand', 'price'], name='car_brand_price_idx'),
+            models.Index(fields=['model', 'year'], name='car_model_year_idx'),
+            models.Index(fields=['year', 'price'], name='car_year_price_idx'),
+            models.Index(fields=['price'], name='car_price_idx'),
+            # Ranking de los mas favoritos
+            models.Index(fields=['-favourite_count', 'id'], name='car_favourite_count_idx'),
+            # Anuncios modificados desde una fecha (indice de coches similares)
+            models.Index(fields=['updated_at'], name='car_updated_at_idx'),
+        ]
 
 class FavouriteCar(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    car = models.ForeignKey(Car, on_delete=models.CASCADE)
\ No newline at end of file
+    car = models.ForeignKey(Car, on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'car'], name='favouritecar_user_car_unique'),
+        ]
+
+class RevokedToken(models.Model):
+    # "jti:<id del token>" para un logout, "user:<id>" para un cambio de contraseña
+    key = models.CharField(max_length=64, unique=True)
+    not_before = models.BigIntegerField(null=True)
+    expires_at = models.BigIntegerField(db_index=True)
+
+class CatalogState(models.Model):
+    # Fila unica con la version del catalogo, que aumenta con cada alta,
+    # modificacion o baja de un anuncio
+    version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField()
+    # Version de los contadores de favoritos, aparte para que un favorito no
+    # invalide lo que solo depende de los anuncios (ver catalog.py)
+    favourites_version = models.BigIntegerField(default=0)
+    favourites_updated_at = models.DateTimeField(null=True)
+    # Ultimo CarChange borrado por compact_changes que podia ser una baja: los
+    # cursores anteriores ya no son validos (ver changes.py)
+    changes_pruned_through = models.BigIntegerField(default=0)
+
+class CarFacet(models.Model):
+    # Numero de anuncios por marca, año o tramo de precio (ver facets.py)
+    kind = models.CharField(max_length=10)
+    key = models.CharField(max_length=100)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'key'], name='carfacet_kind_key_unique'),
+        ]
+
+class CarNeighbour(models.Model):
+    # Coches que mas se repiten en los favoritos de quienes tienen car, con su
+    # similitud (ver neighbours.py). La calcula manage.py build_neighbours.
+    car = models.ForeignKey(Car, on_delete=models.CASCADE, related_name='neighbours', db_index=False)
+    neighbour = models.ForeignKey(Car, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['car', '-score', 'neighbour'], name='carneighbour_car_score_idx'),
+        ]
+
+class StaleNeighbours(models.Model):
+    # Coches con cambios en sus favoritos desde el ultimo build_neighbours.
+    # Sin clave ajena: si el coche se borra, la fila se ignora.
+    car_id = models.BigIntegerField(unique=True)
+
+class CarChange(models.Model):
+    # Registro de cambios de anuncios para sync/ (ver changes.py). El id es el
+    # cursor. Sin clave ajena: las bajas (deleted) sobreviven al coche.
+    car_id = models.BigIntegerField()
+    deleted = models.BooleanField(default=False)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['car_id', 'id'], name='carchange_car_idx'),
+        ]
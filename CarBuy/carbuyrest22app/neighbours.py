@@ -0,0 +1,69 @@
+from django.conf import settings
+
+from .models import CarNeighbour, FavouriteCar, StaleNeighbours
+from .serializers import AD_LIST_FIELDS
+
+
+# "Quienes tienen este coche en favoritos tambien tienen...". manage.py
+# build_neighbours lee FavouriteCar por bloques y forma la matriz dispersa
+# usuario x coche (en formato CSR por usuario y CSC por coche, con arrays de
+# numpy). La similitud entre dos coches es la del coseno entre sus columnas:
+# usuarios en comun / raiz(usuarios de a * usuarios de b). Se calcula por
+# lotes de coches limitados por el numero de pares que generan, asi que la
+# memoria no depende del tamaño de la tabla, y se guardan los TOP_N vecinos de
+# cada coche en CarNeighbour. El endpoint los lee con una sola consulta sobre
+# el indice carneighbour_car_score_idx.
+#
+# Cada alta o baja de favoritos apunta el coche en StaleNeighbours (ver
+# signals.py). build_neighbours --changed solo recalcula esos coches y los que
+# comparten usuarios con ellos o los tenian como vecinos, cuyas similitudes
+# tambien cambian. Al borrar un coche sus favoritos y sus vecinos se borran en
+# cascada, asi que antes se apuntan los coches que comparten usuarios con el o
+# lo tienen como vecino. Y cuando un usuario pasa a tener mas (o menos) de
+# MAX_USER_FAVOURITES favoritos sale (o entra) de la matriz: se apuntan todos
+# sus coches.
+#
+# El calculo, que necesita numpy, esta en cooccurrence.py: este modulo lo
+# importan las vistas y las señales y no debe cargar numpy al arrancar.
+
+# Columnas del listado de anuncios, leidas del coche vecino
+NEIGHBOUR_FIELDS = tuple('neighbour__%s' % field for field in AD_LIST_FIELDS)
+
+# Limite de parametros por consulta con id__in (SQLite admite 32766)
+IN_BATCH = 10000
+
+
+def mark_stale(car_ids):
+    car_ids = list(car_ids)
+    if car_ids:
+        StaleNeighbours.objects.bulk_create(
+            [StaleNeighbours(car_id=car_id) for car_id in car_ids], ignore_conflicts=True
+        )
+
+
+def mark_deleted_car(car_id):
+    # Se llama antes de borrar el coche, mientras existen sus favoritos y vecinos
+    fans = FavouriteCar.objects.filter(car_id=car_id).values('user_id')
+    shared = FavouriteCar.objects.filter(user_id__in=fans).exclude(car_id=car_id).values_list('car_id', flat=True)
+    pointing = CarNeighbour.objects.filter(neighbour_id=car_id).values_list('car_id', flat=True)
+    mark_stale(set(shared) | set(pointing))
+
+
+def mark_threshold_crossing(user_id, delta):
+    # delta: cambio en el numero de favoritos del usuario, ya aplicado
+    limit = settings.CARBUY_NEIGHBOURS['MAX_USER_FAVOURITES']
+    favourites = FavouriteCar.objects.filter(user_id=user_id)
+    after = favourites.count()
+    if (after - delta > limit) != (after > limit):
+        mark_stale(favourites.values_list('car_id', flat=True))
+
+
+def neighbour_rows(car_id, limit):
+    # Vecinos de car_id de mas a menos parecido, como filas de AD_LIST_FIELDS
+    return (CarNeighbour.objects.filter(car_id=car_id).order_by('-score', 'neighbour_id')
+            .values_list(*NEIGHBOUR_FIELDS)[:limit])
+
+
+def in_chunks(values, size=IN_BATCH):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
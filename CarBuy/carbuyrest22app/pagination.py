@@ -0,0 +1,38 @@
+from django.conf import settings
+
+
+def parse_page_params(request):
+    # Lee el cursor (ultimo id recibido) y el tamaño de pagina de la query string.
+    # Lanza ValueError si alguno de los dos no es un entero valido.
+    cursor = request.GET.get('cursor')
+    limit = request.GET.get('limit')
+
+    cursor = int(cursor) if cursor else 0
+    limit = int(limit) if limit else settings.CARBUY_PAGE_SIZE
+    if cursor < 0 or limit < 1:
+        raise ValueError('Invalid pagination parameters')
+
+    return cursor, min(limit, settings.CARBUY_MAX_PAGE_SIZE)
+
+
+def keyset_page(queryset, cursor, limit):
+    # Pagina por id: solo lee las filas posteriores al cursor, asi el coste de
+    # cada pagina no depende de lo avanzada que este. Se pide una fila extra
+    # para saber si existe una pagina siguiente. Las filas son de values_list()
+    # con el id en la primera columna.
+    rows = list(queryset.filter(id__gt=cursor).order_by('id')[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1][0]
+    return rows, next_cursor
+
+
+async def akeyset_page(queryset, cursor, limit):
+    # Version asincrona de keyset_page
+    rows = [row async for row in queryset.filter(id__gt=cursor).order_by('id')[:limit + 1]]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1][0]
+    return rows, next_cursor
@@ -0,0 +1,188 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.urls import Resolver404, resolve
+
+from .serializers import JsonResponse
+
+
+# Control de admision. Cada regla de CARBUY_RATE_LIMITS es un token bucket por
+# ruta, metodo y cliente: se rellena a "rate" peticiones por segundo hasta
+# "burst" y cada peticion gasta una; sin fichas se responde 429 al momento.
+# CARBUY_CONCURRENCY_LIMITS limita ademas cuantas peticiones de una ruta cara
+# (bcrypt, el listado completo) atiende a la vez cada proceso; el resto
+# recibe 503. Las dos respuestas llevan Retry-After.
+#
+# Con BACKEND 'locmem' los buckets viven en el proceso (un diccionario LRU
+# acotado a MAX_BUCKETS). Con 'django' se comparten entre procesos en la
+# cache CACHE_ALIAS mediante contadores con add() e incr(), que son atomicos
+# en memcached y redis: cada ventana de burst / rate segundos admite burst
+# peticiones, la misma tasa media que el token bucket.
+
+# Ruta de cada path, resuelta una sola vez (las rutas con parametros, como
+# ad/<id>/, ocupan una entrada por id hasta llenar la cache)
+@lru_cache(maxsize=4096)
+def _route(urlconf, path):
+    try:
+        return resolve(path, urlconf).route
+    except Resolver404:
+        return None
+
+
+class LocalBuckets:
+    def __init__(self, max_buckets):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        # Gasta una ficha; devuelve 0 o los segundos hasta la siguiente ficha
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                # Los buckets descartados vuelven llenos: como mucho se permite de mas
+                if len(self._buckets) >= self.max_buckets:
+                    self._buckets.popitem(last=False)
+                bucket = self._buckets[key] = [burst, now]
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / rate
+
+
+class SharedBuckets:
+    def __init__(self, alias):
+        self.alias = alias
+
+    def take(self, key, rate, burst):
+        cache = caches[self.alias]
+        now = time.time()
+        window = burst / rate
+        index = int(now // window)
+        cache_key = 'carbuy:ratelimit:%s:%d' % (key, index)
+        cache.add(cache_key, 0, math.ceil(window) + 1)
+        try:
+            count = cache.incr(cache_key)
+        except ValueError:
+            # La entrada ha caducado entre add() e incr()
+            cache.set(cache_key, 1, math.ceil(window) + 1)
+            count = 1
+        if count <= burst:
+            return 0
+        return (index + 1) * window - now
+
+
+class Admission:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Se llama tambien al cambiar los settings (ver signals.py)
+        config = settings.CARBUY_RATE_LIMIT
+        if config.get('BACKEND', 'locmem') == 'django':
+            self.buckets = SharedBuckets(config.get('CACHE_ALIAS', 'default'))
+        else:
+            self.buckets = LocalBuckets(config.get('MAX_BUCKETS', 100000))
+        self.client_header = config.get('CLIENT_HEADER')
+        self.trusted_proxies = config.get('TRUSTED_PROXIES', 1)
+        self.rules = settings.CARBUY_RATE_LIMITS
+        self.slots = {route: threading.BoundedSemaphore(limit)
+                      for route, limit in settings.CARBUY_CONCURRENCY_LIMITS.items()}
+        self.routes = frozenset(self.rules) | frozenset(self.slots)
+        self.urlconf = settings.ROOT_URLCONF
+        _route.cache_clear()
+
+    def client(self, request):
+        # IP del cliente. Detras de TRUSTED_PROXIES proxies, cada uno añade al
+        # final de CLIENT_HEADER la direccion de quien le conecta: la entrada
+        # TRUSTED_PROXIES empezando por la derecha es la que ha puesto el
+        # primero de ellos. Las anteriores las envia el cliente y pueden ser
+        # falsas, asi que no se usan.
+        if self.client_header:
+            value = request.headers.get(self.client_header)
+            if value:
+                addresses = value.split(',')
+                if len(addresses) >= self.trusted_proxies:
+                    return addresses[-self.trusted_proxies].strip()
+        return request.META.get('REMOTE_ADDR', '')
+
+    def admit(self, request):
+        # Devuelve (respuesta de rechazo o None, semaforo a liberar o None)
+        route = _route(self.urlconf, request.path_info)
+        if route not in self.routes:
+            return None, None
+        limit = self.rules.get(route, {}).get(request.method)
+        if limit is not None:
+            rate, burst = limit
+            key = '%s:%s:%s' % (route, request.method, self.client(request))
+            wait = self.buckets.take(key, rate, burst)
+            if wait:
+                return rejection({'error': 'Too many requests'}, 429, wait), None
+        slot = self.slots.get(route)
+        if slot is not None and not slot.acquire(blocking=False):
+            return rejection({'error': 'Server busy, try again later'}, 503, 1), None
+        return None, slot
+
+
+admission = Admission()
+
+
+def rejection(data, status, wait):
+    response = JsonResponse(data, status=status)
+    response['Retry-After'] = str(max(1, math.ceil(wait)))
+    return response
+
+
+class AdmissionMiddleware:
+    # Va justo despues de MetricsMiddleware, para que los rechazos se midan
+    # pero cuesten lo minimo. Las rutas sin reglas solo pagan una busqueda en
+    # diccionario. El hueco de concurrencia se libera al cerrar la respuesta,
+    # asi que en las respuestas en streaming dura hasta enviar el ultimo byte.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        rejected, slot = admission.admit(request)
+        if rejected is not None:
+            return rejected
+        if slot is None:
+            return self.get_response(request)
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            slot.release()
+            raise
+        response._resource_closers.append(slot.release)
+        return response
+
+    async def __acall__(self, request):
+        rejected, slot = admission.admit(request)
+        if rejected is not None:
+            return rejected
+        if slot is None:
+            return await self.get_response(request)
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            slot.release()
+            raise
+        response._resource_closers.append(slot.release)
+        return response
@@ -0,0 +1,139 @@
+import hashlib
+import re
+from django.db import connection
+from django.db.models import Q
+
+from .caching import ResultCache
+from .models import Car
+
+
+# Indice de texto completo sobre marca, modelo y descripcion de los anuncios.
+# En SQLite es una tabla virtual FTS5 de contenido externo que se mantiene
+# sincronizada con triggers; en PostgreSQL es un indice GIN sobre un tsvector.
+CAR_TABLE = 'carbuyrest22app_car'
+FTS_TABLE = 'carbuyrest22app_car_fts'
+PG_INDEX = 'carbuyrest22app_car_search_idx'
+
+# Peso de cada columna en el ranking: marca > modelo > descripcion
+FTS_WEIGHTS = (10.0, 5.0, 1.0)
+
+PG_VECTOR = (
+    "setweight(to_tsvector('simple', coalesce(brand, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(model, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(description, '')), 'D')"
+)
+
+SQLITE_TRIGGERS = (
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON {CAR_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, brand, model, description)
+        VALUES (new.id, new.brand, new.model, new.description);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON {CAR_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, brand, model, description)
+        VALUES ('delete', old.id, old.brand, old.model, old.description);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF brand, model, description ON {CAR_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, brand, model, description)
+        VALUES ('delete', old.id, old.brand, old.model, old.description);
+        INSERT INTO {FTS_TABLE}(rowid, brand, model, description)
+        VALUES (new.id, new.brand, new.model, new.description);
+    END""",
+)
+
+
+def install_search_index(apps, schema_editor):
+    # Operacion de migracion: crea el indice segun el motor de base de datos
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            f"brand, model, description, content='{CAR_TABLE}', content_rowid='id', "
+            f"tokenize='unicode61 remove_diacritics 2')"
+        )
+        install_sqlite_triggers(apps, schema_editor)
+        schema_editor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            f"CREATE INDEX IF NOT EXISTS {PG_INDEX} ON {CAR_TABLE} USING GIN (({PG_VECTOR}))"
+        )
+
+
+def install_sqlite_triggers(apps, schema_editor):
+    # SQLite reconstruye la tabla de coches en muchas migraciones (AddField,
+    # AlterField...) y al hacerlo borra sus triggers. Toda migracion que
+    # modifique columnas de Car debe volver a ejecutar esta operacion.
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in SQLITE_TRIGGERS:
+        schema_editor.execute(statement)
+
+
+def remove_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for suffix in ('ai', 'ad', 'au'):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {FTS_TABLE}_{suffix}")
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+    elif vendor == 'postgresql':
+        schema_editor.execute(f"DROP INDEX IF EXISTS {PG_INDEX}")
+
+
+def query_terms(search_query):
+    # Separa la busqueda en palabras; cualquier otro caracter se descarta, asi
+    # el usuario nunca puede inyectar sintaxis del motor de busqueda
+    return re.findall(r'\w+', search_query.lower())
+
+
+# Ids de cada pagina de resultados, en orden de relevancia, y la pagina
+# siguiente. La clave incluye la version del catalogo, que cambia con cada
+# alta, modificacion o baja de un anuncio, asi que nunca se sirve un resultado
+# antiguo. Las filas se leen en cada peticion, con los contadores de favoritos
+# actuales, asi que los favoritos no invalidan la cache.
+search_cache = ResultCache('search', 'CARBUY_SEARCH_CACHE')
+
+
+def search_entry_size(car_ids):
+    # Tamaño aproximado de una entrada, para MAX_BYTES
+    return 8 * (len(car_ids) + 1)
+
+
+def search_cache_key(version, search_query, page, limit):
+    # Busquedas que solo difieren en mayusculas, signos o espacios comparten entrada
+    normalized = ' '.join(query_terms(search_query))
+    return '%d:%d:%d:%s' % (version, page, limit, hashlib.sha1(normalized.encode('utf8')).hexdigest())
+
+
+def search_car_ids(search_query, offset, limit):
+    # Devuelve los ids de los coches que contienen todas las palabras buscadas
+    # (como prefijo), ordenados por relevancia
+    terms = query_terms(search_query)
+    if not terms:
+        return []
+
+    vendor = connection.vendor
+    if vendor == 'sqlite':
+        match = ' '.join('"%s"*' % term for term in terms)
+        sql = (
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s "
+            f"ORDER BY bm25({FTS_TABLE}, %s, %s, %s), rowid LIMIT %s OFFSET %s"
+        )
+        params = [match, *FTS_WEIGHTS, limit, offset]
+    elif vendor == 'postgresql':
+        match = ' & '.join('%s:*' % term for term in terms)
+        sql = (
+            f"SELECT id FROM {CAR_TABLE}, to_tsquery('simple', %s) query "
+            f"WHERE ({PG_VECTOR}) @@ query "
+            f"ORDER BY ts_rank(({PG_VECTOR}), query) DESC, id LIMIT %s OFFSET %s"
+        )
+        params = [match, limit, offset]
+    else:
+        # Otros motores: busqueda por subcadena sin ranking
+        condition = Q()
+        for term in terms:
+            condition &= Q(brand__icontains=term) | Q(model__icontains=term) | Q(description__icontains=term)
+        ids = Car.objects.filter(condition).order_by('id').values_list('id', flat=True)
+        return list(ids[offset:offset + limit])
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
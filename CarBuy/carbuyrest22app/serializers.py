@@ -0,0 +1,190 @@
+from decimal import Decimal
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+from .instrumentation import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Serializacion de todas las respuestas. Las consultas piden solo las columnas
+# de cada formato con values_list() y las filas se convierten directamente en
+# diccionarios, sin instanciar modelos. Los precios se devuelven siempre como
+# String ("9000.00"). Para codificar se usa orjson si esta instalado (y
+# CARBUY_FAST_JSON esta activo) o el modulo json de la libreria estandar.
+
+_encoder = DjangoJSONEncoder(separators=(',', ':'))
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    return _encoder.default(value)
+
+
+def dumps(data):
+    # Codifica data como JSON y devuelve bytes
+    if orjson is not None and settings.CARBUY_FAST_JSON:
+        return orjson.dumps(data, default=_default)
+    return _encoder.encode(data).encode('utf8')
+
+
+def dumps_lines(items):
+    # Codifica cada elemento en una linea JSON terminada en \n (NDJSON)
+    if orjson is not None and settings.CARBUY_FAST_JSON:
+        option = orjson.OPT_APPEND_NEWLINE
+        return b''.join([orjson.dumps(item, default=_default, option=option) for item in items])
+    return ''.join([_encoder.encode(item) + '\n' for item in items]).encode('utf8')
+
+
+class JsonResponse(HttpResponse):
+    # Como django.http.JsonResponse, pero codificando con dumps y midiendo el
+    # tiempo de serializacion (ver instrumentation.py)
+    def __init__(self, data, safe=True, **kwargs):
+        if safe and not isinstance(data, dict):
+            raise TypeError('In order to allow non-dict objects to be serialized set the safe parameter to False.')
+        kwargs.setdefault('content_type', 'application/json')
+        with timed('serialize'):
+            content = dumps(data)
+        super().__init__(content=content, **kwargs)
+
+
+# Listados de anuncios (get_ads, filter_ads, most_favourited y la busqueda). El
+# id debe ir el primero: lo usa la paginacion por cursor.
+AD_LIST_FIELDS = ('id', 'brand', 'model', 'year', 'price', 'description', 'image_url', 'user_id',
+                  'favourite_count')
+
+
+def ad_list_row(row):
+    car_id, brand, model, year, price, description, image_url, user_id, favourite_count = row
+    return {
+        'id': car_id,
+        'brand': brand,
+        'model': model,
+        'year': year,
+        'price': str(price),
+        'description': description,
+        'image_url': image_url,
+        'user_id': user_id,
+        'favourite_count': favourite_count,
+    }
+
+
+def search_results(car_ids, rows):
+    # Resultados de la busqueda a partir de filas de AD_LIST_FIELDS, en el
+    # orden de relevancia de car_ids
+    rows = {row[0]: row for row in rows}
+    results = []
+    for car_id in car_ids:
+        row = rows.get(car_id)
+        if row is None:
+            continue
+        car_id, brand, model, year, price, description, image_url, user_id, favourite_count = row
+        results.append({
+            'car_id': car_id,
+            'brand': brand,
+            'model': model,
+            'year': year,
+            'price': str(price),
+            'description': description,
+            'image_url': image_url,
+            'user_id': user_id,
+            'favourite_count': favourite_count,
+        })
+    return results
+
+
+# Detalle de un anuncio con los datos de contacto del vendedor
+AD_DETAIL_FIELDS = ('brand', 'model', 'year', 'price', 'description', 'image_url', 'user__name', 'user__phone')
+
+
+def ad_detail_data(row):
+    brand, model, year, price, description, image_url, user_name, user_phone = row
+    return {
+        'brand': brand,
+        'model': model,
+        'year': year,
+        'price': str(price),
+        'description': description,
+        'image_url': image_url,
+        'user': {
+            'name': user_name,
+            'phone': user_phone,
+        },
+    }
+
+
+FAVOURITE_FIELDS = ('user__name', 'car_id', 'car__brand', 'car__model', 'car__year', 'car__price',
+                    'car__description', 'car__image_url')
+
+
+def favourite_data(user_id, row):
+    user_name, car_id, brand, model, year, price, description, image_url = row
+    return {
+        'user_id': user_id,
+        'car_id': car_id,
+        'user_name': user_name,
+        'car_brand': brand,
+        'car_model': model,
+        'car_year': year,
+        'car_price': str(price),
+        'car_description': description,
+        'image_url': image_url,
+    }
+
+
+USER_FIELDS = ('id', 'email', 'name')
+
+
+def user_data(row, token):
+    user_id, email, name = row
+    return {
+        'id': user_id,
+        'email': email,
+        'name': name,
+        'token': token,
+    }
+
+
+def stream_json_array(rows, batch_size=None):
+    # Genera un array JSON fragmento a fragmento a partir de un iterador de
+    # diccionarios, sin tener nunca el listado completo en memoria. Cada
+    # fragmento se codifica de una vez.
+    if batch_size is None:
+        batch_size = settings.CARBUY_STREAM_BATCH_SIZE
+
+    yield b'['
+    buffer = []
+    first = True
+    for row in rows:
+        buffer.append(row)
+        if len(buffer) >= batch_size:
+            yield (b'' if first else b',') + dumps(buffer)[1:-1]
+            first = False
+            buffer = []
+    if buffer:
+        yield (b'' if first else b',') + dumps(buffer)[1:-1]
+    yield b']'
+
+
+async def astream_json_array(rows, batch_size=None):
+    # Version asincrona de stream_json_array para un iterador asincrono
+    if batch_size is None:
+        batch_size = settings.CARBUY_STREAM_BATCH_SIZE
+
+    yield b'['
+    buffer = []
+    first = True
+    async for row in rows:
+        buffer.append(row)
+        if len(buffer) >= batch_size:
+            yield (b'' if first else b',') + dumps(buffer)[1:-1]
+            first = False
+            buffer = []
+    if buffer:
+        yield (b'' if first else b',') + dumps(buffer)[1:-1]
+    yield b']'
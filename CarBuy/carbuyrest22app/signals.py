@@ -0,0 +1,169 @@
+from collections import Counter
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import Signal, receiver
+
+from .catalog import bump_catalog_version, bump_favourites_version
+from .changes import record_changes
+from .database import configure_connection
+from .details import ad_cache, forget_ad, forget_seller, seller_cache
+from .facets import apply_deltas, car_deltas
+from .instrumentation import install_query_timer
+from .models import Car, FavouriteCar, User
+from .neighbours import mark_deleted_car, mark_stale, mark_threshold_crossing
+from .ratelimit import admission
+from .search import search_cache
+from .snapshot import snapshot_scheduler
+
+
+# Se envia dentro de la transaccion de cada lote de la alta masiva (bulk_create
+# no envia post_save). Argumentos: cars, lista de los Car creados.
+cars_bulk_created = Signal()
+
+# Se envia dentro de la transaccion de cada alta o baja de favoritos (ver
+# favourites.py). Argumentos: user_id, y added y removed, ids de los coches
+# afectados.
+favourites_changed = Signal()
+
+
+@receiver(post_save, sender=Car)
+@receiver(post_delete, sender=Car)
+@receiver(cars_bulk_created, sender=Car)
+def car_changed(sender, **kwargs):
+    bump_catalog_version()
+    # Nueva copia del listado completo cuando se calmen las escrituras (snapshot.py)
+    transaction.on_commit(snapshot_scheduler.schedule)
+
+
+@receiver(favourites_changed, sender=FavouriteCar)
+def favourite_counts_changed(sender, **kwargs):
+    # Solo cambian los contadores: no afecta a la version del catalogo, pero
+    # la copia del listado completo los incluye
+    bump_favourites_version()
+    transaction.on_commit(snapshot_scheduler.schedule)
+
+
+@receiver(pre_save, sender=Car)
+def remember_facets(sender, instance, **kwargs):
+    # Valores anteriores de un anuncio que se va a modificar, para restarlos de las facetas
+    instance._previous_facets = None
+    if instance.pk is not None:
+        instance._previous_facets = Car.objects.filter(pk=instance.pk).values_list('brand', 'year', 'price').first()
+
+
+@receiver(post_save, sender=Car)
+def update_facets_on_save(sender, instance, **kwargs):
+    deltas = Counter()
+    previous = getattr(instance, '_previous_facets', None)
+    if previous is not None:
+        car_deltas(deltas, *previous, -1)
+    car_deltas(deltas, instance.brand, instance.year, instance.price, 1)
+    apply_deltas(deltas)
+
+
+@receiver(post_delete, sender=Car)
+def update_facets_on_delete(sender, instance, **kwargs):
+    apply_deltas(car_deltas(Counter(), instance.brand, instance.year, instance.price, -1))
+
+
+@receiver(cars_bulk_created, sender=Car)
+def update_facets_on_bulk_create(sender, cars, **kwargs):
+    deltas = Counter()
+    for car in cars:
+        car_deltas(deltas, car.brand, car.year, car.price, 1)
+    apply_deltas(deltas)
+
+
+# Registro de cambios para sync/ (ver changes.py). Estos receptores van
+# despues de car_changed y favourite_counts_changed, que ya han bloqueado la
+# fila de CatalogState.
+
+@receiver(post_save, sender=Car)
+def log_save(sender, instance, **kwargs):
+    record_changes([instance.pk])
+
+
+@receiver(post_delete, sender=Car)
+def log_delete(sender, instance, **kwargs):
+    record_changes([instance.pk], deleted=True)
+
+
+@receiver(cars_bulk_created, sender=Car)
+def log_bulk_create(sender, cars, **kwargs):
+    record_changes([car.pk for car in cars])
+
+
+@receiver(favourites_changed, sender=FavouriteCar)
+def log_favourites(sender, added, removed, **kwargs):
+    record_changes(added + removed)
+
+
+# Cache de detalles (details.py): se borra al cambiar y otra vez tras el
+# commit, por si otra peticion ha vuelto a leer la fila antigua entretanto
+
+@receiver(post_save, sender=Car)
+@receiver(post_delete, sender=Car)
+def invalidate_ad(sender, instance, **kwargs):
+    car_id = instance.pk
+    forget_ad(car_id)
+    transaction.on_commit(lambda: forget_ad(car_id))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_seller(sender, instance, **kwargs):
+    user_id = instance.pk
+    forget_seller(user_id)
+    transaction.on_commit(lambda: forget_seller(user_id))
+
+
+@receiver(pre_delete, sender=User)
+def release_favourites(sender, instance, **kwargs):
+    # Los favoritos del usuario se borran en cascada sin señales: antes se
+    # restan de los contadores de los coches (una sola sentencia UPDATE)
+    favourites = FavouriteCar.objects.filter(user=instance).values('car_id')
+    if Car.objects.filter(id__in=favourites).update(favourite_count=Greatest(F('favourite_count') - 1, Value(0))):
+        bump_favourites_version()
+        transaction.on_commit(snapshot_scheduler.schedule)
+        car_ids = list(favourites.values_list('car_id', flat=True))
+        record_changes(car_ids)
+        mark_stale(car_ids)
+
+
+@receiver(favourites_changed, sender=FavouriteCar)
+def neighbours_changed(sender, user_id, added, removed, **kwargs):
+    # Los vecinos de estos coches se recalculan en el proximo build_neighbours --changed
+    mark_stale(added + removed)
+    mark_threshold_crossing(user_id, len(added) - len(removed))
+
+
+@receiver(pre_delete, sender=Car)
+def neighbours_deleted(sender, instance, **kwargs):
+    mark_deleted_car(instance.pk)
+
+
+@receiver(setting_changed)
+def reset_caches(setting, **kwargs):
+    if setting == 'CARBUY_SEARCH_CACHE':
+        search_cache.reset()
+    if setting in ('CARBUY_RATE_LIMIT', 'CARBUY_RATE_LIMITS', 'CARBUY_CONCURRENCY_LIMITS', 'ROOT_URLCONF'):
+        admission.reset()
+    if setting == 'CARBUY_AD_CACHE':
+        ad_cache.reset()
+    if setting == 'CARBUY_SELLER_CACHE':
+        seller_cache.reset()
+
+
+@receiver(connection_created)
+def configure_database(sender, connection, **kwargs):
+    configure_connection(connection)
+
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    # Cuenta y cronometra las consultas de cada peticion (ver instrumentation.py)
+    install_query_timer(connection)
@@ -0,0 +1,330 @@
+import math
+import os
+import threading
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .changes import pruned_through
+from .models import Car, CarChange
+from .signals import cars_bulk_created
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Indice en memoria para "coches similares". Cada anuncio es un vector con la
+# marca y el modelo en one-hot y el año y el precio normalizados. La distancia
+# entre dos one-hot es 0 si coinciden y 2 si no, asi que en lugar de guardar
+# las columnas one-hot (miles de columnas con muchos modelos) se guarda el
+# codigo de la categoria y se compara con ==, que da el mismo resultado con
+# una fraccion de la memoria. La consulta es una sola pasada vectorizada sobre
+# todas las filas mas un argpartition para quedarse con las k mejores.
+#
+# El indice se carga de un snapshot .npz (CARBUY_SIMILAR_SNAPSHOT) la primera
+# vez que se usa, se actualiza fila a fila con las señales de Car y, antes de
+# cada consulta, si la version del catalogo ha cambiado (escrituras hechas por
+# otros procesos), aplica las entradas del registro de cambios de sync/
+# posteriores a la ultima que vio, bajas incluidas (ver changes.py). Los
+# favoritos no cambian la version del catalogo, asi que no provocan ninguna
+# sincronizacion. Requiere numpy; sin numpy el endpoint responde 503.
+#
+# Para no cargar numpy al arrancar, este modulo solo se importa en la primera
+# peticion a ad/<id>/similar/ (o desde build_similar_index), y con el se
+# conectan sus señales.
+
+# Escalas fijas: asi añadir un anuncio nunca obliga a renormalizar el resto.
+# 5 años de diferencia o el doble de precio cuentan como una unidad.
+YEAR_SCALE = 5.0
+PRICE_SCALE = math.log(2)
+
+# Entradas del registro de cambios leidas por consulta al sincronizar
+SYNC_BATCH_SIZE = 10000
+
+FIELDS = ('id', 'brand', 'model', 'year', 'price')
+
+
+def price_feature(price):
+    return math.log1p(max(float(price), 0.0)) / PRICE_SCALE
+
+
+class SimilarityIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        # Vacia el indice; la siguiente consulta lo vuelve a cargar
+        with self._lock:
+            self.clear()
+            self.loaded = False
+
+    def clear(self):
+        self.size = 0
+        self.alive = 0
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.brands = np.zeros(0, dtype=np.int32)
+        self.models = np.zeros(0, dtype=np.int32)
+        self.years = np.zeros(0, dtype=np.float32)
+        self.prices = np.zeros(0, dtype=np.float32)
+        self.live = np.zeros(0, dtype=bool)
+        self.brand_codes = {}
+        self.model_codes = {}
+        self.version = None
+        # Ultima entrada de CarChange aplicada
+        self.change_id = 0
+
+    # Filas
+
+    def _grow(self, needed):
+        capacity = len(self.ids)
+        if self.size + needed <= capacity:
+            return
+        capacity = max(1024, capacity * 2, self.size + needed)
+        for name in ('ids', 'brands', 'models', 'years', 'prices', 'live'):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            setattr(self, name, grown)
+
+    def _code(self, codes, key):
+        code = codes.get(key)
+        if code is None:
+            code = codes[key] = len(codes)
+        return code
+
+    def _row(self, car_id):
+        # Posicion de car_id (los ids se guardan ordenados) o None
+        position = int(np.searchsorted(self.ids[:self.size], car_id))
+        if position < self.size and self.ids[position] == car_id:
+            return position
+        return None
+
+    def upsert(self, rows):
+        # rows: iterable de (id, brand, model, year, price)
+        with self._lock:
+            for car_id, brand, model, year, price in rows:
+                position = self._row(car_id)
+                if position is None:
+                    self._grow(1)
+                    position = self.size
+                    if self.size and car_id < self.ids[self.size - 1]:
+                        # Id antiguo que no estaba en el indice: se inserta en orden
+                        position = int(np.searchsorted(self.ids[:self.size], car_id))
+                        for array in (self.ids, self.brands, self.models, self.years, self.prices, self.live):
+                            array[position + 1:self.size + 1] = array[position:self.size]
+                    self.size += 1
+                    self.alive += 1
+                elif not self.live[position]:
+                    self.alive += 1
+                self.ids[position] = car_id
+                self.brands[position] = self._code(self.brand_codes, brand)
+                self.models[position] = self._code(self.model_codes, (brand, model))
+                self.years[position] = int(year) / YEAR_SCALE
+                self.prices[position] = price_feature(price)
+                self.live[position] = True
+
+    def remove(self, car_ids):
+        with self._lock:
+            for car_id in car_ids:
+                position = self._row(car_id)
+                if position is not None and self.live[position]:
+                    self.live[position] = False
+                    self.alive -= 1
+            # Compacta cuando mas de la mitad de las filas estan borradas
+            if self.size > 1024 and self.alive < self.size // 2:
+                self._compact()
+
+    def _compact(self):
+        keep = np.flatnonzero(self.live[:self.size])
+        for name in ('ids', 'brands', 'models', 'years', 'prices', 'live'):
+            setattr(self, name, getattr(self, name)[keep].copy())
+        self.size = self.alive = len(keep)
+
+    # Consulta
+
+    def similar(self, car_id, k):
+        # Ids de los k anuncios mas parecidos a car_id, del mas al menos
+        # parecido, o None si car_id no esta en el indice
+        weights = settings.CARBUY_SIMILAR_WEIGHTS
+        with self._lock:
+            position = self._row(car_id)
+            if position is None or not self.live[position]:
+                return None
+            size = self.size
+            distance = (self.brands[:size] != self.brands[position]) * np.float32(2 * weights['brand'])
+            distance += (self.models[:size] != self.models[position]) * np.float32(2 * weights['model'])
+            distance += np.square(self.years[:size] - self.years[position]) * np.float32(weights['year'])
+            distance += np.square(self.prices[:size] - self.prices[position]) * np.float32(weights['price'])
+            distance[~self.live[:size]] = np.inf
+            distance[position] = np.inf
+            # Copia: upsert() desplaza los ids en su sitio al insertar uno antiguo
+            ids = self.ids[:size].copy()
+            k = min(k, self.alive - 1)
+
+        if k <= 0:
+            return []
+        nearest = np.argpartition(distance, k - 1)[:k]
+        # Empates por distancia: primero el id mas bajo
+        nearest = nearest[np.lexsort((ids[nearest], distance[nearest]))]
+        return [int(car_id) for car_id in ids[nearest]]
+
+    # Sincronizacion con la base de datos
+
+    def rebuild(self, version):
+        # Carga completa: las columnas se leen en listas y se convierten de una
+        # vez, mucho mas rapido que upsert() fila a fila
+        with self._lock:
+            self.clear()
+            # Los cambios posteriores se aplicaran en la siguiente sincronizacion
+            change_id = CarChange.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            ids, brands, models, years, prices = [], [], [], [], []
+            for car_id, brand, model, year, price in (
+                    Car.objects.order_by('id').values_list(*FIELDS).iterator(chunk_size=10000)):
+                ids.append(car_id)
+                brands.append(self._code(self.brand_codes, brand))
+                models.append(self._code(self.model_codes, (brand, model)))
+                years.append(year)
+                prices.append(price)
+            self.size = self.alive = len(ids)
+            self.ids = np.array(ids, dtype=np.int64)
+            self.brands = np.array(brands, dtype=np.int32)
+            self.models = np.array(models, dtype=np.int32)
+            self.years = (np.array(years, dtype=np.float64) / YEAR_SCALE).astype(np.float32)
+            self.prices = (np.log1p(np.maximum(np.array(prices, dtype=np.float64), 0)) / PRICE_SCALE).astype(np.float32)
+            self.live = np.ones(self.size, dtype=bool)
+            self.version = version
+            self.change_id = change_id
+            self.loaded = True
+
+    def sync(self, version):
+        # Aplica los cambios hechos desde la ultima sincronizacion (tambien por
+        # otros procesos) a partir del registro de cambios
+        with self._lock:
+            if version == self.version:
+                return
+            if pruned_through() > self.change_id:
+                # compact_changes ha borrado bajas que no se habian aplicado
+                self.rebuild(version)
+                return
+            while True:
+                entries = list(CarChange.objects.filter(id__gt=self.change_id).order_by('id')
+                               .values_list('id', 'car_id', 'deleted')[:SYNC_BATCH_SIZE])
+                if not entries:
+                    break
+                latest = {car_id: deleted for entry_id, car_id, deleted in entries}
+                changed = [car_id for car_id, deleted in latest.items() if not deleted]
+                rows = list(Car.objects.filter(id__in=changed).values_list(*FIELDS)) if changed else []
+                # Los que ya no existen se borraron despues: su baja llega en otra entrada
+                found = {row[0] for row in rows}
+                self.upsert(rows)
+                self.remove([car_id for car_id, deleted in latest.items() if deleted or car_id not in found])
+                self.change_id = entries[-1][0]
+            self.version = version
+
+    def save(self, path):
+        # Escribe el snapshot en un fichero temporal y lo renombra, para que un
+        # proceso que este cargandolo nunca lea un fichero a medias
+        with self._lock:
+            live = self.live[:self.size]
+            brands = sorted(self.brand_codes, key=self.brand_codes.get)
+            models = sorted(self.model_codes, key=self.model_codes.get)
+            arrays = {
+                'ids': self.ids[:self.size][live],
+                'brands': self.brands[:self.size][live],
+                'models': self.models[:self.size][live],
+                'years': self.years[:self.size][live],
+                'prices': self.prices[:self.size][live],
+                'brand_names': np.array(brands, dtype=str),
+                'model_brands': np.array([brand for brand, model in models], dtype=str),
+                'model_names': np.array([model for brand, model in models], dtype=str),
+                'state': np.array([self.version or 0], dtype=np.int64),
+                'change_id': np.array([self.change_id], dtype=np.int64),
+            }
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary, 'wb') as snapshot:
+            np.savez_compressed(snapshot, **arrays)
+        os.replace(temporary, path)
+
+    def load(self, path):
+        with np.load(path, allow_pickle=False) as snapshot:
+            if 'change_id' not in snapshot.files:
+                # Snapshot anterior al registro de cambios: no se puede poner al dia
+                return
+            with self._lock:
+                self.clear()
+                self.size = self.alive = len(snapshot['ids'])
+                self.ids = snapshot['ids'].astype(np.int64)
+                self.brands = snapshot['brands'].astype(np.int32)
+                self.models = snapshot['models'].astype(np.int32)
+                self.years = snapshot['years'].astype(np.float32)
+                self.prices = snapshot['prices'].astype(np.float32)
+                self.live = np.ones(self.size, dtype=bool)
+                self.brand_codes = {str(name): code for code, name in enumerate(snapshot['brand_names'])}
+                self.model_codes = {
+                    (str(brand), str(model)): code
+                    for code, (brand, model) in enumerate(zip(snapshot['model_brands'], snapshot['model_names']))
+                }
+                self.version = int(snapshot['state'][0])
+                self.change_id = int(snapshot['change_id'][0])
+                self.loaded = True
+
+    def ensure_loaded(self, version):
+        # Primera consulta del proceso: snapshot si existe (lo escribe manage.py
+        # build_similar_index) y si no, carga completa desde la base de datos
+        with self._lock:
+            if self.loaded:
+                return
+            path = settings.CARBUY_SIMILAR_SNAPSHOT
+            if path and os.path.exists(path):
+                self.load(path)
+            if not self.loaded:
+                self.rebuild(version)
+
+
+similar_index = SimilarityIndex() if np is not None else None
+
+
+def similar_car_ids(car_id, k, version):
+    # Devuelve los ids similares a car_id, o None si car_id no existe
+    similar_index.ensure_loaded(version)
+    similar_index.sync(version)
+    return similar_index.similar(car_id, k)
+
+
+# Señales: solo actualizan el indice si ya esta cargado, y despues del
+# commit para no guardar cambios que se deshagan
+
+def _row(car):
+    return car.pk, car.brand, car.model, car.year, car.price
+
+
+@receiver(post_save, sender=Car)
+def update_on_save(sender, instance, **kwargs):
+    if similar_index is not None and similar_index.loaded:
+        row = _row(instance)
+        transaction.on_commit(lambda: similar_index.upsert([row]))
+
+
+@receiver(post_delete, sender=Car)
+def update_on_delete(sender, instance, **kwargs):
+    if similar_index is not None and similar_index.loaded:
+        car_id = instance.pk
+        transaction.on_commit(lambda: similar_index.remove([car_id]))
+
+
+@receiver(cars_bulk_created, sender=Car)
+def update_on_bulk_create(sender, cars, **kwargs):
+    if similar_index is not None and similar_index.loaded:
+        rows = [_row(car) for car in cars]
+        transaction.on_commit(lambda: similar_index.upsert(rows))
+
+
+@receiver(setting_changed)
+def reset_index(setting, **kwargs):
+    if setting == 'CARBUY_SIMILAR_SNAPSHOT' and similar_index is not None:
+        similar_index.reset()
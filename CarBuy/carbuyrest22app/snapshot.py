@@ -0,0 +1,257 @@
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+from django.http import FileResponse
+
+from .catalog import catalog_state
+from .export import accepts_encoding
+from .models import Car
+from .serializers import AD_LIST_FIELDS, ad_list_row, stream_json_array
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Copia del listado completo de get_ads en disco, ya serializada y comprimida
+# (gzip y, si el modulo brotli esta instalado, brotli). El listado incluye
+# favourite_count, asi que los ficheros llevan en el nombre la version del
+# catalogo y la de los favoritos (catalog-<version>-<favoritos>.json), las
+# mismas que su ETag (ver catalog.py). get_ads sirve el de las versiones
+# actuales abriendo un fichero con FileResponse (sendfile si el servidor lo
+# admite), sin consultar los anuncios ni serializarlos. Si no existe, porque
+# el catalogo o los favoritos han cambiado desde la ultima copia, se genera el
+# listado como siempre.
+#
+# Cada alta, modificacion o baja de un anuncio o de un favorito programa una
+# nueva copia tras el commit (ver signals.py). Las rafagas de escrituras se
+# agrupan: la copia se genera cuando pasan DEBOUNCE segundos sin cambios, o
+# como mucho MAX_DELAY segundos despues del primero. Cada
+# fichero se escribe en un temporal del mismo directorio y se publica con
+# os.replace, que es atomico.
+#
+# Con varios procesos, solo genera la copia el que consigue el cerrojo del
+# fichero .build.lock del directorio; el resto lo vuelve a intentar pasados
+# DEBOUNCE segundos y no hace nada si las versiones actuales ya tienen copia,
+# asi que cada par de versiones se genera una sola vez. Las copias automaticas usan niveles
+# de compresion bajos (AUTO_GZIP_LEVEL, AUTO_BROTLI_QUALITY) para que duren
+# poco; manage.py build_catalog_snapshot, pensado para un cron o el
+# despliegue, usa GZIP_LEVEL y BROTLI_QUALITY. Con AUTO = False solo la
+# genera el comando.
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_NAME = re.compile(r'catalog-(\d+)-(\d+)\.json')
+
+LOCK_NAME = '.build.lock'
+
+# (extension, Content-Encoding) por orden de preferencia
+ENCODINGS = (('.br', 'br'), ('.gz', 'gzip'), ('', None))
+
+
+class SnapshotBusy(Exception):
+    # Otro proceso esta generando una copia
+    pass
+
+
+def snapshot_key(state):
+    # (version del catalogo, version de los favoritos) de un catalog_state()
+    return state[0], state[2]
+
+
+def snapshot_path(directory, key, suffix=''):
+    return os.path.join(directory, 'catalog-%d-%d.json%s' % (key + (suffix,)))
+
+
+@contextmanager
+def _build_lock(directory):
+    # Cerrojo exclusivo entre procesos; sin fcntl (Windows) no se bloquea
+    with open(os.path.join(directory, LOCK_NAME), 'a') as lock_file:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise SnapshotBusy()
+        yield
+
+
+class _GzipWriter:
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def process(self, chunk):
+        return self.compressor.compress(chunk)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class _BrotliWriter:
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def process(self, chunk):
+        return self.compressor.process(chunk)
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+def build_catalog_snapshot(directory=None, gzip_level=None, brotli_quality=None, skip_existing=False):
+    # Genera las copias de las versiones actuales y borra las anteriores.
+    # Devuelve {extension: bytes}, {} si skip_existing y ya tienen copia, o
+    # None si el catalogo o los favoritos han cambiado mientras se leia (la
+    # escritura que los ha cambiado ya habra programado otra copia). Lanza SnapshotBusy si otro
+    # proceso esta generando una.
+    config = settings.CARBUY_CATALOG_SNAPSHOT
+    directory = directory or config['DIRECTORY']
+    os.makedirs(directory, exist_ok=True)
+    with _build_lock(directory):
+        key = snapshot_key(catalog_state())
+        if skip_existing and os.path.exists(snapshot_path(directory, key)):
+            return {}
+        sizes = _write_snapshot(directory, key, config['GZIP_LEVEL'] if gzip_level is None else gzip_level,
+                                config['BROTLI_QUALITY'] if brotli_quality is None else brotli_quality)
+    if sizes is None:
+        return None
+
+    # Borra las copias anteriores (no las posteriores, que puede haber
+    # publicado otro proceso: ninguna de sus dos versiones es menor). Las
+    # peticiones que ya tengan abierta una copia antigua la siguen leyendo.
+    for name in os.listdir(directory):
+        match = SNAPSHOT_NAME.match(name)
+        if match:
+            other = (int(match.group(1)), int(match.group(2)))
+            if other != key and other[0] <= key[0] and other[1] <= key[1]:
+                os.unlink(os.path.join(directory, name))
+    return sizes
+
+
+def _write_snapshot(directory, key, gzip_level, brotli_quality):
+    writers = {'': None, '.gz': _GzipWriter(gzip_level)}
+    if brotli is not None:
+        writers['.br'] = _BrotliWriter(brotli_quality)
+
+    files = {suffix: tempfile.NamedTemporaryFile(dir=directory, prefix='.catalog-', delete=False)
+             for suffix in writers}
+    try:
+        rows = Car.objects.values_list(*AD_LIST_FIELDS).order_by('id').iterator(
+            chunk_size=settings.CARBUY_STREAM_CHUNK_SIZE)
+        for chunk in stream_json_array(ad_list_row(row) for row in rows):
+            for suffix, writer in writers.items():
+                files[suffix].write(writer.process(chunk) if writer else chunk)
+        for suffix, writer in writers.items():
+            if writer:
+                files[suffix].write(writer.finish())
+            files[suffix].close()
+
+        # Las filas se han leido en varias consultas: solo son de esas versiones
+        # si no ha habido ningun commit entretanto
+        if snapshot_key(catalog_state()) != key:
+            return None
+        sizes = {}
+        # El JSON sin comprimir el ultimo: su existencia indica que las versiones ya tienen copia
+        for suffix in sorted(files, key=len, reverse=True):
+            sizes[suffix] = os.path.getsize(files[suffix].name)
+            os.replace(files[suffix].name, snapshot_path(directory, key, suffix))
+        return sizes
+    finally:
+        for temporary in files.values():
+            temporary.close()
+            if os.path.exists(temporary.name):
+                os.unlink(temporary.name)
+
+
+def snapshot_response(request, state, etag):
+    # FileResponse con la copia del estado del catalogo state (catalog_state())
+    # en la mejor codificacion que admita el cliente, o None si no hay copia
+    directory = settings.CARBUY_CATALOG_SNAPSHOT['DIRECTORY']
+    if not directory:
+        return None
+    for suffix, encoding in ENCODINGS:
+        if encoding and not accepts_encoding(request, encoding):
+            continue
+        try:
+            snapshot = open(snapshot_path(directory, snapshot_key(state), suffix), 'rb')
+        except FileNotFoundError:
+            continue
+        response = FileResponse(snapshot, content_type='application/json')
+        response['Vary'] = 'Accept-Encoding'
+        if encoding:
+            # Cada codificacion es una representacion distinta: ETag debil,
+            # como GZipMiddleware, para que If-None-Match siga funcionando
+            response['Content-Encoding'] = encoding
+            response['ETag'] = 'W/%s' % etag
+        return response
+    return None
+
+
+class SnapshotScheduler:
+    def __init__(self, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._thread = None
+        self._first = None
+        self._last = None
+
+    def schedule(self):
+        # Pide una copia nueva; se genera en un hilo cuando se calman las escrituras
+        config = settings.CARBUY_CATALOG_SNAPSHOT
+        if not config['DIRECTORY'] or not config['AUTO']:
+            return
+        now = self.clock()
+        with self._lock:
+            self._last = now
+            if self._first is None:
+                self._first = now
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='catalog-snapshot', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        config = settings.CARBUY_CATALOG_SNAPSHOT
+        try:
+            while True:
+                with self._lock:
+                    if self._first is None:
+                        self._thread = None
+                        return
+                    wait = min(self._last + config['DEBOUNCE'], self._first + config['MAX_DELAY']) - self.clock()
+                    if wait <= 0:
+                        # Lo que se escriba a partir de aqui programa la siguiente copia
+                        self._first = self._last = None
+                if wait > 0:
+                    self.sleep(wait)
+                    continue
+                try:
+                    build_catalog_snapshot(gzip_level=config['AUTO_GZIP_LEVEL'],
+                                           brotli_quality=config['AUTO_BROTLI_QUALITY'], skip_existing=True)
+                except SnapshotBusy:
+                    # Otro proceso esta generando una copia, quiza de una version
+                    # anterior: se vuelve a intentar
+                    with self._lock:
+                        now = self.clock()
+                        self._last = now
+                        if self._first is None:
+                            self._first = now
+                except Exception:
+                    logger.exception('Error generating the catalog snapshot')
+        finally:
+            connection.close()
+
+
+snapshot_scheduler = SnapshotScheduler()
@@ -1,3 +1,1496 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import itertools
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock, skipUnless
+import bcrypt
+from decimal import Decimal
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection
+from django.http import FileResponse
+from django.test import TestCase, override_settings
+from django.urls import resolve
 
-# Create your tests here.
+from .benchmarks import AsyncURLConf, compare_results, measure_profile, route_scenarios, seed_dataset
+from .caching import DjangoCache, LRUCache, ResultCache
+from .changes import compact_changes
+from .catalog import catalog_state
+from .details import ad_cache, seller_cache
+from .export import export_chunks
+from .facets import compute_facets, price_bucket, stored_facets
+from .favourites import most_favourited
+from .filters import SORT_ORDERS, filter_cars
+from .hashing import HashingBusy, HashingPool, pool
+from .instrumentation import metrics
+from .models import Car, CarChange, CarNeighbour, FavouriteCar, StaleNeighbours, User
+from .search import search_cache
+from .serializers import dumps
+from .cooccurrence import np as neighbours_numpy
+from .ratelimit import admission
+from .signals import cars_bulk_created
+from .snapshot import (
+    LOCK_NAME, SnapshotBusy, SnapshotScheduler, brotli, build_catalog_snapshot, fcntl, snapshot_scheduler
+)
+from .similar import similar_index
+from .tokens import revocations
+
+
+def create_user(email='seller@mail.com', **kwargs):
+    data = {
+        'email': email,
+        'name': 'Seller',
+        'encrypted_password': 'not-a-hash',
+        'birthdate': '2000-01-01',
+        'phone': '123456789',
+    }
+    data.update(kwargs)
+    return User.objects.create(**data)
+
+
+def create_cars(user, count, **kwargs):
+    cars = [
+        Car(
+            brand=kwargs.get('brand', 'Volkswagen'),
+            model=kwargs.get('model', 'Golf %d' % i),
+            year=kwargs.get('year', 2000 + i % 20),
+            price=kwargs.get('price', 1000 + i),
+            description=kwargs.get('description', 'A good car to drive'),
+            user=user
+        )
+        for i in range(count)
+    ]
+    return Car.objects.bulk_create(cars)
+
+
+@override_settings(CARBUY_SIMILAR_SNAPSHOT=None,
+                   CARBUY_CATALOG_SNAPSHOT=dict(settings.CARBUY_CATALOG_SNAPSHOT, DIRECTORY=''))
+class CarBuyTestCase(TestCase):
+    # La base de datos vuelve a su estado inicial en cada test, asi que las
+    # versiones del catalogo se repiten: las caches del proceso deben vaciarse
+    def setUp(self):
+        super().setUp()
+        search_cache.reset()
+        ad_cache.reset()
+        seller_cache.reset()
+        admission.reset()
+        if similar_index is not None:
+            similar_index.reset()
+
+
+class GetAdsTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user()
+        self.cars = create_cars(self.user, 7)
+
+    def test_full_listing_is_streamed(self):
+        response = self.client.get('/get_ads/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([car['id'] for car in data], [car.id for car in self.cars])
+        self.assertEqual(data[0]['price'], '1000.00')
+
+    def test_keyset_pages(self):
+        seen = []
+        cursor = 0
+        while cursor is not None:
+            response = self.client.get('/get_ads/', {'limit': 3, 'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            self.assertLessEqual(len(page['cars']), 3)
+            seen.extend(car['id'] for car in page['cars'])
+            cursor = page['next_cursor']
+        self.assertEqual(seen, [car.id for car in self.cars])
+
+    def test_invalid_pagination(self):
+        response = self.client.get('/get_ads/', {'limit': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+
+class SearchCarsTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user()
+        self.golf = Car.objects.create(brand='Volkswagen', model='Golf GTI', year=2006, price=9000,
+                                       description='A good car to drive', user=self.user)
+        self.bmw = Car.objects.create(brand='BMW', model='320d', year=2015, price=15000,
+                                      description='Cheaper to run than a Golf', user=self.user)
+
+    def search(self, **params):
+        response = self.client.get('/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_ranks_brand_and_model_above_description(self):
+        data = self.search(q='golf')
+        self.assertEqual([car['car_id'] for car in data['cars']], [self.golf.id, self.bmw.id])
+
+    def test_prefix_and_description_terms(self):
+        self.assertEqual([car['car_id'] for car in self.search(q='volks')['cars']], [self.golf.id])
+        self.assertEqual([car['car_id'] for car in self.search(q='cheaper')['cars']], [self.bmw.id])
+
+    def test_index_follows_updates_and_deletes(self):
+        self.golf.model = 'Polo'
+        self.golf.save()
+        self.assertEqual([car['car_id'] for car in self.search(q='polo')['cars']], [self.golf.id])
+        self.bmw.delete()
+        self.assertEqual(self.search(q='cheaper')['cars'], [])
+
+    def test_pagination(self):
+        data = self.search(q='golf', limit=1)
+        self.assertEqual(len(data['cars']), 1)
+        self.assertEqual(data['next_page'], 2)
+        data = self.search(q='golf', limit=1, page=2)
+        self.assertEqual(data['cars'][0]['car_id'], self.bmw.id)
+        self.assertIsNone(data['next_page'])
+
+    def test_query_syntax_is_ignored(self):
+        self.assertEqual(self.search(q='"golf*" (')['cars'][0]['car_id'], self.golf.id)
+        self.assertEqual(self.search(q='***')['cars'], [])
+
+
+class QueryCountTests(CarBuyTestCase):
+    # El numero de consultas de cada endpoint no debe depender del volumen de datos
+
+    def seed_favourites(self, email, count):
+        user = create_user(email=email, token=email)
+        cars = create_cars(create_user(email='seller-' + email), count)
+        FavouriteCar.objects.bulk_create(FavouriteCar(user=user, car=car) for car in cars)
+        return user
+
+    def test_get_favourites_constant_queries(self):
+        for count in (5, 200):
+            user = self.seed_favourites('fan%d@mail.com' % count, count)
+            with self.assertNumQueries(2):
+                response = self.client.get('/get_favourites/', headers={'sessionToken': user.token})
+            data = response.json()
+            self.assertEqual(len(data), count)
+            self.assertEqual(data[0]['user_name'], user.name)
+
+    def test_ad_details_constant_queries(self):
+        # Una consulta, con join, para el anuncio y su vendedor (el ETag sale de
+        # la misma fila); las siguientes peticiones se sirven de la cache
+        car = create_cars(create_user(), 1)[0]
+        with self.assertNumQueries(1):
+            response = self.client.get('/ad/%d/' % car.id)
+        self.assertEqual(response.json()['user'], {'name': 'Seller', 'phone': '123456789'})
+
+    def test_ad_details_not_found(self):
+        response = self.client.get('/ad/999/')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CARBUY_SIGNED_TOKENS=True, CARBUY_REVOCATION_REFRESH=0, CARBUY_BCRYPT_ROUNDS=4)
+class SignedTokenTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        hashed = bcrypt.hashpw(b'1234', bcrypt.gensalt(4)).decode('utf8')
+        self.user = create_user(email='jose@mail.com', encrypted_password=hashed)
+        revocations.reload()
+
+    def login(self, password='1234'):
+        response = self.client.post('/sessions/', {'email': 'jose@mail.com', 'password': password},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['sessionToken']
+
+    def get_user(self, token):
+        return self.client.get('/get_user/', headers={'sessionToken': token})
+
+    def test_login_does_not_write_user_row(self):
+        token = self.login()
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.token)
+        response = self.get_user(token)
+        self.assertEqual(response.json()['id'], self.user.id)
+
+    @override_settings(CARBUY_REVOCATION_REFRESH=60)
+    def test_verified_without_token_lookup(self):
+        token = self.login()
+        with self.assertNumQueries(1):
+            response = self.client.get('/get_favourites/', headers={'sessionToken': token})
+        self.assertEqual(response.json(), [])
+
+    def test_tampered_token_is_rejected(self):
+        token = self.login()
+        user_id, rest = token.split('.', 1)
+        self.assertEqual(self.get_user('%d.%s' % (int(user_id) + 1, rest)).status_code, 404)
+
+    def test_logout_revokes_token(self):
+        token = self.login()
+        other = self.login()
+        response = self.client.delete('/sessions/', headers={'sessionToken': token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_user(token).status_code, 404)
+        self.assertEqual(self.get_user(other).status_code, 200)
+
+    def test_password_change_revokes_previous_tokens(self):
+        token = self.login()
+        response = self.client.post('/password/', {'current_password': '1234', 'new_password': '5678'},
+                                    content_type='application/json', headers={'sessionToken': token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_user(token).status_code, 404)
+        self.assertEqual(self.get_user(response.json()['sessionToken']).status_code, 200)
+        self.login('5678')
+
+
+@override_settings(CARBUY_BCRYPT_ROUNDS=4)
+class PasswordHashingTests(CarBuyTestCase):
+    def register(self):
+        return self.client.post('/users/', {'name': 'Jose', 'mail': 'jose@mail.com', 'password': '1234',
+                                            'birthdate': '2000-01-01', 'phone': '123456789'},
+                                content_type='application/json')
+
+    def test_register_uses_configured_cost(self):
+        self.assertEqual(self.register().status_code, 200)
+        self.assertTrue(User.objects.get().encrypted_password.startswith('$2b$04$'))
+
+    def test_login_rehashes_when_cost_changes(self):
+        self.register()
+        with self.settings(CARBUY_BCRYPT_ROUNDS=5):
+            response = self.client.post('/sessions/', {'email': 'jose@mail.com', 'password': '1234'},
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        hashed = User.objects.get().encrypted_password
+        self.assertTrue(hashed.startswith('$2b$05$'))
+        self.assertTrue(bcrypt.checkpw(b'1234', hashed.encode('utf8')))
+
+    def test_busy_pool_rejects_immediately(self):
+        with mock.patch.object(pool, 'run', side_effect=HashingBusy):
+            response = self.register()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(User.objects.exists())
+
+    def test_pool_rejects_when_every_worker_is_busy(self):
+        release = threading.Event()
+        pool.run(len, '')
+        slots = pool._slots._value
+        self.assertEqual(slots, settings.CARBUY_HASH_WORKERS + settings.CARBUY_HASH_QUEUE_DEPTH)
+        blockers = [threading.Thread(target=pool.run, args=(release.wait,)) for _ in range(slots)]
+        for blocker in blockers:
+            blocker.start()
+        while pool._slots._value:
+            time.sleep(0.001)
+        try:
+            with self.assertRaises(HashingBusy):
+                pool.run(len, '')
+        finally:
+            release.set()
+            for blocker in blockers:
+                blocker.join()
+
+    def test_pool_queue_depth_adds_slots(self):
+        queued = HashingPool()
+        with self.settings(CARBUY_HASH_WORKERS=2, CARBUY_HASH_QUEUE_DEPTH=3):
+            queued.run(len, '')
+        # Espera a que el hilo devuelva su plaza
+        queued._executor.shutdown()
+        self.assertEqual(queued._slots._value, 5)
+
+
+class AsyncEndpointTests(CarBuyTestCase):
+    # Las versiones asincronas deben responder igual que las sincronas
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user(token='0123456789abcdef0123')
+        self.cars = create_cars(self.user, 5)
+        FavouriteCar.objects.create(user=self.user, car=self.cars[0])
+
+    async def compare(self, url, params=None):
+        headers = {'sessionToken': self.user.token}
+        expected = await self.async_client.get(url, params, headers=headers)
+        with override_settings(ROOT_URLCONF=AsyncURLConf):
+            response = await self.async_client.get(url, params, headers=headers)
+        self.assertEqual(response.status_code, expected.status_code)
+        if response.streaming:
+            body = b''.join([chunk async for chunk in response.streaming_content])
+            expected_body = await sync_to_async(b''.join)(expected.streaming_content)
+        else:
+            body, expected_body = response.content, expected.content
+        self.assertEqual(json.loads(body), json.loads(expected_body))
+
+    async def test_same_responses(self):
+        await self.compare('/account/')
+        await self.compare('/search/', {'q': 'golf', 'limit': 2})
+        await self.compare('/ad/%d/' % self.cars[1].id)
+        await self.compare('/ad/999/')
+        await self.compare('/get_favourites/')
+        await self.compare('/get_ads/')
+        await self.compare('/get_ads/', {'limit': 2, 'cursor': self.cars[1].id})
+        await self.compare('/get_user/')
+
+    @override_settings(ROOT_URLCONF=AsyncURLConf, CARBUY_SEARCH_CACHE={'BACKEND': 'django'})
+    async def test_search_uses_the_async_cache_api(self):
+        # Con una cache compartida get y set bloquearian el bucle de eventos
+        with mock.patch.object(DjangoCache, 'get', side_effect=AssertionError), \
+                mock.patch.object(DjangoCache, 'set', side_effect=AssertionError):
+            first = await self.async_client.get('/search/', {'q': 'golf'})
+            second = await self.async_client.get('/search/', {'q': 'golf'})
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(search_cache.stats(), {'hits': 1, 'misses': 1})
+
+
+class FilterAdsTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user()
+        create_cars(self.user, 20, brand='Volkswagen')
+        create_cars(self.user, 20, brand='BMW', model='320d')
+
+    def test_filters_and_sort(self):
+        response = self.client.get('/filter_ads/', {'brand': 'Volkswagen', 'year_min': 2005, 'year_max': 2010,
+                                                    'price_max': '1015', 'sort': '-price'})
+        self.assertEqual(response.status_code, 200)
+        cars = response.json()['cars']
+        self.assertEqual([car['price'] for car in cars], ['1010.00', '1009.00', '1008.00',
+                                                          '1007.00', '1006.00', '1005.00'])
+        self.assertTrue(all(car['brand'] == 'Volkswagen' for car in cars))
+
+    def test_pagination(self):
+        response = self.client.get('/filter_ads/', {'model': '320d', 'sort': 'price', 'limit': 15, 'page': 2})
+        data = response.json()
+        self.assertEqual(len(data['cars']), 5)
+        self.assertIsNone(data['next_page'])
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get('/filter_ads/', {'year_min': 'new'}).status_code, 400)
+        self.assertEqual(self.client.get('/filter_ads/', {'sort': 'name'}).status_code, 400)
+
+    def test_supported_filters_use_an_index(self):
+        # Ninguna combinacion de filtros admitida puede acabar recorriendo la tabla entera
+        values = {
+            'brand': {'brand': 'BMW'},
+            'model': {'model': '320d'},
+            'year': {'year_min': 2005, 'year_max': 2010},
+            'price': {'price_min': Decimal('1000'), 'price_max': Decimal('5000')},
+        }
+        table_scan = re.compile(r'SCAN %s(?! USING)' % Car._meta.db_table)
+        for size in range(1, len(values) + 1):
+            for combination in itertools.combinations(values, size):
+                filters = {}
+                for name in combination:
+                    filters.update(values[name])
+                for sort in SORT_ORDERS:
+                    plan = filter_cars(filters, sort).explain()
+                    self.assertIsNone(table_scan.search(plan), '%s %s: %s' % (combination, sort, plan))
+
+
+class BulkIngestTests(CarBuyTestCase):
+    def test_ndjson_upload_reports_each_line(self):
+        user = create_user()
+        ad = {'brand': 'Volkswagen', 'model': 'Golf', 'year': 2006, 'price': 9000,
+              'description': 'A good car to drive', 'image_url': 'https://example.com/golf.jpg', 'user_id': user.id}
+        lines = [
+            json.dumps(ad),
+            'not json',
+            json.dumps(dict(ad, user_id=user.id + 100)),
+            '',
+            json.dumps(dict(ad, model='Polo', price='12000.50')),
+            json.dumps(dict(ad, year=None)),
+        ]
+        response = self.client.post('/ad_management/', '\n'.join(lines), content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertEqual((report['created'], report['failed']), (2, 3))
+        self.assertEqual([result['line'] for result in report['results']], [1, 2, 3, 5, 6])
+        self.assertEqual(report['results'][1]['error'], 'Invalid JSON')
+        self.assertEqual(report['results'][2]['error'], 'User not found')
+        polo = Car.objects.get(id=report['results'][3]['id'])
+        self.assertEqual((polo.model, polo.price), ('Polo', Decimal('12000.50')))
+
+    def test_invalid_field_types_fail_their_line(self):
+        user = create_user()
+        ad = {'brand': 'Seat', 'model': 'Ibiza', 'year': 2010, 'price': 5000,
+              'description': 'Small car', 'image_url': 'https://example.com/ibiza.jpg', 'user_id': user.id}
+        lines = [
+            dict(ad, brand={'x': 1}),
+            dict(ad, model='x' * 101),
+            dict(ad, image_url=['https://example.com']),
+            dict(ad, year=True),
+            dict(ad, year=2010.5),
+            dict(ad, user_id=' %d ' % user.id),
+            dict(ad, year='2010'),
+        ]
+        response = self.client.post('/ad_management/', '\n'.join(map(json.dumps, lines)),
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertEqual((report['created'], report['failed']), (1, 6))
+        self.assertEqual([result.get('error') for result in report['results'][:6]], [
+            'Invalid brand', 'Invalid model', 'Invalid image_url',
+            'Invalid year or user_id', 'Invalid year or user_id', 'Invalid year or user_id',
+        ])
+        self.assertEqual(Car.objects.get(id=report['results'][6]['id']).year, 2010)
+
+    @override_settings(CARBUY_BULK_BATCH_SIZE=10)
+    def test_batches_resolve_each_user_once(self):
+        users = [create_user(email='dealer%d@mail.com' % i) for i in range(3)]
+        ad = {'brand': 'BMW', 'model': '320d', 'year': 2015, 'price': 15000,
+              'description': 'Diesel', 'image_url': 'https://example.com/bmw.jpg'}
+        body = '\n'.join(json.dumps(dict(ad, user_id=users[i % 3].id)) for i in range(50))
+        # Con las filas de facetas ya creadas, cada lote cuesta lo mismo
+        Car.objects.create(user=users[0], **ad)
+        # Una sola consulta de usuarios y 5 lotes, cada uno en una transaccion con el
+        # bulk_create, la version del catalogo, una actualizacion por faceta afectada
+        # y el registro de cambios
+        with self.assertNumQueries(1 + 5 * (4 + 4)):
+            response = self.client.post('/ad_management/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.json()['created'], 50)
+        self.assertEqual(Car.objects.count(), 51)
+
+
+class ConditionalGetTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user()
+        self.car = Car.objects.create(brand='Volkswagen', model='Golf', year=2006, price=9000,
+                                      description='A good car to drive', user=self.user)
+
+    def revalidate(self, url, response, **params):
+        return self.client.get(url, params, headers={'If-None-Match': response['ETag']})
+
+    def test_catalog_not_modified_until_an_ad_changes(self):
+        for url, params in (('/get_ads/', {}), ('/search/', {'q': 'golf'})):
+            first = self.client.get(url, params)
+            self.assertEqual(first.status_code, 200)
+            self.assertIn('Last-Modified', first)
+            with self.assertNumQueries(1):
+                second = self.revalidate(url, first, **params)
+            self.assertEqual(second.status_code, 304)
+            self.assertEqual(second.content, b'')
+
+        first = self.client.get('/get_ads/')
+        Car.objects.create(brand='BMW', model='320d', year=2015, price=15000, description='Diesel', user=self.user)
+        self.assertEqual(self.revalidate('/get_ads/', first).status_code, 200)
+
+    def test_ad_details_validators(self):
+        url = '/ad/%d/' % self.car.id
+        first = self.client.get(url)
+        self.assertEqual(self.revalidate(url, first).status_code, 304)
+        modified_since = self.client.get(url, headers={'If-Modified-Since': first['Last-Modified']})
+        self.assertEqual(modified_since.status_code, 304)
+
+        self.user.phone = '987654321'
+        self.user.save()
+        changed = self.revalidate(url, first)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+
+    def test_updates_and_bulk_uploads_bump_catalog_version(self):
+        versions = [catalog_state()[0]]
+        self.car.price = 8500
+        self.car.save()
+        versions.append(catalog_state()[0])
+        ad = {'brand': 'BMW', 'model': '320d', 'year': 2015, 'price': 15000, 'description': 'Diesel',
+              'image_url': 'https://example.com/bmw.jpg', 'user_id': self.user.id}
+        self.client.post('/ad_management/', json.dumps(ad), content_type='application/x-ndjson')
+        versions.append(catalog_state()[0])
+        self.car.delete()
+        versions.append(catalog_state()[0])
+        self.assertEqual(versions, sorted(set(versions)))
+
+    async def test_async_views_answer_not_modified(self):
+        with override_settings(ROOT_URLCONF=AsyncURLConf):
+            first = await self.async_client.get('/ad/%d/' % self.car.id)
+            second = await self.async_client.get('/ad/%d/' % self.car.id, headers={'If-None-Match': first['ETag']})
+        self.assertEqual(second.status_code, 304)
+
+
+class SearchCacheTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user()
+        create_cars(self.user, 3, brand='BMW')
+
+    def test_repeated_searches_are_served_from_memory(self):
+        first = self.client.get('/search/', {'q': 'BMW'})
+        # La version del catalogo y las filas de los ids guardados
+        with self.assertNumQueries(2):
+            second = self.client.get('/search/', {'q': '  bmw!'})
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(self.client.get('/search/cache_stats/').json()['hits'], 1)
+
+    def test_writes_invalidate_cached_results(self):
+        self.assertEqual(len(self.client.get('/search/', {'q': 'bmw'}).json()['cars']), 3)
+        Car.objects.filter(brand='BMW').first().delete()
+        self.assertEqual(len(self.client.get('/search/', {'q': 'bmw'}).json()['cars']), 2)
+
+    def test_lru_is_bounded(self):
+        cache = LRUCache(max_entries=2, max_bytes=10)
+        cache.set('a', b'aaaa', 4)
+        cache.set('b', b'bbbb', 4)
+        cache.get('a')
+        cache.set('c', b'cccc', 4)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'aaaa')
+        cache.set('d', b'dddddddd', 8)
+        self.assertEqual((len(cache), cache.bytes), (1, 8))
+
+    @override_settings(CARBUY_SEARCH_CACHE={'BACKEND': 'django'})
+    def test_django_cache_backend(self):
+        self.client.get('/search/', {'q': 'bmw'})
+        self.client.get('/search/', {'q': 'bmw'})
+        self.assertEqual(search_cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_stats_count_every_lookup_across_threads(self):
+        cache = ResultCache('test', 'CARBUY_SEARCH_CACHE')
+        cache.set('a', b'a')
+
+        def lookups():
+            for _ in range(1000):
+                cache.get('a')
+                cache.get('b')
+
+        threads = [threading.Thread(target=lookups) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.stats()['hits'], 4000)
+        self.assertEqual(cache.stats()['misses'], 4000)
+
+
+class FacetTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user()
+
+    def create_ad(self, **data):
+        ad = {'brand': 'Volkswagen', 'model': 'Golf', 'year': 2006, 'price': 9000,
+              'description': 'A good car to drive', 'image_url': 'https://example.com/golf.jpg',
+              'user_id': self.user.id}
+        ad.update(data)
+        self.client.post('/ad_management/', ad, content_type='application/json')
+
+    def assertConsistent(self):
+        self.assertEqual(stored_facets(), +compute_facets())
+
+    def test_deltas_follow_every_write(self):
+        self.create_ad()
+        self.create_ad(brand='BMW', year='2015', price='14999.99')
+        self.assertConsistent()
+        car = Car.objects.get(brand='BMW')
+        self.client.put('/ad_management/', {'car_id': car.id, 'price': 15000, 'year': 2016},
+                        content_type='application/json')
+        self.assertConsistent()
+        self.client.delete('/ad_management/', {'car_id': car.id}, content_type='application/json')
+        self.assertConsistent()
+        lines = [json.dumps({'brand': 'Seat', 'model': 'Ibiza', 'year': 2010, 'price': 3000, 'description': 'x',
+                             'image_url': 'https://example.com/x.jpg', 'user_id': self.user.id})] * 3
+        self.client.post('/ad_management/', '\n'.join(lines), content_type='application/x-ndjson')
+        self.assertConsistent()
+        self.user.delete()
+        self.assertConsistent()
+
+    def test_price_buckets_match_the_sql_floor(self):
+        self.assertEqual([price_bucket(price) for price in ('-1', '-5000', '-5000.01', '0', '4999.99')],
+                         [-5000, -5000, -10000, 0, 0])
+        for price in ('-1', '-5000.01', '4999.99'):
+            Car.objects.create(brand='Seat', model='Ibiza', year=2010, price=Decimal(price),
+                               description='x', user=self.user)
+        self.assertConsistent()
+
+    def test_facets_endpoint(self):
+        self.create_ad()
+        self.create_ad(model='Polo', year=2008, price=4500)
+        self.create_ad(brand='BMW', year=2015, price=15000)
+        with self.assertNumQueries(2):
+            data = self.client.get('/facets/').json()
+        self.assertEqual(data['brands'], [{'brand': 'Volkswagen', 'count': 2}, {'brand': 'BMW', 'count': 1}])
+        self.assertEqual([year['year'] for year in data['years']], [2015, 2008, 2006])
+        self.assertEqual(data['prices'], [{'min': 0, 'max': 5000, 'count': 1}, {'min': 5000, 'max': 10000, 'count': 1},
+                                          {'min': 15000, 'max': 20000, 'count': 1}])
+
+    def test_rebuild_command_repairs_drift(self):
+        self.create_ad()
+        Car.objects.update(brand='Seat')
+        with self.assertRaises(CommandError):
+            call_command('rebuild_facets', '--verify', stdout=io.StringIO())
+        call_command('rebuild_facets', stdout=io.StringIO())
+        call_command('rebuild_facets', '--verify', stdout=io.StringIO())
+
+
+@override_settings(CARBUY_BCRYPT_ROUNDS=4)
+class BenchmarkTests(CarBuyTestCase):
+    def test_seed_dataset(self):
+        counts = seed_dataset(users=10, cars=200, favourites=45, batch_size=64)
+        self.assertEqual(counts, {'users': 10, 'cars': 200, 'favourites': 45})
+        self.assertEqual(Car.objects.count(), 200)
+        pairs = list(FavouriteCar.objects.values_list('user_id', 'car_id'))
+        self.assertEqual(len(pairs), len(set(pairs)))
+        self.assertEqual(stored_facets(), +compute_facets())
+
+    def test_every_route_has_a_scenario(self):
+        from CarBuy.urls import urlpatterns
+        seed_dataset(users=4, cars=20, favourites=8)
+        routes = {resolve(prepare(0)[1].split('?')[0]).route for name, prepare, limit in route_scenarios(readers=2)}
+        # Las rutas del admin estan incluidas bajo admin/
+        routes = {'admin/' if route.startswith('admin/') else route for route in routes}
+        expected = {str(pattern.pattern) for pattern in urlpatterns}
+        self.assertEqual(expected - routes, set())
+
+    def test_api_profile_starts_without_admin_or_numpy(self):
+        full = measure_profile('CarBuy.settings', runs=1, requests=20)
+        api = measure_profile('CarBuy.settings_api', runs=1, requests=20)
+        self.assertEqual(api['statuses'], {'200': 20})
+        self.assertEqual(full['statuses'], {'200': 20})
+        self.assertNotIn('numpy', full['heavy_modules'])
+        self.assertNotIn('bcrypt', full['heavy_modules'])
+        self.assertIn('django.contrib.admin', full['heavy_modules'])
+        self.assertNotIn('django.contrib.admin', api['heavy_modules'])
+        self.assertLess(api['modules'], full['modules'])
+
+    def test_benchmark_command_writes_and_compares_results(self):
+        seed_dataset(users=4, cars=20, favourites=8)
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            call_command('benchmark', requests=2, concurrency=1, readers=2, output=output, stdout=io.StringIO())
+            with open(output) as output_file:
+                results = json.load(output_file)
+        self.assertEqual(results['meta']['cars'], 20)
+        for name, stats in results['routes'].items():
+            self.assertTrue(all(int(status) < 500 for status in stats['statuses']), name)
+        self.assertLessEqual(results['routes']['ad_details']['queries_per_request'], 1)
+        self.assertEqual(compare_results(results, results, 0.2), [])
+
+    def test_compare_results(self):
+        baseline = {'routes': {'search': {'p95_ms': 10.0, 'throughput': 100.0, 'queries_per_request': 2.0}}}
+        current = {'routes': {'search': {'p95_ms': 11.0, 'throughput': 90.0, 'queries_per_request': 2.0},
+                              'facets': {'p95_ms': 1.0, 'throughput': 1.0, 'queries_per_request': 9.0}}}
+        self.assertEqual(compare_results(baseline, current, 0.2), [])
+        current['routes']['search'].update(p95_ms=13.0, queries_per_request=3.0)
+        self.assertEqual(len(compare_results(baseline, current, 0.2)), 2)
+
+
+class InstrumentationTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+        self.user = create_user()
+        self.car = create_cars(self.user, 1)[0]
+
+    def server_timing(self, response):
+        return dict(re.findall(r'(\w+);dur=([\d.]+)', response['Server-Timing']))
+
+    def test_server_timing_header(self):
+        response = self.client.get('/ad/%d/' % self.car.id)
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+        self.assertEqual(set(self.server_timing(response)), {'db', 'hash', 'serialize', 'view', 'total'})
+
+    @override_settings(CARBUY_BCRYPT_ROUNDS=4)
+    def test_bcrypt_time_is_reported(self):
+        User.objects.filter(id=self.user.id).update(
+            encrypted_password=bcrypt.hashpw(b'secret', bcrypt.gensalt(4)).decode('utf8'))
+        response = self.client.post('/sessions/', {'email': self.user.email, 'password': 'secret'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(float(self.server_timing(response)['hash']), 0)
+
+    @override_settings(CARBUY_SERVER_TIMING=False)
+    def test_header_can_be_disabled(self):
+        self.assertNotIn('Server-Timing', self.client.get('/ad/%d/' % self.car.id))
+
+    def test_metrics_endpoint(self):
+        self.client.get('/ad/%d/' % self.car.id)
+        self.client.get('/ad/%d/' % (self.car.id + 1))
+        self.client.get('/ad/%d/' % self.car.id, REQUEST_METHOD='BREW')
+        body = self.client.get('/metrics/').content.decode()
+        self.assertIn('carbuy_responses_total{route="ad/<int:position_id>/",method="GET",status="200"} 1', body)
+        self.assertIn('carbuy_responses_total{route="ad/<int:position_id>/",method="GET",status="404"} 1', body)
+        self.assertIn('method="OTHER"', body)
+        self.assertIn('carbuy_db_queries_bucket{route="ad/<int:position_id>/",method="GET",le="2"} 2', body)
+        self.assertIn('carbuy_request_duration_seconds_count{route="ad/<int:position_id>/",method="GET"} 2', body)
+
+    async def test_async_views_are_measured(self):
+        with override_settings(ROOT_URLCONF=AsyncURLConf):
+            response = await self.async_client.get('/ad/%d/' % self.car.id)
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+
+@skipUnless(settings.CARBUY_DB_TUNING, 'CARBUY_DB_TUNING=off')
+class DatabaseTuningTests(CarBuyTestCase):
+    def test_connection_pragmas(self):
+        with connection.cursor() as cursor:
+            self.assertEqual(cursor.execute('PRAGMA synchronous').fetchone()[0], 1)
+            self.assertEqual(cursor.execute('PRAGMA busy_timeout').fetchone()[0], 20000)
+
+    def test_concurrent_writers_never_hit_lock_errors(self):
+        # Necesita un fichero real: la base de datos de los tests esta en memoria
+        manage = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'manage.py')
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, CARBUY_DB_NAME=os.path.join(directory, 'stress.sqlite3'), CARBUY_DB_TUNING='on')
+            subprocess.run([sys.executable, manage, 'migrate', '-v0'], env=env, check=True)
+            result = subprocess.run([sys.executable, manage, 'stress_db', '--seconds', '1', '--writers', '6'],
+                                    env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('journal_mode=wal', result.stdout)
+        self.assertIn('lock errors: 0', result.stdout)
+
+
+class SerializerTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user(token='0123456789abcdef0123')
+        self.car = create_cars(self.user, 1, brand='Citroën', price=Decimal('9000.5'))[0]
+        FavouriteCar.objects.create(user=self.user, car=self.car)
+
+    def test_prices_are_always_strings(self):
+        headers = {'sessionToken': self.user.token}
+        self.assertEqual(self.client.get('/get_ads/', {'limit': 1}).json()['cars'][0]['price'], '9000.50')
+        self.assertEqual(self.client.get('/ad/%d/' % self.car.id).json()['price'], '9000.50')
+        self.assertEqual(self.client.get('/get_favourites/', headers=headers).json()[0]['car_price'], '9000.50')
+        self.assertEqual(self.client.get('/search/', {'q': 'citroen'}).json()['cars'][0]['price'], '9000.50')
+
+    def test_json_backends_agree(self):
+        data = {'brand': 'Citroën', 'price': Decimal('9000.50'), 'year': 2010, 'rows': [[1, None, True]]}
+        with override_settings(CARBUY_FAST_JSON=True):
+            fast = dumps(data)
+        with override_settings(CARBUY_FAST_JSON=False):
+            standard = dumps(data)
+        self.assertEqual(json.loads(fast), json.loads(standard))
+        self.assertEqual(json.loads(standard)['price'], '9000.50')
+
+    @override_settings(CARBUY_FAST_JSON=False, CARBUY_STREAM_BATCH_SIZE=2)
+    def test_stream_batches_form_one_array(self):
+        create_cars(self.user, 4)
+        data = json.loads(b''.join(self.client.get('/get_ads/').streaming_content))
+        self.assertEqual(len(data), 5)
+        self.assertEqual(data[0]['brand'], 'Citroën')
+
+
+class FavouriteBatchTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user(token='0123456789abcdef0123')
+        self.cars = create_cars(self.user, 40)
+        self.headers = {'sessionToken': self.user.token}
+
+    def put(self, data):
+        return self.client.put('/favourite_management/', data, content_type='application/json', headers=self.headers)
+
+    def favourites(self):
+        return sorted(FavouriteCar.objects.filter(user=self.user).values_list('car_id', flat=True))
+
+    def test_single_car(self):
+        car_id = self.cars[0].id
+        self.assertTrue(self.put({'car_id': car_id}).json()['success'])
+        self.assertFalse(self.put({'car_id': car_id}).json()['success'])
+        self.assertEqual(self.put({'car_id': 999999}).status_code, 404)
+        self.assertEqual(self.favourites(), [car_id])
+
+    def test_batch_add_and_remove(self):
+        ids = [car.id for car in self.cars]
+        FavouriteCar.objects.create(user=self.user, car_id=ids[0])
+        response = self.put({'add': [ids[0], ids[1], ids[1], ids[2], 999999], 'remove': [ids[3]]})
+        self.assertEqual(response.json(), {'added': [ids[1], ids[2]], 'removed': [], 'not_found': [999999]})
+        response = self.put({'add': [ids[3]], 'remove': [ids[0], ids[2]]})
+        self.assertEqual(response.json(), {'added': [ids[3]], 'removed': [ids[0], ids[2]], 'not_found': []})
+        self.assertEqual(self.favourites(), [ids[1], ids[3]])
+
+    def test_batch_queries_do_not_depend_on_size(self):
+        ids = [car.id for car in self.cars]
+        FavouriteCar.objects.bulk_create(FavouriteCar(user=self.user, car_id=car_id) for car_id in ids[30:])
+        for add, remove in ((ids[:2], ids[30:32]), (ids[:20], ids[30:])):
+            FavouriteCar.objects.filter(user=self.user, car_id__in=add).delete()
+            FavouriteCar.objects.bulk_create(
+                [FavouriteCar(user=self.user, car_id=car_id) for car_id in remove], ignore_conflicts=True)
+            # Token, coches existentes y una transaccion (savepoint) con el bloqueo del
+            # usuario, los favoritos actuales, la insercion, el borrado, los dos
+            # cambios de contadores, la version de los favoritos, el registro de cambios,
+            # los coches pendientes de build_neighbours y el numero de favoritos del usuario
+            with self.assertNumQueries(14):
+                self.put({'add': add, 'remove': remove})
+
+    def test_invalid_batches(self):
+        self.assertEqual(self.put({'add': 'abc'}).status_code, 400)
+        self.assertEqual(self.put({'add': [1, 'x']}).status_code, 400)
+        with override_settings(CARBUY_MAX_FAVOURITES_BATCH=2):
+            self.assertEqual(self.put({'remove': [1, 2, 3]}).status_code, 400)
+
+    def test_duplicates_are_rejected_by_the_database(self):
+        FavouriteCar.objects.create(user=self.user, car=self.cars[0])
+        with self.assertRaises(IntegrityError):
+            FavouriteCar.objects.create(user=self.user, car=self.cars[0])
+
+
+class FavouriteCountTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.seller = create_user()
+        self.cars = create_cars(self.seller, 4)
+        self.fans = [create_user('fan%d@mail.com' % i, token='%020d' % i) for i in range(3)]
+
+    def put(self, fan, data):
+        return self.client.put('/favourite_management/', data, content_type='application/json',
+                               headers={'sessionToken': fan.token})
+
+    def counts(self):
+        return [Car.objects.get(id=car.id).favourite_count for car in self.cars]
+
+    def test_counts_follow_adds_removes_and_deletes(self):
+        ids = [car.id for car in self.cars]
+        self.put(self.fans[0], {'add': ids[:3]})
+        self.put(self.fans[1], {'add': ids[:2]})
+        self.put(self.fans[2], {'car_id': ids[0]})
+        self.put(self.fans[2], {'car_id': ids[0]})
+        self.assertEqual(self.counts(), [3, 2, 1, 0])
+        self.put(self.fans[0], {'remove': [ids[1], ids[3]]})
+        self.assertEqual(self.counts(), [3, 1, 1, 0])
+        self.fans[1].delete()
+        self.assertEqual(self.counts(), [2, 0, 1, 0])
+        call_command('reconcile_favourite_counts', '--verify', stdout=io.StringIO())
+
+    def test_listings_expose_the_count(self):
+        self.put(self.fans[0], {'add': [self.cars[0].id]})
+        self.assertEqual(self.client.get('/get_ads/', {'limit': 1}).json()['cars'][0]['favourite_count'], 1)
+
+    def test_favourites_change_listings_but_not_the_catalog_version(self):
+        urls = (('/get_ads/', {'limit': 1}), ('/get_ads/', {}), ('/search/', {'q': 'car'}),
+                ('/most_favourited/', {}), ('/facets/', {}))
+        etags = [self.client.get(url, params)['ETag'] for url, params in urls]
+        version = catalog_state()[0]
+        self.put(self.fans[0], {'add': [self.cars[0].id]})
+        self.assertEqual(catalog_state()[0], version)
+        changed = [self.client.get(url, params) for url, params in urls]
+        self.assertEqual([response['ETag'] != etag for response, etag in zip(changed, etags)],
+                         [True, True, True, True, False])
+        # El listado completo con el ETag anterior ya no es 304 y lleva el contador nuevo
+        revalidated = self.client.get('/get_ads/', headers={'If-None-Match': etags[1]})
+        self.assertEqual(revalidated.status_code, 200)
+        self.assertEqual(json.loads(b''.join(revalidated.streaming_content))[0]['favourite_count'], 1)
+        # La busqueda se sirve de la cache con el contador actual
+        self.assertEqual(search_cache.stats()['hits'], 1)
+        self.assertEqual(changed[2].json()['cars'][0]['favourite_count'], 1)
+
+    def test_most_favourited(self):
+        ids = [car.id for car in self.cars]
+        for fan, favourites in zip(self.fans, (ids[:3], ids[1:3], ids[2:3])):
+            self.put(fan, {'add': favourites})
+        with self.assertNumQueries(2):
+            data = self.client.get('/most_favourited/', {'limit': 2}).json()
+        self.assertEqual([(car['id'], car['favourite_count']) for car in data['cars']], [(ids[2], 3), (ids[1], 2)])
+        self.assertEqual(self.client.get('/most_favourited/', {'limit': 'x'}).status_code, 400)
+
+    def test_most_favourited_uses_the_index(self):
+        plan = most_favourited(10).explain()
+        self.assertIn('car_favourite_count_idx', plan)
+
+    def test_reconcile_repairs_drift(self):
+        FavouriteCar.objects.create(user=self.fans[0], car=self.cars[0])
+        Car.objects.filter(id=self.cars[1].id).update(favourite_count=5)
+        with self.assertRaises(CommandError):
+            call_command('reconcile_favourite_counts', '--verify', stdout=io.StringIO())
+        out = io.StringIO()
+        call_command('reconcile_favourite_counts', stdout=out)
+        self.assertIn('2 coches', out.getvalue())
+        self.assertEqual(self.counts(), [1, 0, 0, 0])
+
+
+@skipUnless(similar_index is not None, 'numpy no esta instalado')
+class SimilarCarsTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user()
+        self.golf = create_cars(self.user, 1, model='Golf', year=2010, price=10000)[0]
+        self.cars = {
+            'golf_close': create_cars(self.user, 1, model='Golf', year=2011, price=11000)[0],
+            'golf_old': create_cars(self.user, 1, model='Golf', year=2006, price=8000)[0],
+            'polo': create_cars(self.user, 1, model='Polo', year=2010, price=10000)[0],
+            'ibiza': create_cars(self.user, 1, brand='Seat', model='Ibiza', year=2010, price=10000)[0],
+        }
+
+    def similar(self, car, **params):
+        response = self.client.get('/ad/%d/similar/' % car.id, params)
+        self.assertEqual(response.status_code, 200)
+        return [row['id'] for row in response.json()['cars']]
+
+    def test_ranked_by_distance(self):
+        cars = self.cars
+        self.assertEqual(self.similar(self.golf),
+                         [cars['golf_close'].id, cars['golf_old'].id, cars['polo'].id, cars['ibiza'].id])
+        self.assertEqual(self.similar(self.golf, limit=2), [cars['golf_close'].id, cars['golf_old'].id])
+
+    def test_errors(self):
+        self.assertEqual(self.client.get('/ad/999999/similar/').status_code, 404)
+        self.assertEqual(self.client.get('/ad/%d/similar/' % self.golf.id, {'limit': 0}).status_code, 400)
+
+    def test_writes_update_the_index_incrementally(self):
+        self.similar(self.golf)
+        polo = self.cars['polo']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put('/ad_management/', {'car_id': polo.id, 'model': 'Golf'}, content_type='application/json')
+            self.client.delete('/ad_management/', {'car_id': self.cars['golf_old'].id},
+                               content_type='application/json')
+        self.assertEqual(similar_index.similar(self.golf.id, 2), [polo.id, self.cars['golf_close'].id])
+        self.assertEqual(self.similar(self.golf, limit=2), [polo.id, self.cars['golf_close'].id])
+
+    def test_catches_up_with_writes_from_other_processes(self):
+        self.similar(self.golf)
+        # Con el indice marcado como no cargado las señales no lo actualizan
+        similar_index.loaded = False
+        ibiza = self.cars['ibiza']
+        ibiza.brand, ibiza.model = 'Volkswagen', 'Golf'
+        ibiza.save()
+        self.cars['golf_close'].delete()
+        similar_index.loaded = True
+        # Estado del catalogo, compactacion, dos lecturas del registro, las
+        # filas cambiadas y las de la respuesta; nunca toda la tabla
+        with self.assertNumQueries(6):
+            self.assertEqual(self.similar(self.golf, limit=2), [self.cars['ibiza'].id, self.cars['golf_old'].id])
+
+    def test_favourites_do_not_sync_the_index(self):
+        self.similar(self.golf)
+        fan = create_user('fan@mail.com', token='f' * 20)
+        self.client.put('/favourite_management/', {'add': [self.cars['polo'].id]}, content_type='application/json',
+                        headers={'sessionToken': fan.token})
+        with self.assertNumQueries(2):
+            self.similar(self.golf)
+
+    def test_compacted_tombstones_force_a_rebuild(self):
+        self.similar(self.golf)
+        similar_index.loaded = False
+        self.cars['golf_close'].delete()
+        similar_index.loaded = True
+        compact_changes(tombstone_days=0)
+        self.assertNotIn(self.cars['golf_close'].id, self.similar(self.golf))
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'similar.npz')
+            call_command('build_similar_index', '--output', path, stdout=io.StringIO())
+            expected = self.similar(self.golf)
+            similar_index.reset()
+            with override_settings(CARBUY_SIMILAR_SNAPSHOT=path):
+                with self.assertNumQueries(2):
+                    self.assertEqual(self.similar(self.golf), expected)
+
+
+@skipUnless(neighbours_numpy is not None, 'numpy no esta instalado')
+class NeighbourTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        seller = create_user()
+        self.cars = [car.id for car in create_cars(seller, 5)]
+        self.fans = [create_user('fan%d@mail.com' % i, token='%020d' % i) for i in range(4)]
+        a, b, c, d, e = self.cars
+        for fan, favourites in zip(self.fans, ([a, b, c], [a, b], [a, d], [b, c])):
+            FavouriteCar.objects.bulk_create(FavouriteCar(user=fan, car_id=car_id) for car_id in favourites)
+
+    def build(self, *args):
+        call_command('build_neighbours', *args, stdout=io.StringIO())
+
+    def also_liked(self, car_id):
+        response = self.client.get('/ad/%d/also_liked/' % car_id)
+        self.assertEqual(response.status_code, 200)
+        return [car['id'] for car in response.json()['cars']]
+
+    def stored(self):
+        return sorted(CarNeighbour.objects.values_list('car_id', 'neighbour_id', 'score'))
+
+    def test_ranked_by_cosine_similarity(self):
+        a, b, c, d, e = self.cars
+        self.build()
+        # a: b 2/sqrt(3*3), c 1/sqrt(3*2), d 1/sqrt(3*1)
+        self.assertEqual(self.also_liked(a), [b, d, c])
+        self.assertEqual(self.also_liked(c), [b, a])
+        self.assertEqual(self.also_liked(e), [])
+        with self.assertNumQueries(1):
+            self.client.get('/ad/%d/also_liked/' % a, {'limit': 2})
+        with override_settings(CARBUY_NEIGHBOURS={**settings.CARBUY_NEIGHBOURS, 'TOP_N': 1, 'MAX_BATCH_CARS': 1}):
+            self.build()
+        self.assertEqual(self.also_liked(a), [b])
+
+    def test_incremental_refresh_matches_full_rebuild(self):
+        a, b, c, d, e = self.cars
+        self.build()
+        self.assertFalse(StaleNeighbours.objects.exists())
+        self.client.put('/favourite_management/', {'add': [e], 'remove': [d]}, content_type='application/json',
+                        headers={'sessionToken': self.fans[2].token})
+        self.fans[3].delete()
+        self.assertEqual(set(StaleNeighbours.objects.values_list('car_id', flat=True)), {b, c, d, e})
+        self.build('--changed')
+        incremental = self.stored()
+        self.assertFalse(StaleNeighbours.objects.exists())
+        self.build()
+        self.assertEqual(incremental, self.stored())
+        self.assertEqual(self.also_liked(d), [])
+        self.assertEqual(self.also_liked(e), [a])
+
+    def assertIncrementalMatchesFullRebuild(self):
+        self.build('--changed')
+        incremental = self.stored()
+        self.build()
+        self.assertEqual(incremental, self.stored())
+
+    def test_deleting_a_car_refreshes_its_neighbours(self):
+        a, b, c, d, e = self.cars
+        with override_settings(CARBUY_NEIGHBOURS={**settings.CARBUY_NEIGHBOURS, 'TOP_N': 1}):
+            self.build()
+            self.assertEqual(self.also_liked(c), [b])
+            Car.objects.get(id=b).delete()
+            self.assertEqual(set(StaleNeighbours.objects.values_list('car_id', flat=True)), {a, c})
+            self.assertIncrementalMatchesFullRebuild()
+        self.assertEqual(self.also_liked(c), [a])
+
+    def test_users_crossing_the_favourites_limit(self):
+        a, b, c, d, e = self.cars
+        with override_settings(CARBUY_NEIGHBOURS={**settings.CARBUY_NEIGHBOURS, 'MAX_USER_FAVOURITES': 2}):
+            self.build()
+            # fan1 pasa de 2 a 3 favoritos y deja de contar para a y b
+            self.client.put('/favourite_management/', {'add': [e]}, content_type='application/json',
+                            headers={'sessionToken': self.fans[1].token})
+            self.assertEqual(set(StaleNeighbours.objects.values_list('car_id', flat=True)), {a, b, e})
+            self.assertIncrementalMatchesFullRebuild()
+            # fan0 baja de 3 a 2 y vuelve a contar para a y b
+            self.client.put('/favourite_management/', {'remove': [c]}, content_type='application/json',
+                            headers={'sessionToken': self.fans[0].token})
+            self.assertEqual(set(StaleNeighbours.objects.values_list('car_id', flat=True)), {a, b, c})
+            self.assertIncrementalMatchesFullRebuild()
+
+
+class AdCacheTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user()
+        self.car = create_cars(self.user, 1, model='Golf')[0]
+        self.url = '/ad/%d/' % self.car.id
+
+    def test_hot_ads_are_served_without_queries(self):
+        with self.assertNumQueries(1):
+            first = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            second = self.client.get(self.url)
+            not_modified = self.client.get(self.url, headers={'If-None-Match': first['ETag']})
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_car_and_seller_writes_invalidate(self):
+        self.client.get(self.url)
+        self.client.put('/ad_management/', {'car_id': self.car.id, 'price': 4321}, content_type='application/json')
+        self.assertEqual(self.client.get(self.url).json()['price'], '4321.00')
+
+        other = create_cars(self.user, 1)[0]
+        self.client.get('/ad/%d/' % other.id)
+        self.user.phone = '600111222'
+        self.user.save()
+        # El anuncio sigue en cache; solo se vuelve a leer el vendedor
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(self.url).json()['user']['phone'], '600111222')
+        self.assertEqual(self.client.get('/ad/%d/' % other.id).json()['user']['phone'], '600111222')
+
+        self.client.delete('/ad_management/', {'car_id': self.car.id}, content_type='application/json')
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_bounded_and_expiring(self):
+        with override_settings(CARBUY_AD_CACHE={'MAX_ENTRIES': 2}):
+            for car in create_cars(self.user, 3):
+                self.client.get('/ad/%d/' % car.id)
+            self.assertEqual(ad_cache.stats()['entries'], 2)
+        cache = LRUCache(max_entries=10, timeout=60)
+        cache.set('a', 1)
+        with mock.patch('carbuyrest22app.caching.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_shared_backend(self):
+        config = {'BACKEND': 'django', 'CACHE_ALIAS': 'default', 'TIMEOUT': 60}
+        with override_settings(CARBUY_AD_CACHE=config, CARBUY_SELLER_CACHE=config):
+            self.client.get(self.url)
+            with self.assertNumQueries(0):
+                self.assertEqual(self.client.get(self.url).json()['model'], 'Golf')
+            self.car.model = 'Polo'
+            self.car.save()
+            self.assertEqual(self.client.get(self.url).json()['model'], 'Polo')
+
+    async def test_async_view_uses_the_async_cache_api(self):
+        config = {'BACKEND': 'django', 'CACHE_ALIAS': 'default', 'TIMEOUT': 60}
+        with override_settings(ROOT_URLCONF=AsyncURLConf, CARBUY_AD_CACHE=config, CARBUY_SELLER_CACHE=config), \
+                mock.patch.object(DjangoCache, 'get', side_effect=AssertionError), \
+                mock.patch.object(DjangoCache, 'set', side_effect=AssertionError):
+            first = await self.async_client.get(self.url)
+            second = await self.async_client.get(self.url)
+            self.assertEqual(second.json(), first.json())
+            self.assertEqual((ad_cache.stats(), seller_cache.stats()),
+                             ({'hits': 1, 'misses': 1}, {'hits': 1, 'misses': 0}))
+
+
+class AdmissionTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user()
+        create_cars(self.user, 3)
+
+    def login(self, remote_addr='127.0.0.1'):
+        return self.client.post('/sessions/', {'email': 'nobody@mail.com', 'password': 'x'},
+                                content_type='application/json', REMOTE_ADDR=remote_addr)
+
+    @override_settings(CARBUY_RATE_LIMITS={'sessions/': {'POST': (0.5, 3)}})
+    def test_token_bucket_per_client(self):
+        self.assertEqual([self.login().status_code for _ in range(3)], [404, 404, 404])
+        rejected = self.login()
+        self.assertEqual(rejected.status_code, 429)
+        self.assertEqual(rejected['Retry-After'], '2')
+        # Otros clientes y otras rutas no se ven afectados
+        self.assertEqual(self.login('10.0.0.2').status_code, 404)
+        self.assertEqual(self.client.get('/get_ads/', {'limit': 1}).status_code, 200)
+        with mock.patch('carbuyrest22app.ratelimit.time.monotonic', return_value=time.monotonic() + 2):
+            self.assertEqual(self.login().status_code, 404)
+
+    def post_forwarded(self, forwarded):
+        return self.client.post('/sessions/', {}, content_type='application/json',
+                                headers={'X-Forwarded-For': forwarded}).status_code
+
+    @override_settings(CARBUY_RATE_LIMIT={'BACKEND': 'locmem', 'CLIENT_HEADER': 'X-Forwarded-For'},
+                       CARBUY_RATE_LIMITS={'sessions/': {'POST': (1, 1)}})
+    def test_client_header(self):
+        self.assertEqual(self.post_forwarded('198.51.100.1, 203.0.113.9'), 400)
+        # Cambiar las entradas que pone el cliente no cambia de bucket
+        self.assertEqual(self.post_forwarded('198.51.100.2, 203.0.113.9'), 429)
+        self.assertEqual(self.post_forwarded('203.0.113.10'), 400)
+        self.assertEqual(self.login().status_code, 404)
+
+    @override_settings(CARBUY_RATE_LIMIT={'BACKEND': 'locmem', 'CLIENT_HEADER': 'X-Forwarded-For',
+                                          'TRUSTED_PROXIES': 2},
+                       CARBUY_RATE_LIMITS={'sessions/': {'POST': (1, 1)}})
+    def test_trusted_proxies(self):
+        self.assertEqual(self.post_forwarded('198.51.100.1, 203.0.113.9, 10.0.0.1'), 400)
+        self.assertEqual(self.post_forwarded('198.51.100.2, 203.0.113.9, 10.0.0.2'), 429)
+        self.assertEqual(self.post_forwarded('203.0.113.10, 10.0.0.1'), 400)
+        # Sin entradas suficientes se usa REMOTE_ADDR
+        self.assertEqual(self.post_forwarded('203.0.113.11'), 400)
+        self.assertEqual(self.login().status_code, 429)
+
+    @override_settings(CARBUY_RATE_LIMIT={'BACKEND': 'django', 'CACHE_ALIAS': 'default'},
+                       CARBUY_RATE_LIMITS={'sessions/': {'POST': (1, 2)}})
+    def test_shared_backend(self):
+        from django.core.cache import cache
+        cache.clear()
+        # Al principio de una ventana de 2 segundos
+        now = (time.time() // 2 + 1) * 2
+        with mock.patch('carbuyrest22app.ratelimit.time.time', return_value=now + 0.5):
+            self.assertEqual([self.login().status_code for _ in range(3)], [404, 404, 429])
+            rejected = self.login()
+        self.assertEqual(rejected['Retry-After'], '2')
+        with mock.patch('carbuyrest22app.ratelimit.time.time', return_value=now + 2):
+            self.assertEqual(self.login().status_code, 404)
+
+    @override_settings(CARBUY_CONCURRENCY_LIMITS={'get_ads/': 1})
+    def test_concurrency_cap_holds_until_the_stream_ends(self):
+        streaming = self.client.get('/get_ads/')
+        busy = self.client.get('/get_ads/', {'limit': 1})
+        self.assertEqual(busy.status_code, 503)
+        self.assertEqual(busy['Retry-After'], '1')
+        self.assertEqual(len(json.loads(b''.join(streaming.streaming_content))), 3)
+        self.assertEqual(self.client.get('/get_ads/', {'limit': 1}).status_code, 200)
+
+
+class ExportTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user(name='Ana', phone='600000001', token='export-token')
+        self.cars = create_cars(self.user, 5)
+
+    def export(self, **headers):
+        response = self.client.get('/export/', {'format': headers.pop('format', 'ndjson'), 'sellers': 1},
+                                   headers=dict(headers, sessionToken='export-token'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def test_ndjson_with_sellers(self):
+        response, content = self.export()
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['id'] for row in rows], [car.id for car in self.cars])
+        self.assertEqual(rows[0]['price'], '1000.00')
+        self.assertEqual((rows[0]['seller_name'], rows[0]['seller_phone']), ('Ana', '600000001'))
+
+    def test_csv(self):
+        response, content = self.export(format='csv')
+        rows = list(csv.DictReader(io.StringIO(content.decode('utf8'))))
+        self.assertEqual([int(row['id']) for row in rows], [car.id for car in self.cars])
+        self.assertEqual((rows[-1]['price'], rows[-1]['seller_name']), ('1004.00', 'Ana'))
+        plain = b''.join(self.client.get('/export/', {'format': 'csv'}).streaming_content)
+        self.assertNotIn(b'seller_name', plain)
+
+    def test_gzip_follows_accept_encoding(self):
+        plain_response, plain = self.export()
+        self.assertFalse(plain_response.has_header('Content-Encoding'))
+        response, compressed = self.export(accept_encoding='br, gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(compressed), plain)
+        refused, content = self.export(accept_encoding='gzip;q=0')
+        self.assertFalse(refused.has_header('Content-Encoding'))
+
+    @override_settings(CARBUY_EXPORT={'CHUNK_SIZE': 2, 'BATCH_SIZE': 2, 'GZIP_LEVEL': 1})
+    def test_rows_are_encoded_in_batches(self):
+        self.assertEqual(len(list(export_chunks('ndjson'))), 3)
+        self.assertEqual(len(list(export_chunks('csv'))), 4)
+
+    def test_invalid_format(self):
+        self.assertEqual(self.client.get('/export/', {'format': 'xml'}).status_code, 400)
+
+    def test_sellers_require_a_session(self):
+        self.assertEqual(self.client.get('/export/', {'sellers': 1}).status_code, 401)
+        self.assertEqual(self.client.get('/export/', {'sellers': 1}, headers={'sessionToken': 'x'}).status_code, 401)
+
+    def test_csv_cells_are_not_formulas(self):
+        Car.objects.filter(id=self.cars[0].id).update(brand='=HYPERLINK("http://x")', model='-1+1',
+                                                      description='@SUM(A1)')
+        rows = list(csv.reader(io.StringIO(self.export(format='csv')[1].decode('utf8'))))
+        self.assertEqual(rows[1][1:4], ['\'=HYPERLINK("http://x")', "'-1+1", '2000'])
+        self.assertEqual(rows[1][5], "'@SUM(A1)")
+        self.assertEqual(rows[1][4], '1000.00')
+
+    def test_command_matches_endpoint(self):
+        response, content = self.export(format='csv')
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'ads.csv.gz')
+            call_command('export_ads', format='csv', sellers=True, gzip=True, output=output, stdout=io.StringIO())
+            with gzip.open(output) as export_file:
+                self.assertEqual(export_file.read(), content)
+
+
+class SyncTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user(token='sync-token')
+        self.cars = self.create_cars(4)
+
+    def create_cars(self, count):
+        # Como el alta masiva: bulk_create no envia post_save
+        cars = create_cars(self.user, count)
+        cars_bulk_created.send(sender=Car, cars=cars)
+        return cars
+
+    def sync(self, since, **params):
+        response = self.client.get('/sync/', dict(params, since=since))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def changes_after(self, since):
+        data = self.sync(since)
+        return [car['id'] for car in data['cars']], data['deleted'], data['cursor']
+
+    def test_only_changes_after_the_cursor(self):
+        car_ids, deleted, cursor = self.changes_after(0)
+        self.assertEqual(car_ids, [car.id for car in self.cars])
+        self.assertEqual(self.changes_after(cursor), ([], [], cursor))
+
+        self.client.put('/ad_management/', {'car_id': self.cars[1].id, 'price': 5000}, content_type='application/json')
+        self.client.put('/favourite_management/', {'car_id': self.cars[2].id}, content_type='application/json',
+                        headers={'sessionToken': self.user.token})
+        self.client.delete('/ad_management/', {'car_id': self.cars[3].id}, content_type='application/json')
+        data = self.sync(cursor)
+        self.assertEqual([(car['id'], car['price'], car['favourite_count']) for car in data['cars']],
+                         [(self.cars[1].id, '5000.00', 0), (self.cars[2].id, '1002.00', 1)])
+        self.assertEqual(data['deleted'], [self.cars[3].id])
+        self.assertEqual(self.changes_after(data['cursor']), ([], [], data['cursor']))
+
+    def test_pages(self):
+        self.client.put('/ad_management/', {'car_id': self.cars[0].id, 'price': 5000}, content_type='application/json')
+        seen = []
+        cursor = 0
+        while True:
+            data = self.sync(cursor, limit=2)
+            seen.extend(car['id'] for car in data['cars'])
+            cursor = data['cursor']
+            if not data['has_more']:
+                break
+        self.assertEqual(sorted(set(seen)), [car.id for car in self.cars])
+        self.assertEqual(seen[-1], self.cars[0].id)
+
+    def test_queries_do_not_depend_on_catalog_size(self):
+        self.create_cars(50)
+        cursor = self.sync(0, limit=100)['cursor']
+        Car.objects.get(id=self.cars[0].id).save()
+        # Estado de la compactacion, pagina del registro y filas cambiadas
+        with self.assertNumQueries(3):
+            data = self.sync(cursor)
+        self.assertEqual([car['id'] for car in data['cars']], [self.cars[0].id])
+
+    def test_compaction_keeps_answers_and_expires_old_cursors(self):
+        old_cursor = self.sync(0)['cursor']
+        for price in (5000, 6000):
+            self.client.put('/ad_management/', {'car_id': self.cars[0].id, 'price': price},
+                            content_type='application/json')
+        self.client.delete('/ad_management/', {'car_id': self.cars[1].id}, content_type='application/json')
+        before = self.sync(old_cursor)
+        call_command('compact_changes', stdout=io.StringIO())
+        self.assertEqual(CarChange.objects.count(), 4)
+        self.assertEqual(self.sync(0)['cars'], self.sync(0)['cars'])
+        after = self.sync(old_cursor)
+        self.assertEqual((after['cars'], after['deleted']), (before['cars'], before['deleted']))
+
+        self.assertEqual(compact_changes(tombstone_days=0), {'superseded': 0, 'tombstones': 1})
+        self.assertEqual(self.client.get('/sync/', {'since': old_cursor}).status_code, 410)
+        data = self.sync(0)
+        self.assertEqual(sorted(car['id'] for car in data['cars']), [self.cars[0].id] + [car.id for car in self.cars[2:]])
+        self.assertEqual(self.sync(data['cursor'])['cars'], [])
+        # Un recorrido desde 0 por paginas no caduca aunque sus cursores sean antiguos
+        rest = self.sync(self.sync(0, limit=1)['cursor'])
+        self.assertEqual([car['id'] for car in rest['cars']], [self.cars[0].id, self.cars[3].id])
+
+    def test_invalid_parameters(self):
+        for params in ({'since': 'x'}, {'since': -1}, {'since': '3.x'}, {'limit': 0}):
+            self.assertEqual(self.client.get('/sync/', params).status_code, 400)
+
+
+class CatalogSnapshotTests(CarBuyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        config = dict(settings.CARBUY_CATALOG_SNAPSHOT, DIRECTORY=self.directory, AUTO=False, DEBOUNCE=0.05)
+        self.enterContext(override_settings(CARBUY_CATALOG_SNAPSHOT=config))
+        self.user = create_user()
+        self.cars = create_cars(self.user, 5)
+        self.client.put('/ad_management/', {'car_id': self.cars[0].id, 'price': 4000}, content_type='application/json')
+
+    def snapshot_files(self):
+        return sorted(name for name in os.listdir(self.directory) if name != LOCK_NAME)
+
+    def get_ads(self, encoding=None):
+        headers = {'Accept-Encoding': encoding} if encoding else {}
+        response = self.client.get('/get_ads/', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content)
+
+    def test_current_version_is_served_from_disk(self):
+        streamed, listing = self.get_ads()
+        self.assertNotIsInstance(streamed, FileResponse)
+        build_catalog_snapshot()
+        with self.assertNumQueries(1):
+            response, content = self.get_ads()
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(content, listing)
+        self.assertEqual(response['Content-Length'], str(len(listing)))
+
+        response, content = self.get_ads('gzip, deflate')
+        self.assertEqual((response['Content-Encoding'], response['Vary']), ('gzip', 'Accept-Encoding'))
+        self.assertEqual(gzip.decompress(content), listing)
+        not_modified = self.client.get('/get_ads/', headers={'Accept-Encoding': 'gzip',
+                                                              'If-None-Match': response['ETag']})
+        self.assertEqual(not_modified.status_code, 304)
+
+    @skipUnless(brotli, 'brotli no esta instalado')
+    def test_brotli_is_preferred(self):
+        listing = self.get_ads()[1]
+        build_catalog_snapshot()
+        response, content = self.get_ads('gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(content), listing)
+
+    def test_writes_schedule_a_new_snapshot(self):
+        build_catalog_snapshot()
+        with mock.patch.object(snapshot_scheduler, 'schedule') as schedule:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.delete('/ad_management/', {'car_id': self.cars[1].id}, content_type='application/json')
+            self.assertEqual(schedule.call_count, 1)
+            # Hasta que se genere la nueva copia el listado se vuelve a leer de la base de datos
+            response, content = self.get_ads('gzip')
+        self.assertNotIsInstance(response, FileResponse)
+        self.assertEqual(len(json.loads(content)), 4)
+
+        state = catalog_state()
+        build_catalog_snapshot()
+        suffixes = ['', '.gz'] + (['.br'] if brotli else [])
+        self.assertEqual(self.snapshot_files(),
+                         sorted('catalog-%d-%d.json%s' % (state[0], state[2], suffix) for suffix in suffixes))
+
+    def test_favourites_schedule_a_new_snapshot(self):
+        fan = create_user('fan@mail.com', token='fedcba9876543210fedc')
+        build_catalog_snapshot()
+        with mock.patch.object(snapshot_scheduler, 'schedule') as schedule:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.put('/favourite_management/', {'add': [self.cars[0].id]},
+                                content_type='application/json', headers={'sessionToken': fan.token})
+            self.assertEqual(schedule.call_count, 1)
+            # La copia anterior tiene los contadores antiguos: no se sirve
+            response, content = self.get_ads()
+        self.assertNotIsInstance(response, FileResponse)
+        self.assertEqual(json.loads(content)[0]['favourite_count'], 1)
+
+        build_catalog_snapshot()
+        self.assertEqual(len(self.snapshot_files()), 3 if brotli else 2)
+        response, snapshot = self.get_ads()
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(snapshot, content)
+
+    def test_snapshot_is_discarded_if_the_catalog_changes_while_reading(self):
+        for states in ([(7, None, 0, None), (8, None, 0, None)], [(7, None, 0, None), (7, None, 1, None)]):
+            with mock.patch('carbuyrest22app.snapshot.catalog_state', side_effect=states):
+                self.assertIsNone(build_catalog_snapshot())
+            self.assertEqual(self.snapshot_files(), [])
+
+    @skipUnless(fcntl, 'fcntl no esta disponible')
+    def test_one_process_builds_each_version(self):
+        self.assertTrue(build_catalog_snapshot(gzip_level=1, skip_existing=True))
+        self.assertEqual(build_catalog_snapshot(skip_existing=True), {})
+        # Otro proceso tiene el cerrojo (flock bloquea por descriptor abierto)
+        with open(os.path.join(self.directory, LOCK_NAME)) as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            with self.assertRaises(SnapshotBusy):
+                build_catalog_snapshot()
+
+    def run_scheduler(self, writes_while_waiting=(), busy=0):
+        # Ejecuta el hilo del programador en este hilo con un reloj simulado;
+        # writes_while_waiting son los segundos en los que llega otra escritura
+        now = [0.0]
+        writes = list(writes_while_waiting)
+        builds = []
+
+        def sleep(seconds):
+            if writes and now[0] + seconds >= writes[0]:
+                now[0] = writes.pop(0)
+                scheduler.schedule()
+            else:
+                now[0] += seconds
+
+        scheduler = SnapshotScheduler(clock=lambda: now[0], sleep=sleep)
+
+        def build(**kwargs):
+            builds.append(now[0])
+            if len(builds) <= busy:
+                raise SnapshotBusy()
+            return {}
+
+        config = dict(settings.CARBUY_CATALOG_SNAPSHOT, AUTO=True, DEBOUNCE=2, MAX_DELAY=10)
+        with override_settings(CARBUY_CATALOG_SNAPSHOT=config), \
+                mock.patch('carbuyrest22app.snapshot.threading.Thread'), \
+                mock.patch('carbuyrest22app.snapshot.connection'), \
+                mock.patch('carbuyrest22app.snapshot.build_catalog_snapshot', side_effect=build) as build_mock:
+            scheduler.schedule()
+            scheduler._run()
+        self.assertIsNone(scheduler._thread)
+        return builds, build_mock
+
+    def test_bursts_of_writes_build_once(self):
+        builds, build = self.run_scheduler(writes_while_waiting=[1, 2.5, 4])
+        # DEBOUNCE segundos despues de la ultima escritura, con niveles de compresion bajos
+        self.assertEqual(builds, [6])
+        build.assert_called_once_with(gzip_level=1, brotli_quality=3, skip_existing=True)
+
+    def test_constant_writes_build_after_max_delay(self):
+        builds, build = self.run_scheduler(writes_while_waiting=[1.5 * i for i in range(1, 8)])
+        self.assertEqual(builds, [10])
+
+    def test_retries_while_another_process_builds(self):
+        builds, build = self.run_scheduler(busy=1)
+        self.assertEqual(builds, [2, 4])
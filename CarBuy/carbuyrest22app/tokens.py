@@ -0,0 +1,208 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .models import RevokedToken, User
+
+
+# Tokens de sesion firmados: "<user_id>.<emitido_ms>.<caduca>.<jti>.<firma>".
+# Se verifican sin consultar la base de datos; solo los tokens revocados (logout
+# o cambio de contraseña) necesitan confirmarse contra la tabla RevokedToken.
+# Los tokens antiguos (hexadecimales guardados en User.token) siguen aceptandose.
+
+_signing_key = None
+
+
+def _key():
+    global _signing_key
+    if _signing_key is None:
+        _signing_key = hashlib.sha256(b'carbuy.sessions:' + settings.SECRET_KEY.encode('utf8')).digest()
+    return _signing_key
+
+
+def _sign(payload):
+    digest = hmac.new(_key(), payload.encode('utf8'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def issue_token(user_id):
+    issued = now_ms()
+    expires = issued // 1000 + settings.CARBUY_TOKEN_TTL
+    payload = '%d.%d.%d.%s' % (user_id, issued, expires, secrets.token_hex(8))
+    return payload + '.' + _sign(payload)
+
+
+def decode_token(token):
+    # Devuelve (user_id, emitido_ms, caduca, jti) si la firma es valida y el
+    # token no ha caducado, o None en cualquier otro caso
+    parts = token.split('.')
+    if len(parts) != 5:
+        return None
+    payload, signature = token.rsplit('.', 1)
+    if not hmac.compare_digest(signature, _sign(payload)):
+        return None
+    try:
+        user_id, issued, expires = int(parts[0]), int(parts[1]), int(parts[2])
+    except ValueError:
+        return None
+    if expires <= time.time():
+        return None
+    return user_id, issued, expires, parts[3]
+
+
+class BloomFilter:
+    # Conjunto aproximado: sin falsos negativos y con pocos falsos positivos,
+    # que se confirman siempre contra la tabla
+
+    def __init__(self, size_bits, hashes):
+        self.size = size_bits
+        self.hashes = hashes
+        self.bits = bytearray((size_bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RevocationFilter:
+    # Copia en memoria de RevokedToken. Se recarga cada pocos segundos para ver
+    # las revocaciones hechas por otros procesos.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filter = None
+        self._loaded_at = 0
+
+    def _stale(self):
+        return self._filter is None or time.monotonic() - self._loaded_at > settings.CARBUY_REVOCATION_REFRESH
+
+    def _current(self):
+        if self._stale():
+            with self._lock:
+                if self._stale():
+                    self.reload()
+        return self._filter
+
+    def reload(self):
+        bloom = BloomFilter(settings.CARBUY_REVOCATION_BLOOM_BITS, settings.CARBUY_REVOCATION_BLOOM_HASHES)
+        keys = RevokedToken.objects.filter(expires_at__gt=int(time.time())).values_list('key', flat=True)
+        for key in keys.iterator():
+            bloom.add(key)
+        self._filter = bloom
+        self._loaded_at = time.monotonic()
+
+    def is_revoked(self, user_id, issued, jti):
+        bloom = self._current()
+        jti_key = 'jti:' + jti
+        if jti_key in bloom and RevokedToken.objects.filter(key=jti_key).exists():
+            return True
+        user_key = 'user:%d' % user_id
+        if user_key in bloom:
+            not_before = RevokedToken.objects.filter(key=user_key).values_list('not_before', flat=True).first()
+            if not_before is not None and issued < not_before:
+                return True
+        return False
+
+    def needs_check(self, user_id, jti):
+        # Indica si hay que consultar la base de datos para saber si el token
+        # esta revocado (filtro sin cargar o caducado, o posible revocacion)
+        bloom = self._filter
+        return self._stale() or ('jti:' + jti) in bloom or ('user:%d' % user_id) in bloom
+
+    def revoke_token(self, jti, expires):
+        self.prune()
+        RevokedToken.objects.get_or_create(key='jti:' + jti, defaults={'expires_at': expires})
+        self._current().add('jti:' + jti)
+
+    def revoke_user(self, user_id):
+        # Invalida todos los tokens del usuario emitidos hasta este momento
+        key = 'user:%d' % user_id
+        self.prune()
+        RevokedToken.objects.update_or_create(key=key, defaults={
+            'not_before': now_ms(),
+            'expires_at': int(time.time()) + settings.CARBUY_TOKEN_TTL,
+        })
+        self._current().add(key)
+
+    def prune(self):
+        # Las revocaciones de tokens ya caducados no hacen falta
+        RevokedToken.objects.filter(expires_at__lte=int(time.time())).delete()
+
+
+revocations = RevocationFilter()
+
+
+def is_signed_token(token):
+    return token.count('.') == 4
+
+
+def session_user_id(token):
+    # Resuelve el id del usuario de un token de sesion, o None si no es valido
+    if not token:
+        return None
+    if is_signed_token(token):
+        claims = decode_token(token)
+        if claims is None:
+            return None
+        user_id, issued, expires, jti = claims
+        if revocations.is_revoked(user_id, issued, jti):
+            return None
+        return user_id
+    return User.objects.filter(token=token).values_list('id', flat=True).first()
+
+
+async def asession_user_id(token):
+    # Version asincrona de session_user_id. Los tokens firmados se resuelven sin
+    # salir del bucle de eventos salvo que el filtro de revocaciones lo exija.
+    if not token:
+        return None
+    if is_signed_token(token):
+        claims = decode_token(token)
+        if claims is None:
+            return None
+        user_id, issued, expires, jti = claims
+        if revocations.needs_check(user_id, jti):
+            return await sync_to_async(session_user_id)(token)
+        return user_id
+    return await User.objects.filter(token=token).values_list('id', flat=True).afirst()
+
+
+def start_session(user_id):
+    # Crea un token de sesion nuevo. Con tokens firmados no se escribe nada en
+    # la base de datos; con los antiguos solo se actualiza la columna token.
+    if settings.CARBUY_SIGNED_TOKENS:
+        return issue_token(user_id)
+    token = secrets.token_hex(10)
+    User.objects.filter(id=user_id).update(token=token)
+    return token
+
+
+def end_session(token):
+    # Cierra la sesion del token. Devuelve False si el token no era valido.
+    if is_signed_token(token):
+        claims = decode_token(token)
+        if claims is None:
+            return False
+        user_id, issued, expires, jti = claims
+        revocations.revoke_token(jti, expires)
+        return True
+    return User.objects.filter(token=token).update(token=None) > 0